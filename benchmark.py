@@ -0,0 +1,319 @@
+import array
+import collections
+import sys
+import time
+import argparse
+
+import syspath_fix
+syspath_fix.update_sys_path()
+
+import twistedbot.logbot as logbot
+
+
+log = logbot.getlogger("BENCHMARK")
+
+
+def conformance(args):
+    from twistedbot import packet_samples, traffic
+    from twistedbot.grid import check_block_tables, check_change_notifications
+    errors = packet_samples.check_conformance()
+    for error in errors:
+        log.msg(error)
+    log.msg("packet engines conformance: %s" % ("FAILED" if errors else "OK"))
+    # on the surface, in the ground, at the column edge
+    table_errors = check_block_tables(traffic.terrain_grid(1), [(3, 63, 5), (12, 40, 2), (15, 50, 15)])
+    for error in table_errors:
+        log.msg(error)
+    log.msg("block tables: %s" % ("FAILED" if table_errors else "OK"))
+    change_errors = check_change_notifications(traffic.terrain_grid(1), 12, 40, 2)
+    for error in change_errors:
+        log.msg(error)
+    log.msg("block change notifications: %s" % ("FAILED" if change_errors else "OK"))
+    return 1 if errors or table_errors or change_errors else 0
+
+
+def timed(f, repeat):
+    start = time.time()
+    for _ in xrange(repeat):
+        f()
+    return (time.time() - start) / repeat
+
+
+def encoders(args):
+    from twistedbot import packet_samples
+    from twistedbot.packets import packets, packets_by_name, encoders, Container
+    samples = packet_samples.samples()
+    names = ["keep alive", "chat message", "player position&look", "entity action",
+             "player digging", "player block placement", "held item change", "click window"]
+    log.msg("%-24s %12s %12s %12s" % ("packet", "construct us", "payload us", "positional us"))
+    for name in names:
+        pid = packets_by_name[name]
+        payload = samples[pid][0]
+        template = packets[pid]
+        encoder = encoders[pid]
+        values = packet_samples.flat_values(pid, payload)
+        reference = timed(lambda: chr(pid) + template.build(Container(**payload)), args.repeat)
+        built = timed(lambda: encoder.build(payload), args.repeat)
+        positional = timed(lambda: encoder(*values), args.repeat)
+        log.msg("%-24s %12.2f %12.2f %12.2f" % (name, reference * 1e6, built * 1e6, positional * 1e6))
+    return 0
+
+
+def replay(args):
+    from twistedbot import config, traffic
+    from twistedbot.packets import packets
+    config.CHUNK_INGEST_WORKERS = 0
+    config.BATCH_WRITES = False
+    if args.capture:
+        from twistedbot.capture import CaptureReader, SERVER
+        reader = CaptureReader(args.capture)
+        captured = [(ord(f.data[0]), str(f.data)) for f in reader.frames(SERVER)]
+        reader.close()
+        sources = [(args.capture, lambda: captured)]
+    else:
+        names = [args.scenario] if args.scenario else sorted(traffic.scenarios)
+        sources = [(name, lambda name=name: traffic.encode(traffic.scenarios[name]())) for name in names]
+    for name, source in sources:
+        frames = source()
+        run = traffic.Replay(frames)
+        size = len(run.stream) / 1048576.0
+        decode = run.decode()
+        pipeline = run.pipeline()
+        log.msg("%s: %d packets %.2f MB" % (name, len(frames), size))
+        log.msg("  decode    %8.0f packets/s %7.2f MB/s" % (len(frames) / decode, size / decode))
+        log.msg("  pipeline  %8.0f packets/s %7.2f MB/s" % (len(frames) / pipeline, size / pipeline))
+        for pid, (count, mean) in sorted(run.decode_times().iteritems()):
+            log.msg("  %3d %-28s %6d x %8.2f us" % (pid, packets[pid].name, count, mean * 1e6))
+    return 0
+
+
+def grid(args):
+    import random
+    from twistedbot import blocks, traffic, utils
+    from twistedbot.axisbox import AABB
+    from twistedbot.grid import BlockRecord
+    from twistedbot.gridspace import NodeState, node_flags
+    g = traffic.terrain_grid()
+    rnd = random.Random(1)
+    cells = [(rnd.randint(-32, 47), rnd.randint(0, 80), rnd.randint(-32, 47)) for _ in xrange(1000)]
+    repeat = max(1, args.repeat / 1000)
+
+    def each(f):
+        return lambda: [f(x, y, z) for x, y, z in cells]
+
+    def node_objects(x, y, z):
+        b0, b1, b2 = g.get_block(x, y - 1, z), g.get_block(x, y, z), g.get_block(x, y + 1, z)
+        return b0.can_stand_on and b1.can_fall_through and b2.can_fall_through and b1.is_free and b2.is_free
+
+    def collisions_objects(bb):
+        out = []
+        for blk in g.blocks_in_aabb(bb.extend_to(0, -1, 0)):
+            blk.add_grid_bounding_boxes_to(out)
+        return out
+
+    boxes = [AABB(x + 0.2, y + 0.1, z + 0.2, x + 0.8, y + 1.9, z + 0.8) for x, y, z in cells]
+    buffer = array.array('d')
+
+    def sweep_objects(bb):
+        """ move_collisions before the box buffer, one step of 0.3, -0.5, 0.3 """
+        aabbs = collisions_objects(bb.extend_to(0.3, -0.5, 0.3))
+        d = [0.3, -0.5, 0.3]
+        for axis in (1, 0, 2):
+            for col_bb in aabbs:
+                d[axis] = bb.calculate_axis_offset(col_bb, d[axis], axis)
+        return d
+
+    def sweep_boxes(bb):
+        g.collision_boxes(bb.extend_to(0.3, -0.5, 0.3), buffer)
+        return [bb.axis_offset_in(buffer, d, axis) for d, axis in ((-0.5, 1), (0.3, 0), (0.3, 2))]
+
+    rays = [(utils.Vector(x + 0.5, y + 0.5, z + 0.5), utils.Vector(rnd.uniform(-1, 1), rnd.uniform(-1, 1),
+                                                                   rnd.uniform(-1, 1))) for x, y, z in cells]
+    rows = [("get_block", each(g.get_block)),
+            ("block_id_at", each(g.block_id_at)),
+            ("flags_at", each(g.flags_at)),
+            ("node flags from objects", each(node_objects)),
+            ("NodeState", each(lambda x, y, z: NodeState(x, y, z, node_flags(g, x, y, z)))),
+            ("collisions from objects", lambda: [collisions_objects(bb) for bb in boxes]),
+            ("collision_aabbs_in", lambda: [g.collision_aabbs_in(bb) for bb in boxes]),
+            ("collision_boxes", lambda: [g.collision_boxes(bb, buffer) for bb in boxes]),
+            ("sweep objects", lambda: [sweep_objects(bb) for bb in boxes]),
+            ("sweep collision_boxes", lambda: [sweep_boxes(bb) for bb in boxes]),
+            ("ground_below", each(g.ground_below)),
+            ("raycast_to_block", lambda: [g.raycast_to_block(start, ray) for start, ray in rays])]
+    for name, f in rows:
+        log.msg("%-24s %8.2f us" % (name, timed(f, repeat) * 1e6 / len(cells)))
+    chunks, nbytes = g.memory()
+    kinds = collections.Counter(section.kind for chunk in g.chunks.itervalues()
+                                for section in chunk.sections if section is not None)
+    log.msg("%d chunks %.1fKB each, sections %s" % (chunks, nbytes / 1024.0 / chunks, dict(kinds)))
+    for x, y, z in cells[:20]:
+        g.change_block_to(x, min(y, 63), z, blocks.CraftingTable.number, 0)
+    center = utils.Vector(8, 64, 8)
+    search = lambda: list(g.blocks_in_distance(center, block_number=blocks.CraftingTable.number, distance=80))
+    log.msg("blocks_in_distance %d crafting tables %8.2f us" % (len(search()), timed(search, repeat) * 1e6))
+    nearest = lambda: next(g.nearest_blocks(center, blocks.CraftingTable.number, distance=80), None)
+    log.msg("nearest_blocks closest crafting table %8.2f us" % (timed(nearest, repeat) * 1e6))
+    swaps = [[BlockRecord(rnd.randint(0, 15), rnd.randint(20, 62), rnd.randint(0, 15), block_id, 0)
+              for _ in xrange(256)] for block_id in (1, 3)]
+    per_record = lambda: [g.change_block_to(r.x, r.y, r.z, r.block_id, r.meta) for records in swaps for r in records]
+    batched = lambda: [g.multi_block_change(0, 0, records) for records in swaps]
+    log.msg("block changes per record %8.2f us multi_block_change %8.2f us" %
+            (timed(per_record, repeat) * 1e6 / 512, timed(batched, repeat) * 1e6 / 512))
+    return 0
+
+
+def raycast(args):
+    import math
+    import random
+    from twistedbot import raycast, traffic
+    g = traffic.terrain_grid()
+    rnd = random.Random(1)
+    for x in xrange(-32, 40):  # a cave along x, ending in rock
+        for y in xrange(38, 41):
+            for z in xrange(7, 10):
+                g.change_block_to(x, y, z, 0, 0)
+    repeat = max(1, args.repeat / 1000)
+
+    def ray_objects(x, y, z, dx, dy, dz, max_distance):
+        """ DDA building a block at every step """
+        gx, gy, gz = int(math.floor(x)), int(math.floor(y)), int(math.floor(z))
+        steps, deltas, tmaxs = zip(*[raycast.axis_start(p, gp, d / math.sqrt(dx * dx + dy * dy + dz * dz))
+                                     for p, gp, d in ((x, gx, dx), (y, gy, dy), (z, gz, dz))])
+        cell, tmaxs = [gx, gy, gz], list(tmaxs)
+        while True:
+            axis = tmaxs.index(min(tmaxs))
+            if tmaxs[axis] > max_distance:
+                return None
+            cell[axis] += steps[axis]
+            tmaxs[axis] += deltas[axis]
+            blk = g.get_block(*cell)
+            if blk.number:
+                return blk
+
+    sky = [((rnd.uniform(-32, 48), 80.5, rnd.uniform(-32, 48)),
+            (rnd.uniform(-1, 1), rnd.uniform(-0.1, 0.1), rnd.uniform(-1, 1))) for _ in xrange(200)]
+    cave = [((rnd.uniform(-32, 0), 39.5, 8.5), (1, rnd.uniform(-0.01, 0.01), rnd.uniform(-0.01, 0.01)))
+            for _ in xrange(200)]
+    down = [((rnd.uniform(-32, 48), 120.5, rnd.uniform(-32, 48)), (0.1, -1, 0.1)) for _ in xrange(200)]
+    log.msg("%-10s %8s %14s %14s" % ("rays", "hits", "objects us", "raycast us"))
+    for name, rays in (("sky", sky), ("cave", cave), ("down", down)):
+        hits = sum(1 for (x, y, z), (dx, dy, dz) in rays if raycast.raycast(g, x, y, z, dx, dy, dz, 100))
+        objects = timed(lambda: [ray_objects(x, y, z, dx, dy, dz, 100) for (x, y, z), (dx, dy, dz) in rays], repeat)
+        fast = timed(lambda: [raycast.raycast(g, x, y, z, dx, dy, dz, 100) for (x, y, z), (dx, dy, dz) in rays],
+                     repeat)
+        log.msg("%-10s %8d %14.2f %14.2f" % (name, hits, objects * 1e6 / len(rays), fast * 1e6 / len(rays)))
+    cone = raycast.cone_directions(1, -0.3, 0, 0.4, rings=4, per_ring=12)
+    visible = lambda: raycast.visible_blocks(g, 0.5, 64.6, 0.5, cone, 8)
+    log.msg("cone of %d rays, %d visible blocks %8.2f us" % (len(cone), len(visible()), timed(visible, repeat) * 1e6))
+    return 0
+
+
+def path(args):
+    from StringIO import StringIO
+    from twistedbot import traffic, utils
+    from twistedbot.grid import Grid, read_column
+    from twistedbot.gridspace import GridSpace, walkability
+    from twistedbot.pathfinding import AStarCoords
+    started = time.time()
+    g = Grid(None)
+    g.load_columns([read_column(StringIO(traffic.terrain_column(x, z)), x, z, True, 15, 0)
+                    for x in xrange(-13, 14) for z in xrange(-2, 3)])
+    for trench_x in xrange(-160, 200, 40):  # too deep to cross, bridged at alternating ends
+        bridge = range(-20, -17) if trench_x % 80 else range(27, 30)
+        for z in xrange(-32, 48):
+            if z not in bridge:
+                for y in xrange(56, 64):
+                    g.change_block_to(trench_x, y, z, 0, 0)
+                    g.change_block_to(trench_x + 1, y, z, 0, 0)
+    dimension = collections.namedtuple("Dimension", "grid")(g)
+    log.msg("grid of %d chunks in %.1fs" % (len(g.chunks), time.time() - started))
+
+    def search():
+        started = time.time()
+        astar = AStarCoords(dimension, utils.Vector(-196, 64, 5), utils.Vector(204, 64, 5))
+        astar.astar.max_cost = 1000
+        try:
+            while True:
+                astar.next()
+        except StopIteration:
+            pass
+        return astar, time.time() - started
+
+    cache = walkability(g)
+    for name in ("cold", "warm"):
+        hits, misses = cache.hits, cache.misses
+        astar, spent = search()
+        log.msg("%s search %d steps %d iterations %.3fs, node flags %d cached %d computed" %
+                (name, len(astar.path or []), astar.astar.iter_count, spent, cache.hits - hits,
+                 cache.misses - misses))
+    log.msg("walkability of %d sections, moves of %d nodes" %
+            (len(cache.sections), sum(len(masks) for masks in cache.moves.itervalues())))
+    # open heap and sets of the search with every node reachable from them through the parents
+    search_bytes = deep_size((astar.astar.open_heap, astar.astar.open_set, astar.astar.closed_set, astar.path))
+    log.msg("search state %.1fMB, %.1f bytes per explored node" %
+            (search_bytes / 1048576.0, search_bytes / float(len(astar.astar.closed_set))))
+    steps = [node.coords for node in reversed(astar.path)]
+
+    def checks():
+        """ what MoveTo checks every tick, for every step of the path """
+        for start, target in zip(steps, steps[1:]):
+            gs = GridSpace(g)
+            gs.can_go(gs.get_state_coords(start).key, gs.get_state_coords(target).key)
+
+    repeat = max(1, args.repeat / 1000)
+    cold = timed(lambda: (cache.sections.clear(), cache.moves.clear(), checks()), repeat)
+    warm = timed(checks, repeat)
+    log.msg("move checks per step cold %.2f us warm %.2f us" % (cold * 1e6 / len(steps), warm * 1e6 / len(steps)))
+    return 0
+
+
+def deep_size(o):
+    """ bytes of o and the objects it holds, each object counted once """
+    seen = set()
+    stack = [o]
+    size = 0
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.iterkeys())
+            stack.extend(o.itervalues())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        elif hasattr(o, "__dict__"):
+            stack.append(o.__dict__)
+        elif hasattr(o, "__slots__"):
+            stack.extend(getattr(o, name) for name in o.__slots__ if hasattr(o, name))
+    return size
+
+
+commands = {
+    "conformance": conformance,
+    "encoders": encoders,
+    "grid": grid,
+    "path": path,
+    "raycast": raycast,
+    "replay": replay,
+}
+
+
+def start():
+    parser = argparse.ArgumentParser(description='Benchmarks and self checks.')
+    parser.add_argument('command', choices=sorted(commands.keys()),
+                        help='what to run')
+    parser.add_argument('--scenario', default=None,
+                        help='replay only this traffic scenario')
+    parser.add_argument('--capture', default=None,
+                        help='replay server frames of this capture file instead of the scenarios')
+    parser.add_argument('--repeat', type=int, default=10000,
+                        help='iterations for timing loops')
+    args = parser.parse_args()
+    sys.exit(commands[args.command](args))
+
+
+if __name__ == '__main__':
+    start()
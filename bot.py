@@ -62,6 +62,13 @@ def start():
     parser.add_argument('--log2file',
                         action='store_true',
                         help='Save log data to file')
+    parser.add_argument('--packet_engine', default=config.PACKET_ENGINE,
+                        choices=['compiled', 'construct'],
+                        dest='packet_engine',
+                        help='packet decoding engine')
+    parser.add_argument('--chunk_cache', default=config.CHUNK_CACHE_DIR,
+                        dest='chunk_cache',
+                        help='directory of the on disk chunk cache')
     args = parser.parse_args()
     if args.log2file:
         logbot.start_bot_filelog()
@@ -70,6 +77,8 @@ def start():
     config.EMAIL = args.botemail
     config.USE_ENCRYPTION = args.use_encryption or args.onlinemode
     config.ONLINE_LOGIN = args.onlinemode
+    config.PACKET_ENGINE = args.packet_engine
+    config.CHUNK_CACHE_DIR = args.chunk_cache
     if config.USE_ENCRYPTION:
         factory.import_encryption()  
     config.COMMANDER = args.commandername.lower()
@@ -0,0 +1,87 @@
+import os
+import sys
+import argparse
+
+import syspath_fix
+syspath_fix.update_sys_path()
+
+from twisted.internet import reactor
+from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.task import LoopingCall
+
+from twistedbot import config
+from twistedbot import logbot
+from twistedbot.fakeserver import FakeServerFactory
+
+
+log = logbot.getlogger("LOAD TEST")
+
+
+class BotProcess(ProcessProtocol):
+    """ bot.py running against the fake server, its output is dropped """
+
+    def __init__(self, name):
+        self.name = name
+
+    def processEnded(self, reason):
+        log.msg("%s process ended, %s" % (self.name, reason.getErrorMessage()))
+
+
+def spawn_bots(count, port, python):
+    bot_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+    processes = []
+    for i in xrange(count):
+        name = "loadbot%d" % i
+        args = [python, bot_py, "--serverhost", "127.0.0.1", "--serverport", str(port), "--botname", name]
+        processes.append(reactor.spawnProcess(BotProcess(name), python, args, env=os.environ))
+    return processes
+
+
+def stop_bots(processes):
+    for p in processes:
+        if p.pid is not None:
+            p.signalProcess("INT")
+
+
+def start():
+    parser = argparse.ArgumentParser(description='Fake Minecraft server for load tests.')
+    parser.add_argument('--port', type=int, default=config.SERVER_PORT,
+                        help='port to listen on')
+    parser.add_argument('--bots', type=int, default=0,
+                        help='number of bot.py processes to start against the fake server')
+    parser.add_argument('--python', default=sys.executable,
+                        help='interpreter for the bot processes, e.g. pypy')
+    parser.add_argument('--radius', type=int, default=3,
+                        help='chunk columns around the spawn')
+    parser.add_argument('--mobs', type=int, default=20,
+                        help='mobs alive at any time')
+    parser.add_argument('--entity_churn', type=float, default=1.0,
+                        help='mobs destroyed and spawned per second')
+    parser.add_argument('--block_changes', type=float, default=10.0,
+                        help='blocks changed per second')
+    parser.add_argument('--no_echo', action='store_true',
+                        help='do not echo positions of bots to the other bots')
+    parser.add_argument('--report', type=float, default=10.0,
+                        help='seconds between tick lag reports')
+    parser.add_argument('--duration', type=float, default=None,
+                        help='stop after this many seconds')
+    parser.add_argument('--log2file', action='store_true',
+                        help='Save log data to file')
+    args = parser.parse_args()
+    if args.log2file:
+        logbot.start_filelog(kind="fakeserver_log")
+    factory = FakeServerFactory(radius=args.radius, mobs=args.mobs, entity_churn=args.entity_churn,
+                                block_changes=args.block_changes, echo_positions=not args.no_echo)
+    reactor.listenTCP(args.port, factory)
+    log.msg("fake server on port %d" % args.port)
+    processes = spawn_bots(args.bots, args.port, args.python)
+    LoopingCall(factory.log_lag).start(args.report, now=False)
+    if args.duration is not None:
+        reactor.callLater(args.duration, reactor.stop)
+    reactor.addSystemEventTrigger("before", "shutdown", stop_bots, processes)
+    reactor.addSystemEventTrigger("before", "shutdown", factory.log_lag)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    start()
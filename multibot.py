@@ -0,0 +1,72 @@
+import signal
+import argparse
+
+import syspath_fix
+syspath_fix.update_sys_path()
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+
+import twistedbot.config as config
+import twistedbot.logbot as logbot
+from twistedbot.multibot import BotHost, MetricsReporter, read_roster
+
+
+log = logbot.getlogger("MAIN")
+
+
+def start():
+    parser = argparse.ArgumentParser(description='Run many bots in one process.')
+    parser.add_argument('roster',
+                        help='file with one bot per line: name [host[:port]] [commander]')
+    parser.add_argument('--stagger', type=float, default=0.2,
+                        help='seconds between connecting two bots')
+    parser.add_argument('--report', type=float, default=30.0,
+                        help='seconds between tick lag reports')
+    parser.add_argument('--shard', default=None,
+                        help='i/n, host only every n-th bot of the roster starting with the i-th')
+    parser.add_argument('--metrics_fd', type=int, default=None,
+                        help='write metrics as json lines to this file descriptor on every report')
+    parser.add_argument('--use_encryption',
+                        action='store_true',
+                        help='use encryption')
+    parser.add_argument('--log2file',
+                        action='store_true',
+                        help='Save log data to file')
+    parser.add_argument('--packet_engine', default=config.PACKET_ENGINE,
+                        choices=['compiled', 'construct'],
+                        dest='packet_engine',
+                        help='packet decoding engine')
+    parser.add_argument('--chunk_cache', default=config.CHUNK_CACHE_DIR,
+                        dest='chunk_cache',
+                        help='directory of the on disk chunk cache, shared by the bots')
+    args = parser.parse_args()
+    if args.log2file:
+        logbot.start_bot_filelog()
+    config.USE_ENCRYPTION = args.use_encryption
+    config.PACKET_ENGINE = args.packet_engine
+    config.CHUNK_CACHE_DIR = args.chunk_cache
+    roster = read_roster(args.roster)
+    if args.shard:
+        index, count = map(int, args.shard.split("/"))
+        roster = roster[index::count]
+    host = BotHost(roster, stagger=args.stagger)
+    host.start()
+
+    def customKeyboardInterruptHandler(signum, stackframe):
+        log.msg("CTRL-C from user, exiting....")
+        for mc_factory in host.factories:
+            mc_factory.log_connection_lost = False
+        reactor.callFromThread(reactor.stop)
+
+    signal.signal(signal.SIGINT, customKeyboardInterruptHandler)
+    LoopingCall(host.log_lag).start(args.report, now=False)
+    if args.metrics_fd is not None:
+        LoopingCall(MetricsReporter(host, args.metrics_fd).report).start(args.report, now=False)
+    reactor.addSystemEventTrigger("before", "shutdown", host.stop)
+    reactor.addSystemEventTrigger("before", "shutdown", host.log_lag)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    start()
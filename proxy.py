@@ -8,7 +8,7 @@ import argparse
 from twisted.internet import reactor
 from twisted.internet.protocol import Protocol, Factory
 
-from twistedbot.packets import make_packet, parse_packets, packets
+from twistedbot.packets import make_packet, packets, PacketBuffer
 from twistedbot import encryption
 from twistedbot import logbot
 from twistedbot import config
@@ -33,10 +33,23 @@ class ProxyProtocol(Protocol):
     def parse_encrypted_stream(self, bytestream):
         plaintext = self.decipher.decrypt(bytestream)
         self.opposite_proxy_side.protocol.sendData(plaintext)
-        data = self.leftover + plaintext
-        parsed_packets, self.leftover = parse_packets(data)
-        processor.process_packets(self.mgsside, parsed_packets,
-                                  encrypted=True, leftover=self.leftover)
+        self.buffer.feed(plaintext)
+        if getattr(processor, "needs_frames", False):
+            parsed_packets, frames = self.buffer.read_frames()
+            processor.process_packets(self.mgsside, parsed_packets, encrypted=True, frames=frames)
+        else:
+            parsed_packets = self.buffer.read_packets()
+            processor.process_packets(self.mgsside, parsed_packets, encrypted=True)
+
+    def read_and_process(self):
+        """ unencrypted part of the stream, returns parsed packets and their raw bytes """
+        if getattr(processor, "needs_frames", False):
+            parsed_packets, frames = self.buffer.read_frames()
+            processor.process_packets(self.mgsside, parsed_packets, frames=frames)
+            return parsed_packets, "".join(frames)
+        parsed_packets, data = self.buffer.read_packets_raw()
+        processor.process_packets(self.mgsside, parsed_packets)
+        return parsed_packets, data
 
     def start_encryption(self):
         self.encryption_on = True
@@ -50,7 +63,7 @@ class ProxyServerProtocol(ProxyProtocol):
         self.factory = factory
         self.encryption_on = False
         self.parser = self.parse_stream
-        self.leftover = ""
+        self.buffer = PacketBuffer()
         self.mgsside = self.factory.mgsside
         self.log = self.factory.log
         self.opposite_proxy_side = self.factory.proxyclient
@@ -64,10 +77,8 @@ class ProxyServerProtocol(ProxyProtocol):
         self.factory.proxyclient.protocol.transport.loseConnection()
 
     def parse_stream(self, bytestream):
-        data = self.leftover + bytestream
-        parsed_packets, self.leftover = parse_packets(data)
-        processor.process_packets(
-            self.mgsside, parsed_packets, leftover=self.leftover)
+        self.buffer.feed(bytestream)
+        parsed_packets, data = self.read_and_process()
         for p in parsed_packets:
             if p[0] == 253:
                 self.on_encryption_key_request(p[1])
@@ -151,7 +162,7 @@ class ProxyClientProtocol(ProxyProtocol):
         self.factory = factory
         self.encryption_on = False
         self.parser = self.parse_stream
-        self.leftover = ""
+        self.buffer = PacketBuffer()
         self.mgsside = self.factory.mgsside
         self.log = self.factory.log
         self.proxyserver = ProxyServerFactory(self.factory)
@@ -170,12 +181,10 @@ class ProxyClientProtocol(ProxyProtocol):
         if self.proxyserver.protocol is None:
             self.log.msg(
                 "Not having connection to server yet, postpone proxying")
-            self.leftover += bytestream
+            self.buffer.feed(bytestream)
             return
-        data = self.leftover + bytestream
-        parsed_packets, self.leftover = parse_packets(data)
-        processor.process_packets(
-            self.mgsside, parsed_packets, leftover=self.leftover)
+        self.buffer.feed(bytestream)
+        parsed_packets, data = self.read_and_process()
         for p in parsed_packets:
             if p[0] == 252:
                 self.on_encryption_key_responce(p[1])
@@ -247,6 +256,10 @@ if __name__ == '__main__':
                         default='default',
                         dest='processor',
                         help='Processor for packets, to print, save, analyze')
+    parser.add_argument('--capture_file',
+                        default=None,
+                        dest='capture_file',
+                        help='File for the capture processor, default capture-<time>.tbcap')
     parser.add_argument('--log2file',
                         action='store_true',
                         help='Save log data to file')
@@ -275,6 +288,8 @@ if __name__ == '__main__':
             logbot.msg("Filter packet ids %s" % args.filter_packets)
         processor.ignore_packets = args.ignore_packets
         processor.filter_packets = args.filter_packets
+        if args.capture_file:
+            processor.capture_file = args.capture_file
     except:
         logbot.exit_on_error(_why="Cannot import %s" % (
             'proxy_processors.' + args.processor,))
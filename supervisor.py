@@ -0,0 +1,52 @@
+import os
+import sys
+import signal
+import argparse
+import multiprocessing
+
+import syspath_fix
+syspath_fix.update_sys_path()
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+
+import twistedbot.logbot as logbot
+from twistedbot.supervisor import Supervisor
+
+
+log = logbot.getlogger("MAIN")
+
+
+def start():
+    parser = argparse.ArgumentParser(description='Spread bots of a roster over worker processes.')
+    parser.add_argument('roster',
+                        help='file with one bot per line: name [host[:port]] [commander]')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='worker processes, default is one per core')
+    parser.add_argument('--python', default=sys.executable,
+                        help='interpreter for the workers, e.g. pypy')
+    parser.add_argument('--report', type=float, default=30.0,
+                        help='seconds between metrics reports')
+    parser.add_argument('--log2file',
+                        action='store_true',
+                        help='Save log data to file')
+    args, worker_args = parser.parse_known_args()
+    if args.log2file:
+        logbot.start_filelog(kind="supervisor_log")
+    multibot_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "multibot.py")
+    supervisor = Supervisor(args.roster, args.workers, args.python, multibot_py,
+                            report=args.report, worker_args=worker_args)
+    supervisor.start()
+
+    def customKeyboardInterruptHandler(signum, stackframe):
+        log.msg("CTRL-C from user, exiting....")
+        reactor.callFromThread(reactor.stop)
+
+    signal.signal(signal.SIGINT, customKeyboardInterruptHandler)
+    LoopingCall(supervisor.log_metrics).start(args.report, now=False)
+    reactor.addSystemEventTrigger("before", "shutdown", supervisor.stop)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    start()
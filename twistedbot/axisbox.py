@@ -8,6 +8,9 @@ import utils
 from utils import Vector
 
 
+other_axes = ((1, 2), (0, 2), (0, 1))
+
+
 class AABB(object):
     """ Axis aligned bounding box """
     def __init__(self, min_x, min_y, min_z, max_x, max_y, max_z):
@@ -259,6 +262,53 @@ class AABB(object):
             col = fops.lte(u0, min(u_1))
         return col, u0
 
+    def axis_offset_in(self, boxes, d, axis):
+        """
+        calculate_axis_offset against every box of boxes, a flat buffer of
+        min_x, min_y, min_z, max_x, max_y, max_z as Grid.collision_boxes fills
+        """
+        mins, maxs = self.mins, self.maxs
+        a1, a2 = other_axes[axis]
+        lte, gte = fops.lte, fops.gte
+        # overlaps up to ABS_TOL are within the tolerance of fops, overlaps beyond slack never are
+        if not boxes:
+            return d
+        slack = fops.ABS_TOL + fops.REL_TOL * max(max(boxes), -min(boxes), max(maxs), -min(mins))
+        abs_tol = fops.ABS_TOL
+        for i in xrange(0, len(boxes), 6):
+            overlap = maxs[a1] - boxes[i + a1]
+            if overlap <= abs_tol or overlap <= slack and lte(maxs[a1], boxes[i + a1]):
+                continue
+            overlap = boxes[i + 3 + a1] - mins[a1]
+            if overlap <= abs_tol or overlap <= slack and gte(mins[a1], boxes[i + 3 + a1]):
+                continue
+            overlap = maxs[a2] - boxes[i + a2]
+            if overlap <= abs_tol or overlap <= slack and lte(maxs[a2], boxes[i + a2]):
+                continue
+            overlap = boxes[i + 3 + a2] - mins[a2]
+            if overlap <= abs_tol or overlap <= slack and gte(mins[a2], boxes[i + 3 + a2]):
+                continue
+            if d < 0:
+                top = boxes[i + 3 + axis]
+                if lte(top, mins[axis]) and fops.gt(top - mins[axis], d):
+                    d = top - mins[axis]
+            elif d > 0:
+                bottom = boxes[i + axis]
+                if gte(bottom, maxs[axis]) and fops.lt(bottom - maxs[axis], d):
+                    d = bottom - maxs[axis]
+        return d
+
+    def collides_any(self, boxes):
+        """ collides with any box of a flat buffer as in axis_offset_in """
+        mins, maxs = self.mins, self.maxs
+        lte, gte = fops.lte, fops.gte
+        for i in xrange(0, len(boxes), 6):
+            if not (lte(maxs[0], boxes[i]) or gte(mins[0], boxes[i + 3]) or
+                    lte(maxs[1], boxes[i + 1]) or gte(mins[1], boxes[i + 4]) or
+                    lte(maxs[2], boxes[i + 2]) or gte(mins[2], boxes[i + 5])):
+                return True
+        return False
+
     def calculate_axis_offset(self, collidee, d, axis):
         for i in xrange(3):
             if i == axis:
@@ -1,10 +1,11 @@
 
+import itertools
+
 from twisted.internet.task import cooperate
 from twisted.internet.defer import inlineCallbacks
 
 import items
 import recipes
-import config
 import logbot
 import utils
 import fops
@@ -69,7 +70,7 @@ class BlackBoard(object):
         self.inventory_item_collected_count = self._world.inventories.get_item_collected_count
         self.inventory_tool_for_block = self._world.inventories.tool_for_block
         self.receive_inventory = self._world.inventories.get_open_window
-        self.blocks_around = self._world.grid.blocks_in_distance
+        self.blocks_nearest = self._world.grid.nearest_blocks
 
     def positions_to_dig(self, coords):
         gs = GridSpace(self.grid)
@@ -103,6 +104,10 @@ class BlackBoard(object):
     def commander_name(self):
         return self._world.commander.name
 
+    @property
+    def config(self):
+        return self._world.config
+
     @property
     def bot_object(self):
         return self._bot.bot_object
@@ -704,7 +709,7 @@ class CollectMine(BTSequencer):
 
     def setup(self):
         _, self.have_tool, self.mine_tool = self.blackboard.inventory_tool_for_block(self.recipe.block)
-        self.blocks_around = self.blackboard.blocks_around(self.blackboard.bot_object.position, block_number=self.recipe.block.number, block_filter=self.recipe.block_filter)
+        self.blocks_around = list(itertools.islice(self.blackboard.blocks_nearest(self.blackboard.bot_object.position, block_number=self.recipe.block.number, block_filter=self.recipe.block_filter), 1))
 
     def choices(self):
         if not self.have_tool:
@@ -780,7 +785,8 @@ class CraftItem(BTSelector):
         self.itemstack = itemstack
         self.recipe = recipe
         self.name = 'craft %s' % self.itemstack
-        self.sorted_tables = None
+        self.tried_tables = set()
+        self.closest_table = None
         log.msg(self.name)
 
     def is_valid(self):
@@ -792,22 +798,34 @@ class CraftItem(BTSelector):
 
     def setup(self):
         if self.recipe.need_bench:
-            self.crafting_tables_around = list(self.blackboard.blocks_around(self.blackboard.bot_object.position, block_number=blocks.CraftingTable.number, distance=80))
-            log.msg("There are %d crafting table around" % len(self.crafting_tables_around))
+            self.tried_tables = set()
+            self.closest_table = self.nearest_table()
+            log.msg("Closest crafting table %s" % self.closest_table)
 
     @property
     def is_tables_around(self):
-        return len(self.crafting_tables_around) > 0
+        return self.closest_table is not None
+
+    def nearest_table(self):
+        """ crafting table not tried yet nearest to where the bot is now """
+        for table in self.blackboard.blocks_nearest(self.blackboard.bot_object.position, block_number=blocks.CraftingTable.number, distance=80):
+            if table.coords not in self.tried_tables:
+                return table
+        return None
 
     def get_closest_table(self):
-        self.crafting_tables_around = sorted(self.crafting_tables_around, key=lambda b: (b.coords - self.blackboard.bot_object.position).size_pow)
-        return self.crafting_tables_around.pop(0)
+        table = self.nearest_table()
+        if table is not None:
+            self.tried_tables.add(table.coords)
+        self.closest_table = table
+        return table
 
     def choices(self):
         if self.recipe.need_bench:
-            while self.is_tables_around:
-                table = self.get_closest_table()
+            table = self.get_closest_table()
+            while table is not None:
                 yield self.make_behavior(CraftItemAtTable, recipe=self.recipe, craftingtable=table)
+                table = self.get_closest_table()
         else:
             yield self.make_behavior(CraftItemInventory, recipe=self.recipe)
 
@@ -839,6 +857,7 @@ class TravelTo(BTSequencer):
         self.travel_multiple_goals = multiple_goals
         self.shorten_path_by = shorten_path_by
         self.path = None
+        self.pinned_grid = None
         log.msg(self.name)
 
     @property
@@ -858,6 +877,8 @@ class TravelTo(BTSequencer):
             yield utils.reactor_break()
             sb = self.blackboard.bot_standing_on_block(self.blackboard.bot_object)
         else:
+            if self.travel_coords is not None:
+                self.blackboard.grid.load_cached_between(sb.coords, self.travel_coords)
             if self.travel_multiple_goals is not None:
                 d = cooperate(AStarMultiCoords(dimension=self.blackboard.dimension,
                                                start_coords=sb.coords,
@@ -880,6 +901,25 @@ class TravelTo(BTSequencer):
                     if self.shorten_path_by > 0:
                         self.path = self.path[self.shorten_path_by:]
                     self.start_coords = current_start.coords
+                    self.pinned_grid = self.blackboard.grid
+                    self.pinned_grid.pin(("path", id(self)), [self.start_coords] + [step.coords for step in self.path])
+
+    @inlineCallbacks
+    def tick(self):
+        yield super(TravelTo, self).tick()
+        if self.status in (Status.success, Status.failure):
+            self.cleanup()
+
+    def from_child(self, child):
+        super(TravelTo, self).from_child(child)
+        if self.status == Status.failure:
+            self.cleanup()
+
+    def cleanup(self):
+        """ lets the grid evict the columns of the path again """
+        if self.pinned_grid is not None:
+            self.pinned_grid.unpin(("path", id(self)))
+            self.pinned_grid = None
 
     def choices(self):
         for step in reversed(self.path):
@@ -900,7 +940,7 @@ class MoveTo(BTAction):
         gs = GridSpace(self.blackboard.grid)
         self.start_state = gs.get_state_coords(self.start_coords)
         self.target_state = gs.get_state_coords(self.target_coords)
-        go = gs.can_go(self.start_state, self.target_state)
+        go = gs.can_go(self.start_state.key, self.target_state.key)
         if not go:
             log.msg('cannot go between %s %s' % (self.start_state, self.target_state))
             return Status.failure
@@ -971,7 +1011,7 @@ class ShowCursor(BTAction):
     def __init__(self, player=None, **kwargs):
         super(ShowCursor, self).__init__(**kwargs)
         self.player = player
-        self.name = 'show player %s cursor' % config.COMMANDER
+        self.name = 'show player %s cursor' % self.blackboard.config.COMMANDER
 
     def on_start(self):
         player_look_vector = utils.yaw_pitch_to_vector(self.player.yaw, self.player.pitch)
@@ -1,5 +1,6 @@
 
 import re
+import array
 
 import logbot
 import utils
@@ -15,6 +16,57 @@ log = logbot.getlogger("BLOCKS")
 block_list = [None for _ in xrange(256)]
 block_map = {}
 
+# block_flags bits, the table is indexed by block id << 4 | meta
+CAN_FALL_THROUGH = 1
+CAN_STAND_ON = 1 << 1
+CAN_STAND_IN = 1 << 2
+IS_FREE = 1 << 3
+IS_COLLIDABLE = 1 << 4
+IS_CLIMBABLE = 1 << 5
+IS_WATER = 1 << 6
+IS_LAVA = 1 << 7
+IS_LIQUID = 1 << 8
+IS_BURNING = 1 << 9
+IS_LADDER = 1 << 10
+IS_VINE = 1 << 11
+HAS_BOXES = 1 << 12
+ON_COLLIDED = 1 << 13
+BOXES_CONTEXT = 1 << 14  # bounding boxes depend on the neighbours, ask the block object
+CONTEXT = 1 << 15  # some property depends on the neighbours, ask the block object
+
+SHAPE_CONTEXT = 0xffff  # block_shape of blocks with BOXES_CONTEXT
+
+# per id << 4 | meta tables, filled by BlockMetaClass.emit_tables once all blocks are registered
+block_flags = array.array('H', [0] * (256 << 4))
+block_slipperiness = array.array('d', [0.0] * (256 << 4))
+block_shape = array.array('H', [0] * (256 << 4))
+collision_shapes = [()]  # tuples of (min_x, min_y, min_z, max_x, max_y, max_z) relative to the block
+# per id, 1 when every meta of the id has the flags and shape of stone, what section summaries call opaque
+block_opaque = bytearray(256)
+
+flag_properties = [(CAN_FALL_THROUGH, "can_fall_through"),
+                   (CAN_STAND_ON, "can_stand_on"),
+                   (CAN_STAND_IN, "can_stand_in"),
+                   (IS_FREE, "is_free"),
+                   (IS_COLLIDABLE, "is_collidable"),
+                   (IS_CLIMBABLE, "is_climbable"),
+                   (IS_WATER, "is_water"),
+                   (IS_LAVA, "is_lava"),
+                   (IS_BURNING, "is_burning"),
+                   (IS_LADDER, "is_ladder"),
+                   (IS_VINE, "is_vine")]
+
+
+class ContextNeeded(Exception):
+    pass
+
+
+class NoGrid(object):
+    """ grid of the probed blocks, any use means the property needs the neighbours """
+
+    def __getattr__(self, name):
+        raise ContextNeeded(name)
+
 wood_names = ["Oak", "Spruce", "Birch", "Jungle"]
 stone_lab_names = ["Stone", "Sandstone", None, "Cobblestone", "Brick", "Stone Brick", "Nether Brick", "Quartz"]
 
@@ -49,6 +101,57 @@ class BlockMetaClass(type):
             block_map[cls.name] = cls
         return cls
 
+    @staticmethod
+    def probe(cls, meta):
+        """ (flags, collision shape) of cls with meta, shape is None with BOXES_CONTEXT """
+        blk = cls(NoGrid(), 0, 0, 0, meta)
+        flags = 0
+        for flag, name in flag_properties:
+            try:
+                if getattr(blk, name):
+                    flags |= flag
+            except ContextNeeded:
+                flags |= CONTEXT
+            except AttributeError:
+                pass  # not defined for this block
+        if blk.material.is_liquid:
+            flags |= IS_LIQUID
+        if cls.on_entity_collided.im_func is not Block.on_entity_collided.im_func:
+            flags |= ON_COLLIDED
+        try:
+            boxes = []
+            blk.add_grid_bounding_boxes_to(boxes)
+        except Exception:
+            return flags | HAS_BOXES | BOXES_CONTEXT, None  # neighbours or something else, the object decides
+        if boxes:
+            flags |= HAS_BOXES
+        return flags, tuple((b.min_x, b.min_y, b.min_z, b.max_x, b.max_y, b.max_z) for b in boxes)
+
+    @staticmethod
+    def emit_tables():
+        """ fills the block tables from the registered blocks, probing every meta """
+        shape_index = {(): 0}
+        for cls in block_list:
+            if cls is None:
+                continue
+            for meta in xrange(16):
+                key = cls.number << 4 | meta
+                flags, shape = BlockMetaClass.probe(cls, meta)
+                block_flags[key] = flags
+                block_slipperiness[key] = cls.slipperiness
+                if shape is None:
+                    block_shape[key] = SHAPE_CONTEXT
+                else:
+                    if shape not in shape_index:
+                        shape_index[shape] = len(collision_shapes)
+                        collision_shapes.append(shape)
+                    block_shape[key] = shape_index[shape]
+        stone = (block_flags[1 << 4], block_shape[1 << 4])
+        for cls in block_list:
+            if cls is not None:
+                block_opaque[cls.number] = all((block_flags[cls.number << 4 | meta],
+                                                block_shape[cls.number << 4 | meta]) == stone for meta in xrange(16))
+
 
 class Block(object):
     __metaclass__ = BlockMetaClass
@@ -256,10 +359,7 @@ class BlockWater(BlockFluid):
 
     @property
     def height_percent(self):
-        if self.meta >= 8:
-            return 1 / 9.0
-        else:
-            return (self.meta + 1) / 9.0
+        return fluid_height_percent(self.meta)
 
 
 class BlockLava(BlockFluid):
@@ -1879,4 +1979,14 @@ class Dropper(BlockCube):
     material = materials.rock
 
 
+BlockMetaClass.emit_tables()
+
+
+def fluid_height_percent(meta):
+    if meta >= 8:
+        return 1 / 9.0
+    else:
+        return (meta + 1) / 9.0
+
+
 log.msg("registered %d blocks" % len(block_map))
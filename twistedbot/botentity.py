@@ -1,10 +1,10 @@
 
 
+import array
 import math
 
 import config
 import utils
-import packets
 import logbot
 import fops
 import blocks
@@ -105,6 +105,7 @@ class BotEntity(object):
         self.check_location_received = False
         self.spawn_point_received = False
         self.behavior_tree = bt.BehaviorTree(self.world, self)
+        self.collision_boxes = array.array('d')  # reused by move_collisions
 
     def on_connection_lost(self):
         if self.location_received:
@@ -121,6 +122,9 @@ class BotEntity(object):
         self.check_location_received = True
         if self.location_received is False:
             self.location_received = True
+            loaded = self.world.grid.load_cached_around(self.bot_object.position)
+            if loaded:
+                log.msg("filled %d chunks from the chunk cache" % loaded)
         if not self.in_complete_chunks(self.bot_object):
             log.msg("Server sent me into incomplete chunks, will wait until they load up.")
             self.ready = False
@@ -144,11 +148,8 @@ class BotEntity(object):
             utils.do_now(self.behavior_tree.tick)
 
     def send_location(self, b_obj):
-        self.world.send_packet("player position&look", {
-            "position": packets.Container(x=b_obj.x, y=b_obj.y, z=b_obj.z,
-                                          stance=b_obj.stance),
-            "orientation": packets.Container(yaw=b_obj.yaw, pitch=b_obj.pitch),
-            "grounded": packets.Container(grounded=b_obj.on_ground)})
+        self.world.send_values("player position&look", b_obj.x, b_obj.y, b_obj.stance, b_obj.z,
+                               b_obj.yaw, b_obj.pitch, b_obj.on_ground)
 
     def send_action(self, b_obj):
         """
@@ -156,7 +157,7 @@ class BotEntity(object):
         """
         if b_obj.action != b_obj._action:
             b_obj.action = b_obj._action
-            self.world.send_packet("entity action", {"eid": self.eid, "action": b_obj._action})
+            self.world.send_values("entity action", self.eid, b_obj._action)
 
     def turn_to_point(self, b_obj, point):
         if point.x == b_obj.x and point.z == b_obj.z:
@@ -205,11 +206,10 @@ class BotEntity(object):
         water_current = utils.Vector(0, 0, 0)
         bb = b_obj.aabb.expand(-0.001, -0.401, -0.001)
         top_y = utils.grid_shift(bb.max_y + 1)
-        for blk in self.world.grid.blocks_in_aabb(bb):
-            if isinstance(blk, blocks.BlockWater):
-                if top_y >= (blk.y + 1 - blk.height_percent):
-                    is_in_water = True
-                    water_current = blk.add_velocity_to(water_current)
+        for blk in self.world.grid.blocks_in_aabb_with(bb, blocks.IS_WATER):
+            if top_y >= (blk.y + 1 - blk.height_percent):
+                is_in_water = True
+                water_current = blk.add_velocity_to(water_current)
         if water_current.size > 0:
             water_current.normalize()
             wconst = 0.014
@@ -218,13 +218,7 @@ class BotEntity(object):
         return is_in_water
 
     def handle_lava_movement(self, b_obj):
-        for blk in self.world.grid.blocks_in_aabb(
-                b_obj.aabb.expand(-0.1,
-                                  -0.4,
-                                  -0.1)):
-            if isinstance(blk, blocks.BlockLava):
-                return True
-        return False
+        return self.world.grid.any_flag_in_aabb(b_obj.aabb.expand(-0.1, -0.4, -0.1), blocks.IS_LAVA)
 
     def move_collisions(self, b_obj, vx, vy, vz):
         if self.is_in_web(b_obj):
@@ -234,38 +228,30 @@ class BotEntity(object):
             b_obj.velocities.x = 0
             b_obj.velocities.y = 0
             b_obj.velocities.z = 0
-        aabbs = self.world.grid.collision_aabbs_in(b_obj.aabb.extend_to(vx, vy, vz))
+        boxes = self.collision_boxes
+        self.world.grid.collision_boxes(b_obj.aabb.extend_to(vx, vy, vz), boxes)
         b_bb = b_obj.aabb
         dy = vy
         if not fops.eq(vy, 0):
-            for bb in aabbs:
-                dy = b_bb.calculate_axis_offset(bb, dy, 1)
+            dy = b_bb.axis_offset_in(boxes, dy, 1)
             b_bb = b_bb.offset(dy=dy)
         dx = vx
         if not fops.eq(vx, 0):
-            for bb in aabbs:
-                dx = b_bb.calculate_axis_offset(bb, dx, 0)
+            dx = b_bb.axis_offset_in(boxes, dx, 0)
             b_bb = b_bb.offset(dx=dx)
         dz = vz
         if not fops.eq(vz, 0):
-            for bb in aabbs:
-                dz = b_bb.calculate_axis_offset(bb, dz, 2)
+            dz = b_bb.axis_offset_in(boxes, dz, 2)
             b_bb = b_bb.offset(dz=dz)
         if vy != dy and vy < 0 and (dx != vx or dz != vz):
             st = config.MAX_STEP_HEIGHT
-            aabbs = self.world.grid.collision_aabbs_in(b_obj.aabb.extend_to(vx, st, vz))
+            self.world.grid.collision_boxes(b_obj.aabb.extend_to(vx, st, vz), boxes)
             b_bbs = b_obj.aabb
-            dys = st
-            for bb in aabbs:
-                dys = b_bbs.calculate_axis_offset(bb, dys, 1)
+            dys = b_bbs.axis_offset_in(boxes, st, 1)
             b_bbs = b_bbs.offset(dy=dys)
-            dxs = vx
-            for bb in aabbs:
-                dxs = b_bbs.calculate_axis_offset(bb, dxs, 0)
+            dxs = b_bbs.axis_offset_in(boxes, vx, 0)
             b_bbs = b_bbs.offset(dx=dxs)
-            dzs = vz
-            for bb in aabbs:
-                dzs = b_bbs.calculate_axis_offset(bb, dzs, 2)
+            dzs = b_bbs.axis_offset_in(boxes, vz, 2)
             b_bbs = b_bbs.offset(dz=dzs)
             if fops.gt(dxs * dxs + dzs * dzs, dx * dx + dz * dz):
                 dx = dxs
@@ -369,9 +355,8 @@ class BotEntity(object):
         slowdown = 0.91
         if b_obj.on_ground:
             slowdown = 0.546
-            block = self.world.grid.get_block(b_obj.grid_x, b_obj.grid_y - 1, b_obj.grid_z)
-            if block is not None:
-                slowdown = block.slipperiness * 0.91
+            key = self.world.grid.block_key_at(b_obj.grid_x, b_obj.grid_y - 1, b_obj.grid_z)
+            slowdown = blocks.block_slipperiness[key] * 0.91
         return slowdown
 
     def current_speed_factor(self, b_obj):
@@ -396,16 +381,18 @@ class BotEntity(object):
         is_in_water = False
         bb = b_obj.aabb.expand(-0.001, -0.4010000059604645, -0.001)
         top_y = utils.grid_shift(bb.max_y + 1)
-        for blk in self.world.grid.blocks_in_aabb(bb):
-            if isinstance(blk, blocks.BlockWater):
-                if top_y >= (blk.y + 1 - blk.height_percent):
+        grid = self.world.grid
+        for x, y, z in bb.grid_area:
+            if grid.flags_at(x, y, z) & blocks.IS_WATER:
+                if top_y >= (y + 1 - blocks.fluid_height_percent(grid.meta_at(x, y, z))):
                     is_in_water = True
         return is_in_water
 
     def is_in_web(self, b_obj):
         bb = b_obj.aabb.expand(dx=-0.001, dy=-0.001, dz=-0.001)
-        for blk in self.world.grid.blocks_in_aabb(bb):
-            if isinstance(blk, blocks.Cobweb):
+        grid = self.world.grid
+        for x, y, z in bb.grid_area:
+            if grid.block_id_at(x, y, z) == blocks.Cobweb.number:
                 return True
         return False
 
@@ -413,16 +400,16 @@ class BotEntity(object):
         bb = b_obj.aabb
         eye_y = bb.min_y + eye_height
         ey = utils.grid_shift(eye_y)
-        blk = self.world.grid.get_block(bb.gridpos_x, ey, bb.gridpos_z)
-        if blk.is_water:
-            wh = blk.height_percent - 0.11111111
+        grid = self.world.grid
+        if grid.flags_at(bb.gridpos_x, ey, bb.gridpos_z) & blocks.IS_WATER:
+            wh = blocks.fluid_height_percent(grid.meta_at(bb.gridpos_x, ey, bb.gridpos_z)) - 0.11111111
             return eye_y < (ey + 1 - wh)
         else:
             return False
 
     def do_block_collision(self, b_obj):
         bb = b_obj.aabb.expand(-0.001, -0.001, -0.001)
-        for blk in self.world.grid.blocks_in_aabb(bb):
+        for blk in self.world.grid.blocks_in_aabb_with(bb, blocks.ON_COLLIDED):
             blk.on_entity_collided(b_obj)
 
     def is_sneaking(self, b_obj):
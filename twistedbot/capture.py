@@ -0,0 +1,162 @@
+"""
+Binary capture of decrypted packet frames.
+
+File layout is the magic followed by records, each record is a header
+(direction, monotonic timestamp in seconds since the capture started,
+frame length) and the raw frame, packet id byte included. Files are only
+ever appended to, a capture cut short by a crash is readable up to the
+last whole record.
+"""
+
+import ctypes
+import ctypes.util
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from collections import namedtuple
+from Queue import Queue
+
+from packet_compiler import PacketIncomplete
+from packets import decoders
+
+
+MAGIC = "TBCAP001"
+record_header = struct.Struct(">BdI")
+CLIENT = 0
+SERVER = 1
+directions = {"CLIENT": CLIENT, "SERVER": SERVER}
+
+Frame = namedtuple("Frame", "direction timestamp data")
+
+
+class timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+def make_monotonic():
+    """ CLOCK_MONOTONIC on linux, otherwise time.time that never goes back """
+    try:
+        if not sys.platform.startswith("linux"):
+            raise OSError("no CLOCK_MONOTONIC")
+        clock_gettime = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True).clock_gettime
+    except (OSError, AttributeError):
+        state = [0.0]
+
+        def monotonic():
+            state[0] = max(state[0], time.time())
+            return state[0]
+        return monotonic
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    ts = timespec()
+
+    def monotonic():
+        clock_gettime(1, ctypes.pointer(ts))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+monotonic = make_monotonic()
+
+
+class CaptureWriter(object):
+    """
+    Records are collected in memory and handed over to a writer thread
+    once buffer_size bytes are pending, so the reactor never waits on disk.
+    """
+
+    def __init__(self, path, buffer_size=262144):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.f = open(path, "ab")
+        if self.f.tell() == 0:
+            self.f.write(MAGIC)
+        self.start = monotonic()
+        self.pending = []
+        self.pending_size = 0
+        self.frames = 0
+        self.bytes = 0
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self.run, name="capture writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            self.f.write(chunk)
+        self.f.close()
+
+    def write(self, direction, frame, timestamp=None):
+        if timestamp is None:
+            timestamp = monotonic() - self.start
+        self.pending.append(record_header.pack(direction, timestamp, len(frame)))
+        self.pending.append(frame)
+        self.pending_size += record_header.size + len(frame)
+        self.frames += 1
+        if self.pending_size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            chunk = "".join(self.pending)
+            self.bytes += len(chunk)
+            self.queue.put(chunk)
+            self.pending = []
+            self.pending_size = 0
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+
+class CaptureReader(object):
+    """ iterates frames of a capture file lazily through mmap """
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "rb")
+        size = os.fstat(self.f.fileno()).st_size
+        if size < len(MAGIC):
+            self.f.close()
+            raise ValueError("%s is not a capture file" % path)
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError("%s is not a capture file" % path)
+
+    def __iter__(self):
+        return self.frames()
+
+    def frames(self, direction=None):
+        """ yields Frame(direction, timestamp, data), direction filters if given """
+        mm = self.mm
+        size = len(mm)
+        offset = len(MAGIC)
+        hsize = record_header.size
+        while offset + hsize <= size:
+            d, timestamp, length = record_header.unpack_from(mm, offset)
+            start = offset + hsize
+            offset = start + length
+            if offset > size:
+                break
+            if direction is None or d == direction:
+                yield Frame(d, timestamp, mm[start:offset])
+
+    def packets(self, direction=None):
+        """ yields (direction, timestamp, packet id, payload) decoded by the compiled decoders """
+        for frame in self.frames(direction):
+            header = ord(frame.data[0])
+            try:
+                payload, _ = decoders[header](memoryview(frame.data), 1, len(frame.data))
+            except (KeyError, PacketIncomplete):
+                continue
+            yield frame.direction, frame.timestamp, header, payload
+
+    def close(self):
+        self.mm.close()
+        self.f.close()
@@ -0,0 +1,268 @@
+"""
+On disk cache of chunk columns sent by the server.
+
+Columns are stored in region files of 32x32 columns, one directory per
+server and dimension. A region file is the magic, a header of 1024
+entries (offset, length, crc32 of the column data) and zlib compressed
+records after it, a column sent again with the same data is not written
+again. A changed column goes into its old slot when it fits and is
+appended otherwise, a file with more dead bytes than live ones and
+COMPACT_DEAD_BYTES is compacted in place. Records hold the column as the
+server sends it without the light, so read_column reads them back.
+
+Writes happen in one writer thread per process and take an exclusive
+flock, readers mmap the file under a shared one, so bots of several
+processes can share a cache.
+"""
+
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+from Queue import Queue
+from StringIO import StringIO
+
+from twisted.internet import reactor
+
+import logbot
+from grid import read_column
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+log = logbot.getlogger("CHUNK CACHE")
+
+MAGIC = "TBREG001"
+REGION_SIDE = 32
+header_entry = struct.Struct(">III")
+HEADER_SIZE = len(MAGIC) + header_entry.size * REGION_SIDE * REGION_SIDE
+COMPACT_DEAD_BYTES = 1 << 20
+primary_bit_struct = struct.Struct(">H")
+EMPTY_BIOME = "\x00" * 256
+
+caches = {}
+writer = None
+
+
+def open_cache(bot_config, dimension):
+    """ ChunkCache of the bot server and dimension, None if the cache is off """
+    if bot_config.CHUNK_CACHE_DIR is None:
+        return None
+    server = re.sub(r"[^\w.-]", "_", "%s_%d" % (bot_config.SERVER_HOST, bot_config.SERVER_PORT))
+    directory = os.path.join(bot_config.CHUNK_CACHE_DIR, server, "dim%d" % dimension)
+    if directory not in caches:
+        caches[directory] = ChunkCache(directory)
+    return caches[directory]
+
+
+def get_writer():
+    global writer
+    if writer is None:
+        writer = RegionWriter()
+        reactor.addSystemEventTrigger('during', 'shutdown', writer.close)
+    return writer
+
+
+def lock(f, exclusive):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+
+def unlock(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def entry_offset(x, z):
+    return len(MAGIC) + header_entry.size * ((z & (REGION_SIDE - 1)) * REGION_SIDE + (x & (REGION_SIDE - 1)))
+
+
+def used_entries(header):
+    """ (offset, length, crc, header position) of the columns in a region header """
+    for pos in xrange(len(MAGIC), HEADER_SIZE, header_entry.size):
+        offset, length, crc = header_entry.unpack_from(header, pos)
+        if offset:
+            yield offset, length, crc, pos
+
+
+def compact(f):
+    """ moves the records of the region file f back to back after the header and truncates it """
+    f.seek(0)
+    entries = sorted(used_entries(f.read(HEADER_SIZE)))
+    end = HEADER_SIZE
+    for offset, length, crc, pos in entries:
+        if offset != end:
+            f.seek(offset)
+            record = f.read(length)
+            f.seek(end)
+            f.write(record)
+            f.seek(pos)
+            f.write(header_entry.pack(end, length, crc))
+        end += length
+    f.truncate(end)
+    f.flush()
+
+
+class RegionWriter(object):
+    """ writes column records from a thread, the reactor only queues them """
+
+    def __init__(self):
+        self.queue = Queue()
+        self.written = 0
+        self.skipped = 0
+        self.compacted = 0
+        self.thread = threading.Thread(target=self.run, name="chunk cache writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            try:
+                self.write(*job)
+            except (IOError, OSError) as e:
+                log.msg("cannot write %s, %s" % (job[0], e))
+
+    def write(self, path, x, z, data):
+        crc = zlib.crc32(data) & 0xffffffff
+        if not os.path.exists(path):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+            open(path, "ab").close()
+        with open(path, "r+b") as f:
+            lock(f, True)
+            try:
+                f.seek(0, os.SEEK_END)
+                if f.tell() < HEADER_SIZE:
+                    f.seek(0)
+                    f.write(MAGIC + "\x00" * (HEADER_SIZE - len(MAGIC)))
+                f.seek(0)
+                header = f.read(HEADER_SIZE)
+                old_offset, old_length, old_crc = header_entry.unpack_from(header, entry_offset(x, z))
+                if old_offset and old_crc == crc:
+                    self.skipped += 1
+                    return
+                record = zlib.compress(data, 1)
+                if old_offset and len(record) <= old_length:
+                    offset = old_offset
+                    f.seek(offset)
+                else:
+                    f.seek(0, os.SEEK_END)
+                    offset = f.tell()
+                f.write(record)
+                f.flush()
+                f.seek(entry_offset(x, z))
+                f.write(header_entry.pack(offset, len(record), crc))
+                self.written += 1
+                live = sum(length for _, length, _, _ in used_entries(header)) - old_length + len(record)
+                f.seek(0, os.SEEK_END)
+                dead = f.tell() - HEADER_SIZE - live
+                if dead > COMPACT_DEAD_BYTES and dead > live:
+                    compact(f)
+                    self.compacted += 1
+            finally:
+                unlock(f)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class ChunkCache(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.regions = {}
+        self.hits = 0
+        self.misses = 0
+
+    def region_path(self, x, z):
+        return os.path.join(self.directory, "r.%d.%d.tbr" % (x >> 5, z >> 5))
+
+    def store(self, column):
+        """ queues a continuous column read with read_column """
+        if not column.continuous or column.raw is None:
+            return
+        block_types, metas = column.raw
+        biome = EMPTY_BIOME if column.biome is None else column.biome.tostring()
+        data = "".join([primary_bit_struct.pack(column.primary_bit)] + block_types + metas + [biome])
+        get_writer().queue.put((self.region_path(column.x, column.z), column.x, column.z, data))
+
+    def load(self, x, z):
+        """ ChunkColumn with cached set, None if the column is not in the cache """
+        key = (x >> 5, z >> 5)
+        region = self.regions.get(key, None)
+        if region is None:
+            region = self.regions[key] = RegionReader(self.region_path(x, z))
+        data = region.read(x, z)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        primary_bit, = primary_bit_struct.unpack_from(data)
+        stream = StringIO(data)
+        stream.seek(primary_bit_struct.size)
+        column = read_column(stream, x, z, True, primary_bit, 0, light_data=False)
+        column.raw = None
+        column.cached = True
+        return column
+
+    def close(self):
+        for region in self.regions.itervalues():
+            region.close()
+        self.regions = {}
+
+
+class RegionReader(object):
+    """ mmap of a region file, mapped again when the file grew """
+
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+        self.mm = None
+
+    def read(self, x, z):
+        if self.f is None:
+            if not os.path.exists(self.path):
+                return None
+            self.f = open(self.path, "rb")
+        lock(self.f, False)
+        try:
+            size = os.fstat(self.f.fileno()).st_size
+            if size < HEADER_SIZE:
+                return None
+            if self.mm is None or len(self.mm) != size:
+                if self.mm is not None:
+                    self.mm.close()
+                self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+            if self.mm[:len(MAGIC)] != MAGIC:
+                return None
+            offset, length, crc = header_entry.unpack_from(self.mm, entry_offset(x, z))
+            if offset == 0 or offset + length > size:
+                return None
+            record = self.mm[offset:offset + length]
+        finally:
+            unlock(self.f)
+        try:
+            data = zlib.decompress(record)
+        except zlib.error:
+            return None
+        if zlib.crc32(data) & 0xffffffff != crc:
+            return None
+        return data
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        if self.f is not None:
+            self.f.close()
+        self.mm = self.f = None
@@ -0,0 +1,140 @@
+"""
+Chunk data inflation off the reactor thread.
+
+Map chunk and map chunk bulk packets are handed over as soon as they are
+parsed. Inflating and slicing into sections happens in a small thread pool,
+zlib releases the GIL while it works. The protocol keeps processing packets
+in arrival order and waits on the head job only when it reaches it.
+"""
+
+import time
+import zlib
+from StringIO import StringIO
+
+from twisted.internet import reactor, threads
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+
+import config
+from grid import read_column, read_bulk_columns
+
+
+thread_pool = None
+
+
+def get_thread_pool():
+    global thread_pool
+    if thread_pool is None:
+        thread_pool = ThreadPool(minthreads=1, maxthreads=config.CHUNK_INGEST_WORKERS, name="chunkingest")
+        thread_pool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', thread_pool.stop)
+    return thread_pool
+
+
+def inflate_chunk(c):
+    data_array = zlib.decompress(c.data)
+    column = read_column(StringIO(data_array), c.x, c.z, c.continuous, c.primary_bitmap, c.add_bitmap)
+    return data_array, [column]
+
+
+def inflate_bulk_chunk(c):
+    data_array = zlib.decompress(c.data)
+    return data_array, read_bulk_columns(c.meta, data_array, c.light_data)
+
+
+class ChunkJob(object):
+
+    def __init__(self, ingest, payload):
+        self.ingest = ingest
+        self.payload = payload
+        self.arrived = time.time()
+        self.done = False
+        self.data_array = None
+        self.columns = None
+        self.failure = None
+
+    def finished(self, result):
+        (self.data_array, self.columns), duration = result
+        self.ingest.inflate_time += duration
+        self.done = True
+        self.payload = None
+
+    def failed(self, failure):
+        self.failure = failure
+        self.done = True
+        self.payload = None
+
+    def result(self):
+        """ called on the reactor when the packet is processed, returns (data_array, columns) """
+        self.ingest.applied(self)
+        if self.failure is not None:
+            self.failure.raiseException()
+        return self.data_array, self.columns
+
+
+class ChunkIngest(object):
+    """
+    Queue of chunk packets being inflated. With CHUNK_INGEST_WORKERS = 0
+    everything runs inline when submitted.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = config.CHUNK_INGEST_WORKERS if workers is None else workers
+        self.depth = 0
+        self.max_depth = 0
+        self.submitted = 0
+        self.completed = 0
+        self.inflate_time = 0.0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def submit(self, pid, payload, on_done):
+        """ starts inflating, on_done is called on the reactor once the job is ready """
+        f = inflate_bulk_chunk if pid == 56 else inflate_chunk
+        job = ChunkJob(self, payload)
+        self.depth += 1
+        self.submitted += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        if self.workers > 0:
+            d = threads.deferToThreadPool(reactor, get_thread_pool(), self.timed, f, payload)
+            d.addCallbacks(job.finished, job.failed)
+            d.addBoth(lambda _: on_done())
+        else:
+            try:
+                job.finished(self.timed(f, payload))
+            except Exception:
+                job.failed(Failure())
+        return job
+
+    @staticmethod
+    def timed(f, payload):
+        start = time.time()
+        result = f(payload)
+        return result, time.time() - start
+
+    def applied(self, job):
+        latency = time.time() - job.arrived
+        self.depth -= 1
+        self.completed += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+
+    def clear(self):
+        self.depth = 0
+
+    @property
+    def latency_avg(self):
+        return self.latency_total / self.completed if self.completed else 0.0
+
+    def counters(self):
+        return {"depth": self.depth,
+                "max_depth": self.max_depth,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "inflate_time": self.inflate_time,
+                "latency_avg": self.latency_avg,
+                "latency_max": self.latency_max}
+
+    def __str__(self):
+        return "chunk ingest depth %(depth)d max %(max_depth)d done %(completed)d/%(submitted)d " \
+            "inflate %(inflate_time).3fs latency avg %(latency_avg).3fs max %(latency_max).3fs" % self.counters()
@@ -27,6 +27,15 @@ PROTOCOL_VERSION = 61
 CONNECTION_MAX_DELAY = 5
 CONNECTION_INITIAL_DELAY = 0.1
 KEEP_ALIVE_PERIOD = 300  # that is 6000 ticks
+PACKET_ENGINE = "compiled"  # "compiled" or "construct", construct is the reference
+SKIP_UNHANDLED_PACKETS = True  # only frame packets that no handler or event listener uses
+CHUNK_INGEST_WORKERS = 2  # threads inflating chunk data, 0 inflates on the reactor
+CHUNK_MEMORY_BUDGET = 32 * 1024 * 1024  # bytes of block data per dimension, farthest chunks go above it, 0 no limit
+CHUNK_CACHE_DIR = None  # directory of the on disk chunk cache, None turns it off
+CHUNK_CACHE_RADIUS = 6  # columns around the bot filled from the cache before the server sends them
+CHUNK_CACHE_MAX_COLUMNS = 1024  # most columns filled from the cache for one path
+BATCH_WRITES = True  # write packets once per tick or reactor iteration, encrypted together
+SEND_IMMEDIATELY = ["keep alive"]  # packet names that flush the batch right away
 
 WORLD_HEIGHT = 256
 CHUNK_SIDE_LEN = 16
@@ -59,4 +68,5 @@ COST_FALL = 1.1
 COST_DIRECT = 1
 COST_DIAGONAL = math.sqrt(2) * COST_DIRECT
 PATHFIND_LIMIT = 400  # roughly in blocks
+WALKABILITY_CACHE_SECTIONS = 256  # node flags and moves of so many sections kept per grid
 HORIZONTAL_MOVE_DISTANCE_LIMIT = 2.83
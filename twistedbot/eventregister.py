@@ -12,7 +12,8 @@ log = logbot.getlogger("EVENTREGISTER")
 
 class EventHook(object):
 
-    def __init__(self):
+    def __init__(self, register=None):
+        self.register = register
         self.handlers = []
 
     def fire(self, *args, **kwargs):
@@ -21,9 +22,15 @@ class EventHook(object):
 
     def subscribe(self, f):
         self.handlers.append(f)
+        self.changed()
 
     def unsubscribe(self, f):
         self.handlers.remove(f)
+        self.changed()
+
+    def changed(self):
+        if self.register is not None:
+            self.register.revision += 1
 
     @property
     def no_handlers(self):
@@ -64,6 +71,7 @@ class EventRegister(object):
                    "on_multi_block_change",
                    "on_block_change",
                    "on_load_bulk_chunk",
+                   "on_load_columns",
                    "on_explosion",
                    "on_open_window",
                    "on_close_window",
@@ -80,10 +88,11 @@ class EventRegister(object):
     def __init__(self, world):
         self.world = world
         self.chat_commands = {}
+        self.revision = 0
 
     def setup(self):
         for name in self.event_names:
-            setattr(self, name, EventHook())
+            setattr(self, name, EventHook(self))
         for plugin_cls in plugins.core.plugs:
             self.register_plugin(plugin_cls)
         for plugin_cls in plugins.custom.plugs:
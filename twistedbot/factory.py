@@ -12,7 +12,9 @@ import hashlib
 import logbot
 import proxy_processors.default
 import utils
-from packets import parse_packets, make_packet, packets_by_name, Container
+from chunkingest import ChunkIngest
+from packets import PacketBuffer, make_packet, packet_encoder, packets, packets_by_name, Container
+from packet_compiler import field_names
 from proxy_processors.default import process_packets as packet_printout
 
 encryption = None
@@ -33,13 +35,23 @@ log = logbot.getlogger("PROTOCOL")
 
 
 class MineCraftProtocol(Protocol):
+    chunk_packets = (51, 56)
+
     def __init__(self, world):
         self.world = world
         self.world.protocol = self
         self.event = world.eventregister
-        self.leftover = ""
+        self.buffer = PacketBuffer()
+        self.skip_revision = None
         self.encryption_on = False
         self.packets = deque()
+        self.chunk_ingest = ChunkIngest()
+        self.chunk_jobs = deque()
+        self.out_queue = []
+        self.flush_pending = False
+        self.flushes = 0
+        self.flushed_packets = 0
+        self.flushed_bytes = 0
 
         self.router = {
             0: self.p_ping,
@@ -108,41 +120,129 @@ class MineCraftProtocol(Protocol):
             255: self.p_error,
         }
 
+    def skippable_packets(self):
+        """
+        Packet ids whose handler does nothing or only fires events without handlers.
+        A handler qualifies if the only names it uses are self.event.<hook>.fire
+        and the fields of its packet, anything else keeps the packet decoded.
+        """
+        skip = set()
+        for pid, f in self.router.iteritems():
+            code = getattr(getattr(f, "im_func", None), "func_code", None)
+            if code is None or pid not in packets:
+                continue
+            allowed = field_names(packets[pid])
+            allowed.update(("event", "fire"))
+            ok = True
+            for name in code.co_names:
+                if name.startswith("on_"):
+                    hook = getattr(self.event, name, None)
+                    if hook is None or not hook.no_handlers:
+                        ok = False
+                elif name not in allowed:
+                    ok = False
+            if ok:
+                skip.add(pid)
+        return skip
+
+    def update_skip_packets(self):
+        self.skip_revision = self.event.revision
+        if config.SKIP_UNHANDLED_PACKETS and not config.DEBUG:
+            self.buffer.skip_packets(self.skippable_packets())
+        else:
+            self.buffer.skip_packets(())
+
     def connectionMade(self):
-        self.event.on_connection_made.fire()
+        self.world.in_context(self.event.on_connection_made.fire)
 
     def connectionLost(self, reason):
+        self.world.in_context(self.connection_lost)
+
+    def connection_lost(self):
+        log.msg("sent %d flushes, %.1f packets %.1f bytes per flush" % self.flush_stats())
+        self.out_queue = []
         self.packets = deque()
+        self.chunk_jobs = deque()
+        self.chunk_ingest.clear()
         self.event.on_connection_lost.fire()
 
-    def sendData(self, bytestream):
+    def sendData(self, bytestream, immediately=False):
+        """
+        Packets are queued and written together by flush, at the end of
+        World.tick or of the current reactor iteration, whichever is first.
+        """
+        self.out_queue.append(bytestream)
+        if immediately or not config.BATCH_WRITES:
+            self.flush()
+        elif not self.flush_pending:
+            self.flush_pending = True
+            reactor.callLater(0, self.flush)
+
+    def flush(self):
+        self.flush_pending = False
+        if not self.out_queue or self.transport is None:
+            return
+        bytestream = "".join(self.out_queue)
+        self.flushes += 1
+        self.flushed_packets += len(self.out_queue)
+        self.flushed_bytes += len(bytestream)
+        self.out_queue = []
         if self.encryption_on:
             bytestream = self.cipher.encrypt(bytestream)
         self.transport.write(bytestream)
 
+    def flush_stats(self):
+        """ returns (flushes, packets per flush, bytes per flush) """
+        if self.flushes == 0:
+            return 0, 0.0, 0.0
+        return self.flushes, float(self.flushed_packets) / self.flushes, float(self.flushed_bytes) / self.flushes
+
     def dataReceived(self, bytestream):
         try:
-            self.parse_stream(bytestream)
+            self.world.in_context(self.parse_stream, bytestream)
         except:
             logbot.exit_on_error()
 
     def parse_stream(self, bytestream):
         if self.encryption_on:
             bytestream = self.decipher.decrypt(bytestream)
-        parsed_packets, self.leftover = parse_packets(self.leftover + bytestream)
+        if self.skip_revision != self.event.revision:
+            self.update_skip_packets()
+        self.buffer.feed(bytestream)
+        parsed_packets = self.buffer.read_packets()
+        self.world.packets_received += len(parsed_packets)
         if config.DEBUG:
-            packet_printout("SERVER", parsed_packets, self.encryption_on, self.leftover)
+            packet_printout("SERVER", parsed_packets, self.encryption_on, self.buffer.leftover)
+        for packet in parsed_packets:
+            if packet[0] in self.chunk_packets:
+                self.chunk_jobs.append(self.chunk_ingest.submit(packet[0], packet[1], self.chunk_job_done))
         self.packets.extend(parsed_packets)
         self.packet_iter(self.packets)
 
+    def chunk_job_done(self):
+        try:
+            self.world.in_context(self.packet_iter, self.packets)
+        except:
+            logbot.exit_on_error()
+
     def send_packet(self, name, payload):
         p = make_packet(name, payload)
         if config.DEBUG:
             packet_printout("CLIENT", [(packets_by_name[name], Container(**payload))])
-        self.sendData(p)
+        self.sendData(p, immediately=name in config.SEND_IMMEDIATELY)
+
+    def send_values(self, name, values):
+        """ like send_packet, values are positional as packet_encoder takes them """
+        encoder = packet_encoder(name)
+        p = encoder(*values)
+        if config.DEBUG:
+            packet_printout("CLIENT", [(packets_by_name[name], Container(**dict(zip(encoder.args, values))))])
+        self.sendData(p, immediately=name in config.SEND_IMMEDIATELY)
 
     def packet_iter(self, ipackets):
         while ipackets:
+            if ipackets[0][0] in self.chunk_packets and not self.chunk_jobs[0].done:
+                break
             packet = ipackets.popleft()
             self.process_packet(packet)
 
@@ -279,8 +379,10 @@ class MineCraftProtocol(Protocol):
         self.event.on_update_experience.fire(experience_bar=c.current, level=c.level, total_experience=c.total)
 
     def p_chunk(self, c):
+        data_array, columns = self.chunk_jobs.popleft().result()
+        self.event.on_load_columns.fire(columns=columns)
         self.event.on_load_chunk.fire(x=c.x, z=c.z, continuous=c.continuous, primary_bit=c.primary_bitmap,
-                                      add_bit=c.add_bitmap, data_array=c.data.decode('zlib'))
+                                      add_bit=c.add_bitmap, data_array=data_array)
 
     def p_multi_block_change(self, c):
         self.event.on_multi_block_change.fire(x=c.x, z=c.z, blocks=c.blocks)
@@ -299,7 +401,9 @@ class MineCraftProtocol(Protocol):
         pass
 
     def p_bulk_chunk(self, c):
-        self.event.on_load_bulk_chunk.fire(metas=c.meta, data_array=c.data.decode('zlib'), light_data=c.light_data)
+        data_array, columns = self.chunk_jobs.popleft().result()
+        self.event.on_load_columns.fire(columns=columns)
+        self.event.on_load_bulk_chunk.fire(metas=c.meta, data_array=data_array, light_data=c.light_data)
 
     def p_explosion(self, c):
         self.event.on_explosion.fire(x=c.x, y=c.y, z=c.z, radius=c.radius, records=c.records, player_motion_x=c.player_motion_x,  player_motion_y=c.player_motion_y, player_motion_z=c.player_motion_z) 
@@ -385,6 +489,7 @@ class MineCraftProtocol(Protocol):
 
     def p_encryption_key_response(self, c):
         self.event.on_encryption_key_response.fire()
+        self.flush()
         self.encryption_on = True
         self.send_packet("client statuses", {"status": 0})
 
@@ -401,20 +506,20 @@ class MineCraftProtocol(Protocol):
         else:
             d = "%x" % d
         hashstr = d
-        url = "http://session.minecraft.net/game/joinserver.jsp?user=%s&serverId=%s&sessionId=%s" % (config.USERNAME, hashstr, self.factory.session_id)
+        url = "http://session.minecraft.net/game/joinserver.jsp?user=%s&serverId=%s&sessionId=%s" % (self.world.config.USERNAME, hashstr, self.factory.session_id)
         response = yield getPage(url).addErrback(logbot.exit_on_error)
         log.msg("responce from http://session.minecraft.net: %s" % response)
 
     @inlineCallbacks
     def p_encryption_key_request(self, c):
         self.event.on_encryption_key_request.fire(server_id=c.server_id, public_key=c.public_key, verify_token=c.verify_token)
-        if config.USE_ENCRYPTION:
+        if self.world.config.USE_ENCRYPTION:
             self.cipher = encryption.make_aes(self.factory.client_key, self.factory.client_key)
             self.decipher = encryption.make_aes(self.factory.client_key, self.factory.client_key)
             public_key = encryption.load_pubkey(c.public_key)
             enc_shared_sercet = encryption.encrypt(self.factory.client_key, public_key)
             enc_4bytes = encryption.encrypt(c.verify_token, public_key)
-            if config.ONLINE_LOGIN:
+            if self.world.config.ONLINE_LOGIN:
                 yield self.do_auth(c.server_id, c.public_key)
             self.send_packet("encryption key response",
                              {"shared_length": len(enc_shared_sercet),
@@ -440,13 +545,13 @@ class MineCraftFactory(ReconnectingClientFactory):
         self.clean_to_connect = True
 
     def startFactory(self):
-        if config.USE_ENCRYPTION:
+        if self.world.config.USE_ENCRYPTION:
             self.client_key = encryption.get_random_bytes()
 
     @inlineCallbacks
     def online_auth(self):
         log.msg('doing online login')
-        url = "http://login.minecraft.net/?user=%s&password=%s&version=1337" % (config.EMAIL, config.PASSWORD)
+        url = "http://login.minecraft.net/?user=%s&password=%s&version=1337" % (self.world.config.EMAIL, self.world.config.PASSWORD)
         response = yield getPage(url).addErrback(logbot.exit_on_error)
         log.msg("responce from http://login.minecraft.net: %s" % response)
         if ":" not in response:  # TODO well this is blunt approach, should use code with http code check
@@ -454,24 +559,27 @@ class MineCraftFactory(ReconnectingClientFactory):
             log.msg("did not authenticate with mojang, quiting")
             reactor.stop()
         else:
-            _, _, config.USERNAME, self.session_id, _ = response.split(':')
-            log.msg("my username according to Minecraft is %s" % config.USERNAME)
+            _, _, self.world.config.USERNAME, self.session_id, _ = response.split(':')
+            log.msg("my username according to Minecraft is %s" % self.world.config.USERNAME)
             utils.do_later(10, self.keep_alive)
 
     @inlineCallbacks
     def keep_alive(self):
         log.msg('keep alive to https://login.minecraft.net')
-        url = "https://login.minecraft.net/session?name=%s&session=%s" % (config.USERNAME, self.session_id)
+        url = "https://login.minecraft.net/session?name=%s&session=%s" % (self.world.config.USERNAME, self.session_id)
         yield getPage(url)
         utils.do_later(config.KEEP_ALIVE_PERIOD, self.keep_alive)
 
+    def msg(self, *args):
+        self.world.in_context(log.msg, *args)
+
     def startedConnecting(self, connector):
-        log.msg('started connecting to %s:%d' % (connector.host, connector.port))
+        self.msg('started connecting to %s:%d' % (connector.host, connector.port))
 
     def buildProtocol(self, addr):
-        log.msg('connected to %s:%d' % (addr.host, addr.port))
+        self.msg('connected to %s:%d' % (addr.host, addr.port))
         if self.delay > self.initialDelay:
-            log.msg('Resetting reconnection delay')
+            self.msg('Resetting reconnection delay')
             self.resetDelay()
         protocol = MineCraftProtocol(self.world)
         protocol.factory = self
@@ -479,10 +587,10 @@ class MineCraftFactory(ReconnectingClientFactory):
 
     def clientConnectionLost(self, connector, unused_reason):
         if self.log_connection_lost:
-            log.msg('Connection lost, reason:', unused_reason.getErrorMessage())
+            self.msg('Connection lost, reason:', unused_reason.getErrorMessage())
         ReconnectingClientFactory.clientConnectionLost(self, connector, unused_reason)
 
     def clientConnectionFailed(self, connector, reason):
         if self.log_connection_lost:
-            log.msg('Connection failed, reason:', reason.getErrorMessage())
+            self.msg('Connection failed, reason:', reason.getErrorMessage())
         ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
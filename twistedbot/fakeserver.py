@@ -0,0 +1,284 @@
+"""
+Stand-in Minecraft server for end to end load tests.
+
+Speaks the same packets definitions as the bot, without encryption. It
+logs bots in, streams the terrain from traffic around the spawn as map
+chunk bulk, echoes player positions to the other bots, spawns and
+destroys mobs at entity_churn per second, changes blocks at
+block_changes per second and confirms window clicks. Tick lag of every
+bot is measured from the intervals between its position packets.
+"""
+
+import random
+import time
+from collections import deque
+
+from twisted.internet.protocol import Protocol, ServerFactory
+from twisted.internet.task import LoopingCall
+
+import config
+import logbot
+import packet_samples
+import traffic
+from packets import PacketBuffer, make_packet, packets, Container, Metadata
+from ticklag import TickLag
+
+
+log = logbot.getlogger("FAKE SERVER")
+
+position_packets = (10, 11, 12, 13)
+LEFT_REPORTED = 32  # bots that left still in the lag reports
+
+
+class FakeServerProtocol(Protocol):
+
+    def __init__(self, factory, eid):
+        self.factory = factory
+        self.eid = eid
+        self.username = None
+        self.logged_in = False
+        self.buffer = PacketBuffer()
+        self.ticklag = TickLag()
+        self.position = traffic.SPAWN
+        self.received = 0
+        self.router = {
+            0: self.p_keep_alive,
+            2: self.p_handshake,
+            3: self.p_chat,
+            10: self.p_position,
+            11: self.p_position,
+            12: self.p_position,
+            13: self.p_position,
+            14: self.p_digging,
+            102: self.p_click_window,
+            205: self.p_client_statuses,
+            252: self.p_encryption_key_response,
+            254: self.p_server_list_ping,
+            255: self.p_disconnect,
+        }
+
+    def connectionMade(self):
+        self.factory.connections.append(self)
+
+    def connectionLost(self, reason):
+        if self in self.factory.connections:
+            self.factory.connections.remove(self)
+        if self.logged_in:
+            self.factory.bot_left(self)
+
+    def dataReceived(self, bytestream):
+        self.buffer.feed(bytestream)
+        now = time.time()
+        for pid, payload in self.buffer.read_packets():
+            self.received += 1
+            if pid in position_packets:
+                self.ticklag.tick(now)
+            f = self.router.get(pid, None)
+            if f is not None:
+                f(payload)
+
+    def send(self, name, payload):
+        self.transport.write(make_packet(name, payload))
+
+    def send_many(self, stream):
+        """ stream of (packet id, payload) """
+        self.transport.write("".join(make_packet(packets[pid].name, payload) for pid, payload in stream))
+
+    def kick(self, message):
+        self.send("disconnect/kick", {"message": message})
+        self.transport.loseConnection()
+
+    def p_handshake(self, c):
+        if c.protocol != config.PROTOCOL_VERSION:
+            self.kick(u"protocol %d, fake server speaks %d" % (c.protocol, config.PROTOCOL_VERSION))
+            return
+        self.username = c.username
+        self.send("encryption key request", {"server_id": u"-",
+                                             "public_key_length": 0,
+                                             "public_key": "",
+                                             "token_length": 4,
+                                             "verify_token": "\x00\x00\x00\x00"})
+
+    def p_encryption_key_response(self, c):
+        self.kick(u"fake server does not do encryption")
+
+    def p_client_statuses(self, c):
+        if c.status == 0 and not self.logged_in:
+            self.logged_in = True
+            self.factory.bot_joined(self)
+        elif c.status == 1:
+            self.send("respawn", {"dimension": 0, "difficulty": 1, "game_mode": 0,
+                                  "world_height": config.WORLD_HEIGHT, "level_type": u"default"})
+            self.send_many(traffic.location())
+
+    def p_keep_alive(self, c):
+        pass
+
+    def p_chat(self, c):
+        self.factory.broadcast("chat message", {"message": u"<%s> %s" % (self.username, c.message)})
+
+    def p_position(self, c):
+        if "position" in c:
+            self.position = (c.position.x, c.position.y, c.position.z)
+        if self.factory.echo_positions:
+            x, y, z = self.position
+            self.factory.broadcast("entity teleport",
+                                   {"eid": self.eid, "x": int(x * 32), "y": int(y * 32), "z": int(z * 32),
+                                    "yaw": 0, "pitch": 0}, exclude=self)
+
+    def p_digging(self, c):
+        if c.state == 2:
+            self.factory.broadcast("block change", {"x": c.x, "y": c.y, "z": c.z, "type": 0, "meta": 0})
+
+    def p_click_window(self, c):
+        self.send("confirm transaction", {"window_id": c.window_id, "action_number": c.action_number,
+                                          "confirmed": True})
+
+    def p_server_list_ping(self, c):
+        self.kick(u"\xa71\x00%d\x00fake\x00twistedbot fake server\x00%d\x00%d" %
+                  (config.PROTOCOL_VERSION, len(self.factory.bots), self.factory.max_players))
+
+    def p_disconnect(self, c):
+        self.transport.loseConnection()
+
+
+class FakeServerFactory(ServerFactory):
+    """
+    entity_churn is mobs spawned and destroyed per second, block_changes
+    blocks changed per second, radius in columns around the spawn.
+    """
+
+    def __init__(self, radius=3, mobs=20, entity_churn=0.0, block_changes=0.0,
+                 echo_positions=True, max_players=100, seed=0):
+        self.radius = radius
+        self.mobs = mobs
+        self.entity_churn = entity_churn
+        self.block_changes = block_changes
+        self.echo_positions = echo_positions
+        self.max_players = max_players
+        self.rnd = random.Random(seed)
+        self.connections = []
+        self.bots = []
+        self.left = deque(maxlen=LEFT_REPORTED)  # (username, TickLag) of the last bots that left
+        self.next_eid = 1
+        self.alive = {}
+        self.churn_due = 0.0
+        self.changes_due = 0.0
+        self.ticks = 0
+        self.terrain = None
+        self.loop = LoopingCall(self.tick)
+
+    def buildProtocol(self, addr):
+        return FakeServerProtocol(self, self.new_eid())
+
+    def startFactory(self):
+        self.alive = dict(self.spawn_mobs(self.mobs))
+        self.loop.start(config.TIME_STEP, now=False)
+
+    def stopFactory(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def new_eid(self):
+        self.next_eid += 1
+        return self.next_eid
+
+    def spawn_mobs(self, count):
+        """ list of (eid, spawn mob payload) """
+        out = traffic.spawn_mobs(self.rnd, self.next_eid + 1, count)
+        self.next_eid += count
+        return [(p.eid, p) for _, p in out]
+
+    def terrain_packets(self):
+        """ encoded once and sent to every bot """
+        if self.terrain is None:
+            columns = traffic.area(traffic.SPAWN[0] >> 4, traffic.SPAWN[2] >> 4, self.radius)
+            self.terrain = "".join(make_packet("map chunk bulk", traffic.bulk_packet(columns[i:i + 10])[1])
+                                   for i in xrange(0, len(columns), 10))
+            log.msg("terrain %d columns %d bytes" % (len(columns), len(self.terrain)))
+        return self.terrain
+
+    def bot_joined(self, bot):
+        log.msg("%s logged in as eid %d" % (bot.username, bot.eid))
+        bot.send_many(traffic.login(bot.eid))
+        slots = [packet_samples.slot() for _ in xrange(45)]
+        bot.send_many([(104, Container(window_id=0, length=len(slots), slotdata=slots)),
+                       (8, Container(hp=20, fp=20, saturation=5.0))])
+        bot.transport.write(self.terrain_packets())
+        bot.send_many(traffic.location())
+        for other in self.bots:
+            other.send("spawn named entity", self.named_entity(bot))
+            bot.send("spawn named entity", self.named_entity(other))
+        self.bots.append(bot)
+        self.broadcast("player list item", {"name": bot.username, "online": True, "ping": 0})
+        bot.send_many((24, p) for p in self.alive.itervalues())
+
+    def bot_left(self, bot):
+        log.msg("%s left, %s" % (bot.username, bot.ticklag))
+        self.bots.remove(bot)
+        self.left.append((bot.username, bot.ticklag))
+        self.broadcast("player list item", {"name": bot.username, "online": False, "ping": 0})
+        self.broadcast("destroy entity", {"count": 1, "eids": [bot.eid]})
+
+    def named_entity(self, bot):
+        x, y, z = bot.position
+        return {"eid": bot.eid, "username": bot.username, "x": int(x * 32), "y": int(y * 32), "z": int(z * 32),
+                "yaw": 0, "pitch": 0, "item": 0, "metadata": {0: Metadata("byte", 0)}}
+
+    def broadcast(self, name, payload, exclude=None):
+        if not self.bots:
+            return
+        data = make_packet(name, payload)
+        for bot in self.bots:
+            if bot is not exclude:
+                bot.transport.write(data)
+
+    def tick(self):
+        self.ticks += 1
+        self.churn_due += self.entity_churn * config.TIME_STEP
+        while self.churn_due >= 1:
+            self.churn_due -= 1
+            self.churn()
+        self.changes_due += self.block_changes * config.TIME_STEP
+        changes = int(self.changes_due)
+        if changes:
+            self.changes_due -= changes
+            self.change_blocks(changes)
+        if self.ticks % 20 == 0:
+            self.broadcast("time update", {"timestamp": self.ticks, "daytime": 1000 + self.ticks})
+        if self.ticks % 400 == 0:
+            self.broadcast("keep alive", {"pid": self.ticks})
+
+    def churn(self):
+        if self.alive:
+            eid = self.rnd.choice(sorted(self.alive))
+            del self.alive[eid]
+            self.broadcast("destroy entity", {"count": 1, "eids": [eid]})
+        (eid, p), = self.spawn_mobs(1)
+        self.alive[eid] = p
+        self.broadcast("spawn mob", p)
+
+    def change_blocks(self, count):
+        """ blocks right under the surface, stone and dirt swapped around """
+        cx, cz = traffic.SPAWN[0] >> 4, traffic.SPAWN[2] >> 4
+        x = (cx + self.rnd.randint(-self.radius, self.radius)) * 16
+        z = (cz + self.rnd.randint(-self.radius, self.radius)) * 16
+        while count > 0:
+            n = min(count, 64)
+            count -= n
+            blocks = [Container(x=self.rnd.randint(0, 15), z=self.rnd.randint(0, 15), y=self.rnd.randint(50, 62),
+                                block_id=self.rnd.choice((1, 3)), meta=0) for _ in xrange(n)]
+            self.broadcast("multi block change", {"x": x >> 4, "z": z >> 4, "count": n, "datasize": 4 * n,
+                                                  "blocks": blocks})
+
+    def lag_report(self):
+        """ list of (username, TickLag), connected bots first, then the last LEFT_REPORTED that left """
+        connected = [(bot.username, bot.ticklag) for bot in self.bots]
+        return [(username, lag) for username, lag in connected + list(self.left) if lag.count]
+
+    def log_lag(self):
+        total = TickLag(window=None)
+        for name, lag in self.lag_report():
+            log.msg("%-16s %s" % (name, lag))
+            total.merge(lag)
+        log.msg("%d bots, %s" % (len(self.bots), total))
@@ -1,15 +1,19 @@
 
 import StringIO
 import array
-import math
-import sys
+import collections
+import heapq
+import itertools
 
 import utils
 import blocks
 import config
 import logbot
 import fops
+import raycast
 from axisbox import AABB
+from sections import Section
+from blocks import block_flags, block_shape, collision_shapes
 
 
 log = logbot.getlogger("GRID")
@@ -25,29 +29,97 @@ class Chunk(object):
         self.z = coords[1]
         self.grid_x = self.x << 4
         self.grid_z = self.z << 4
-        self.block_types = [None for _ in xrange(self.levels)]
-        self.meta = [None for _ in xrange(self.levels)]
+        self.sections = [None for _ in xrange(self.levels)]
         self.block_light = []  # ignore block light
         self.sky_light = []  # ifnore sky light
         self.biome = self.biomes[:]
         self.complete = False
+        self.cached = False
+        self.heightmap = array.array('H', [0]) * 256  # z << 4 | x, y above the highest non air block
 
-    def set_meta(self, level, pos, meta):
-        val = self.meta[level][pos / 2]
-        if pos % 2 == 0:
-            val = (val & 240) | meta
-        else:
-            val = (val & 15) | (meta << 4)
-        self.meta[level][pos / 2] = val
-
-    def get_meta(self, level, pos):
-        if pos % 2 == 0:
-            return self.meta[level][pos / 2] & 15
-        else:
-            return self.meta[level][pos / 2] >> 4
+    @property
+    def nbytes(self):
+        """ bytes held by the section arrays """
+        return sum(section.nbytes for section in self.sections if section is not None)
 
     def __repr__(self):
-        return "%s %s %s" % (str(self.coords), self.complete, [i if i is None else 1 for i in self.block_types])
+        return "%s %s %s" % (str(self.coords), self.complete, [i if i is None else 1 for i in self.sections])
+
+
+class ChunkColumn(object):
+    """ sections of one chunk column read from packet data, not yet in the grid """
+
+    def __init__(self, x, z, continuous, primary_bit, add_bit):
+        self.x = x
+        self.z = z
+        self.continuous = continuous
+        self.primary_bit = primary_bit
+        self.add_bit = add_bit
+        self.sections = {}
+        self.biome = None
+        self.raw = None
+        self.cached = False
+        self.heightmap = None
+
+
+def read_column(data, x, z, continuous, primary_bit, add_bit, light_data=True):
+    """
+    Slices one column from the file like data. Does not touch any grid,
+    so it can run outside of the reactor thread.
+    """
+    column = ChunkColumn(x, z, continuous, primary_bit, add_bit)
+    levels = [i for i in xrange(Chunk.levels) if primary_bit & (1 << i)]
+    block_types = [data.read(4096) for _ in levels]  # y, z, x
+    metas = [data.read(2048) for _ in levels]
+    for i, ids, meta in zip(levels, block_types, metas):
+        column.sections[i] = Section.from_data(ids, meta)
+    column.raw = (block_types, metas)
+    if continuous:
+        column.heightmap = column_heightmap([column.sections.get(i, None) for i in xrange(Chunk.levels)])
+    if light_data:
+        for i in xrange(Chunk.levels):
+            if primary_bit & (1 << i):
+                data_str = data.read(2048)
+        for i in xrange(Chunk.levels):
+            if primary_bit & (1 << i):
+                data_str = data.read(2048)
+    # higher block id value will be used after Mojang adds them
+    if add_bit > 0:
+        for i in xrange(Chunk.levels):
+            if add_bit >> i & 1:
+                data_str = data.read(2048)
+    if continuous:
+        data_str = data.read(256)
+        column.biome = array.array('b', data_str)
+    return column
+
+
+def column_heightmap(sections):
+    """ Chunk.heightmap of the sections, layers without any block are skipped """
+    heights = array.array('H', [0]) * 256
+    todo = set(xrange(256))
+    for level in xrange(len(sections) - 1, -1, -1):
+        section = sections[level]
+        if section is None or section.all_air:
+            continue
+        ids = section.ids_array()
+        for y in xrange(15, -1, -1):
+            layer = ids[y << 8:(y + 1) << 8]
+            if layer.count("\x00") == 256:
+                continue
+            found = [i for i in todo if layer[i]]
+            for i in found:
+                heights[i] = (level << 4) + y + 1
+            todo.difference_update(found)
+            if not todo:
+                return heights
+    return heights
+
+
+def read_bulk_columns(metas, data_array, light_data):
+    data = StringIO.StringIO(data_array)
+    return [read_column(data, meta.x, meta.z, True, meta.primary_bitmap, meta.add_bitmap, light_data)
+            for meta in metas]
 
 
 class Grid(object):
@@ -56,6 +128,126 @@ class Grid(object):
         self.chunks = {}
         self.chunks_loaded = 0
         self.spawn_position = None
+        self.pins = {}
+        self.focus = (0, 0)
+        self.cache = None
+        self.resident_bytes = 0
+        self.evicted_chunks = 0
+        self.evictions = 0
+        self.version = 0
+        self.listeners = []
+        self.walkability = None  # gridspace.Walkability, made by the first GridSpace
+
+    def subscribe(self, listener):
+        """
+        listener(section coords, section, positions) is called after blocks
+        change. Coords are (chunk x, level, chunk z), section is None when
+        it is gone, positions are the changed y << 8 | z << 4 | x or None
+        when the whole section was loaded, replaced or dropped.
+        """
+        self.listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        self.listeners.remove(listener)
+
+    def section_changed(self, chunk_x, level, chunk_z, section, positions=None):
+        """ stamps the section with a new version and tells the listeners """
+        self.version += 1
+        if section is not None:
+            section.version = self.version
+        for listener in self.listeners:
+            listener((chunk_x, level, chunk_z), section, positions)
+
+    def chunk_dropped(self, chunk):
+        for level, section in enumerate(chunk.sections):
+            if section is not None:
+                self.section_changed(chunk.x, level, chunk.z, None)
+
+    def section_version(self, x, y, z):
+        """ version of the section holding x, y, z, 0 for air and unknown """
+        section = self.section_at(x, y, z)
+        return 0 if section is None else section.version
+
+    def memory(self):
+        """ (loaded chunks, bytes of block data) """
+        return len(self.chunks), sum(chunk.nbytes for chunk in self.chunks.itervalues())
+
+    def counters(self):
+        return {"chunks": len(self.chunks),
+                "chunk_bytes": self.resident_bytes,
+                "evicted_chunks": self.evicted_chunks,
+                "evictions": self.evictions}
+
+    @property
+    def bot_config(self):
+        """ config of the bot owning the grid, the config module for a grid without one """
+        if self.dimension is None:
+            return config
+        return self.dimension.world.config
+
+    @property
+    def memory_budget(self):
+        return self.bot_config.CHUNK_MEMORY_BUDGET
+
+    def pin(self, owner, coords):
+        """
+        keeps the columns of coords loaded until owner pins something else
+        or unpins, owner is (kind, id of the pinning object)
+        """
+        self.pins[owner] = set((utils.grid_shift(c.x) >> 4, utils.grid_shift(c.z) >> 4) for c in coords)
+
+    def unpin(self, owner):
+        self.pins.pop(owner, None)
+
+    def unpin_all(self, kind):
+        for owner in [owner for owner in self.pins if owner[0] == kind]:
+            del self.pins[owner]
+
+    def pinned_columns(self):
+        """ columns of the pins and of the sign waypoints """
+        pinned = set()
+        for columns in self.pins.itervalues():
+            pinned.update(columns)
+        if self.dimension is not None:
+            for crd in self.dimension.sign_waypoints.crd_to_sign:
+                pinned.add((crd.x >> 4, crd.z >> 4))
+        return pinned
+
+    def focus_column(self):
+        """ column of the bot while it is in this dimension, otherwise where it was last seen """
+        if self.dimension is not None:
+            world = self.dimension.world
+            if world.dimension is self.dimension:
+                b_obj = world.bot.bot_object
+                self.focus = (utils.grid_shift(b_obj.x) >> 4, utils.grid_shift(b_obj.z) >> 4)
+        return self.focus
+
+    def check_budget(self):
+        budget = self.memory_budget
+        if budget and self.resident_bytes > budget:
+            self.evict(budget * 9 / 10)
+
+    def evict(self, budget):
+        """ drops the farthest unpinned chunks until the block data fits into budget bytes """
+        _, self.resident_bytes = self.memory()
+        if self.resident_bytes <= budget:
+            return 0
+        pinned = self.pinned_columns()
+        focus_x, focus_z = self.focus_column()
+        candidates = sorted((chunk for crd, chunk in self.chunks.iteritems() if crd not in pinned),
+                            key=lambda c: (c.x - focus_x) ** 2 + (c.z - focus_z) ** 2, reverse=True)
+        dropped = 0
+        for chunk in candidates:
+            if self.resident_bytes <= budget:
+                break
+            self.resident_bytes -= chunk.nbytes
+            del self.chunks[chunk.coords]
+            self.chunk_dropped(chunk)
+            dropped += 1
+        self.evicted_chunks += dropped
+        self.evictions += 1
+        log.msg("evicted %d chunks, %d left with %dKB" % (dropped, len(self.chunks), self.resident_bytes / 1024))
+        return dropped
 
     def in_spawn_area(self, coords):
         return abs(coords[0] - self.spawn_position[0]) <= 16 or abs(coords[2] - self.spawn_position[2]) <= 16
@@ -77,15 +269,114 @@ class Grid(object):
         chunk = self.get_chunk((chunk_x, chunk_z))
         if chunk is None:
             return self.make_block(x, y, z, 0, 0)
-        y_level = y >> 4
-        block_types = chunk.block_types[y_level]
-        if block_types is None:
+        section = chunk.sections[y >> 4]
+        if section is None:
             return self.make_block(x, y, z, 0, 0)
         cx = x & 15
         cy = y & 15
         cz = z & 15
         pos = self.chunk_array_position(cx, cy, cz)
-        return self.make_block(x, y, z, block_types[pos], chunk.get_meta(y_level, pos))
+        return self.make_block(x, y, z, section.block_id(pos), section.meta_at(pos))
+
+    def block_id_at(self, x, y, z):
+        """ block id at x, y, z without building the block, 0 for unknown """
+        if y > 255 or y < 0:
+            return 0
+        chunk = self.chunks.get((x >> 4, z >> 4), None)
+        if chunk is None:
+            return 0
+        section = chunk.sections[y >> 4]
+        if section is None:
+            return 0
+        return section.block_id((y & 15) << 8 | (z & 15) << 4 | (x & 15))
+
+    def meta_at(self, x, y, z):
+        """ meta nibble at x, y, z without building the block, 0 for unknown """
+        if y > 255 or y < 0:
+            return 0
+        chunk = self.chunks.get((x >> 4, z >> 4), None)
+        if chunk is None:
+            return 0
+        section = chunk.sections[y >> 4]
+        if section is None:
+            return 0
+        return section.meta_at((y & 15) << 8 | (z & 15) << 4 | (x & 15))
+
+    def block_key_at(self, x, y, z):
+        """ block id << 4 | meta at x, y, z, the index of the blocks tables, 0 for unknown """
+        if y > 255 or y < 0:
+            return 0
+        chunk = self.chunks.get((x >> 4, z >> 4), None)
+        if chunk is None:
+            return 0
+        section = chunk.sections[y >> 4]
+        if section is None:
+            return 0
+        return section.key((y & 15) << 8 | (z & 15) << 4 | (x & 15))
+
+    def flags_at(self, x, y, z):
+        """ blocks.block_flags of the block at x, y, z, flags of air for unknown """
+        if y > 255 or y < 0:
+            return block_flags[0]
+        chunk = self.chunks.get((x >> 4, z >> 4), None)
+        if chunk is None:
+            return block_flags[0]
+        section = chunk.sections[y >> 4]
+        if section is None:
+            return block_flags[0]
+        return block_flags[section.key((y & 15) << 8 | (z & 15) << 4 | (x & 15))]
+
+    def section_at(self, x, y, z):
+        """ section holding x, y, z, None for air and unknown """
+        if y > 255 or y < 0:
+            return None
+        chunk = self.chunks.get((x >> 4, z >> 4), None)
+        if chunk is None:
+            return None
+        return chunk.sections[y >> 4]
+
+    def height_at(self, x, z):
+        """ y above the highest non air block of the x, z column, 0 for unknown """
+        chunk = self.chunks.get((x >> 4, z >> 4), None)
+        if chunk is None:
+            return 0
+        return chunk.heightmap[(z & 15) << 4 | (x & 15)]
+
+    def ground_below(self, x, y, z):
+        """ y of the first non air block at or below y, -1 if there is none """
+        chunk = self.chunks.get((x >> 4, z >> 4), None)
+        if chunk is None:
+            return -1
+        height = chunk.heightmap[(z & 15) << 4 | (x & 15)]
+        if y >= height:
+            return height - 1
+        column = (z & 15) << 4 | (x & 15)
+        while y >= 0:
+            section = chunk.sections[y >> 4]
+            if section is None or section.all_air:
+                y = (y & ~15) - 1
+            elif section.block_id((y & 15) << 8 | column):
+                return y
+            else:
+                y -= 1
+        return -1
+
+    def aabb_uniform_flags(self, bb):
+        """ block_flags shared by all blocks in bb going by the section summaries, None if they may differ """
+        min_x, min_y, min_z = utils.grid_shift(bb.min_x), utils.grid_shift(bb.min_y), utils.grid_shift(bb.min_z)
+        max_x, max_y, max_z = utils.grid_shift(bb.max_x), utils.grid_shift(bb.max_y), utils.grid_shift(bb.max_z)
+        flags = block_flags[0] if min_y < 0 or max_y > 255 else None
+        levels = xrange(max(0, min_y) >> 4, (min(255, max_y) >> 4) + 1)
+        for chunk_x in xrange(min_x >> 4, (max_x >> 4) + 1):
+            for chunk_z in xrange(min_z >> 4, (max_z >> 4) + 1):
+                chunk = self.chunks.get((chunk_x, chunk_z), None)
+                for level in levels:
+                    section = None if chunk is None else chunk.sections[level]
+                    section_flags = block_flags[0] if section is None else section.uniform_flags
+                    if section_flags is None or (flags is not None and section_flags != flags):
+                        return None
+                    flags = section_flags
+        return flags
 
     def chunk_updated(self, chunk_x, chunk_z):
         pass
@@ -97,105 +388,164 @@ class Grid(object):
         return chunk
 
     def _load_chunk(self, x, z, continuous, primary_bit, add_bit, data, light_data=True):
-        if primary_bit == 0:
+        self.apply_column(read_column(data, x, z, continuous, primary_bit, add_bit, light_data))
+
+    def apply_column(self, column):
+        x, z = column.x, column.z
+        if column.primary_bit == 0:
             try:
-                del self.chunks[(x, z)]
-                return
+                chunk = self.chunks.pop((x, z))
             except KeyError:
                 pass
+            else:
+                self.resident_bytes -= chunk.nbytes
+                self.chunk_dropped(chunk)
+                return
         self.chunks_loaded += 1
         chunk = self.get_chunk((x, z))
         if chunk is None:
             chunk = self.new_chunk(x, z)
-        if continuous:
+        changed = sorted(column.sections)
+        if column.continuous:
             chunk.complete = True
+            for i, section in enumerate(chunk.sections):  # whole column, what is not sent is air
+                if section is not None and i not in column.sections:
+                    self.resident_bytes -= section.nbytes
+                    chunk.sections[i] = None
+                    changed.append(i)
         else:
             log.msg("WARNING: received noncontinuous chunk, current complete state is %s" % chunk.complete)
-        for i in xrange(chunk.levels):
-            if primary_bit & (1 << i):
-                data_str = data.read(4096)
-                ndata = array.array('B', data_str)  # y, z, x
-                chunk.block_types[i] = ndata
-        for i in xrange(chunk.levels):
-            if primary_bit & (1 << i):
-                data_str = data.read(2048)
-                ndata = array.array('B', data_str)
-                chunk.meta[i] = ndata
-        if light_data:
-            for i in xrange(chunk.levels):
-                if primary_bit & (1 << i):
-                    data_str = data.read(2048)
-                    #ndata = array.array('B', data_str)
-            for i in xrange(chunk.levels):
-                if primary_bit & (1 << i):
-                    data_str = data.read(2048)
-                    #ndata = array.array('B', data_str)
-        # higher block id value will be used after Mojang adds them
-        if add_bit > 0:
-            for i in xrange(chunk.levels):
-                if add_bit >> i & 1:
-                    data_str = data.read(2048)
-                    ndata = array.array('B', data_str)
-        if continuous:
-            data_str = data.read(256)
-            chunk.biome = array.array('b', data_str)
+        chunk.cached = column.cached
+        if self.cache is not None and not column.cached:
+            self.cache.store(column)
+        column.raw = None
+        for i, section in column.sections.iteritems():
+            if chunk.sections[i] is not None:
+                self.resident_bytes -= chunk.sections[i].nbytes
+            chunk.sections[i] = section
+            self.resident_bytes += section.nbytes
+        if column.biome is not None:
+            chunk.biome = column.biome
+        if column.heightmap is not None:
+            chunk.heightmap = column.heightmap
+        else:
+            chunk.heightmap = column_heightmap(chunk.sections)
+        for i in changed:
+            self.section_changed(x, i, z, chunk.sections[i])
 
     def load_chunk(self, x, z, continuous, primary_bit, add_bit, data_array):
         self._load_chunk(x, z, continuous, primary_bit, add_bit, StringIO.StringIO(data_array))
         self.chunk_updated(x, z)
+        self.check_budget()
 
     def load_bulk_chunk(self, metas, data_array, light_data):
-        data = StringIO.StringIO(data_array)
-        for meta in metas:
-            self._load_chunk(meta.x, meta.z, True, meta.primary_bitmap, meta.add_bitmap, data, light_data=light_data)
-        for meta in metas:
-            self.chunk_updated(meta.x, meta.z)
+        self.load_columns(read_bulk_columns(metas, data_array, light_data))
+
+    def load_columns(self, columns):
+        """ put columns made by read_column into the grid """
+        for column in columns:
+            self.apply_column(column)
+        for column in columns:
+            self.chunk_updated(column.x, column.z)
+        self.check_budget()
+
+    def load_cached_columns(self, columns):
+        """ fills the columns the server did not send yet from the chunk cache, returns how many """
+        if self.cache is None:
+            return 0
+        loaded = 0
+        for x, z in columns:
+            if (x, z) in self.chunks:
+                continue
+            column = self.cache.load(x, z)
+            if column is not None:
+                self.apply_column(column)
+                self.chunk_updated(x, z)
+                loaded += 1
+        if loaded:
+            self.check_budget()
+        return loaded
+
+    def load_cached_around(self, coords, radius=None):
+        if radius is None:
+            radius = self.bot_config.CHUNK_CACHE_RADIUS
+        center = (coords / 16.0).grid_shift()
+        return self.load_cached_columns(self.grid_column_around(center, radius))
+
+    def load_cached_between(self, start, goal, margin=2):
+        """ cached columns of the box spanned by start and goal, for paths beyond the view distance """
+        min_x, max_x = sorted((utils.grid_shift(start.x) >> 4, utils.grid_shift(goal.x) >> 4))
+        min_z, max_z = sorted((utils.grid_shift(start.z) >> 4, utils.grid_shift(goal.z) >> 4))
+        limit = self.bot_config.CHUNK_CACHE_MAX_COLUMNS
+        if (max_x - min_x + 2 * margin + 1) * (max_z - min_z + 2 * margin + 1) > limit:
+            return 0
+        return self.load_cached_columns((x, z) for x in xrange(min_x - margin, max_x + margin + 1)
+                                        for z in xrange(min_z - margin, max_z + margin + 1))
 
     def chunk_array_position(self, x, y, z):
         """ compute index from 3D to 1D """
         return y * 256 + z * 16 + x
 
     def change_block_to(self, x, y, z, block_type, meta):
-        chunk_x = x >> 4
-        chunk_z = z >> 4
-        if (chunk_x, chunk_z) not in self.chunks:
-            return None, None
-        else:
-            chunk = self.get_chunk((chunk_x, chunk_z))
-        y_level = y >> 4
-        if chunk.block_types[y_level] is None:
-            return None, None
-        current_block = self.get_block(x, y, z)
-        if current_block is None:
-            log.err("change_block block %s type %s meta %s is None" % ((x, y, z), block_type, meta))
-            return None, None
-        cx = x & 15
-        cy = y & 15
-        cz = z & 15
-        pos = self.chunk_array_position(cx, cy, cz)
-        chunk.block_types[y_level][pos] = block_type
-        chunk.set_meta(y_level, pos, meta)
-        new_block = self.make_block(x, y, z, block_type, meta)
-        return current_block, new_block
+        """ (old block, new block), None, None outside of the loaded sections """
+        return self.apply_block_changes([(x, y, z, block_type, meta)], with_blocks=True)[0]
+
+    def apply_block_changes(self, changes, with_blocks=False):
+        """
+        changes are (x, y, z, block id, meta), written section by section
+        with one notification for every changed section. Returns the number
+        of blocks changed, with with_blocks a list of (old block, new block)
+        for every change instead, None, None outside of the loaded sections.
+        """
+        by_section = {}
+        for i, (x, y, z, block_type, meta) in enumerate(changes):
+            if 0 <= y <= 255:
+                by_section.setdefault((x >> 4, y >> 4, z >> 4), []).append((i, x, y, z, block_type, meta))
+        out = [(None, None)] * len(changes) if with_blocks else None
+        changed = 0
+        for (chunk_x, level, chunk_z), records in by_section.iteritems():
+            chunk = self.chunks.get((chunk_x, chunk_z), None)
+            section = None if chunk is None else chunk.sections[level]
+            if section is None:
+                continue
+            positions = []
+            nbytes = section.nbytes  # writes can grow the section into nibbles or a full array
+            for i, x, y, z, block_type, meta in records:
+                pos = (y & 15) << 8 | (z & 15) << 4 | (x & 15)
+                key = section.key(pos)
+                if with_blocks:
+                    out[i] = (self.make_block(x, y, z, key >> 4, key & 15), self.make_block(x, y, z, block_type, meta))
+                if key == block_type << 4 | meta:  # the server sends unchanged blocks too
+                    continue
+                section.set(pos, block_type, meta)
+                positions.append(pos)
+                column = pos & 255
+                if block_type != 0:
+                    if y >= chunk.heightmap[column]:
+                        chunk.heightmap[column] = y + 1
+                elif y + 1 == chunk.heightmap[column]:
+                    chunk.heightmap[column] = self.ground_below(x, y - 1, z) + 1
+            if positions:
+                if len(positions) > 1:
+                    positions = sorted(set(positions))
+                changed += len(positions)
+                self.resident_bytes += section.nbytes - nbytes
+                self.section_changed(chunk_x, level, chunk_z, section, positions)
+        if changed:
+            self.check_budget()
+        return out if with_blocks else changed
 
     def block_change(self, x, y, z, btype, bmeta):
-        _, _ = self.change_block_to(x, y, z, btype, bmeta)
+        self.apply_block_changes([(x, y, z, btype, bmeta)])
 
     def multi_block_change(self, chunk_x, chunk_z, blocks):
         shift_x = chunk_x << 4
         shift_z = chunk_z << 4
-        for block in blocks:
-            _, _ = self.change_block_to(block.x + shift_x, block.y, block.z + shift_z, block.block_id, block.meta)
+        self.apply_block_changes([(block.x + shift_x, block.y, block.z + shift_z, block.block_id, block.meta)
+                                  for block in blocks])
 
     def on_explosion(self, x, y, z, records):
-        for rec in records:
-            rx = x + rec.x
-            ry = y + rec.y
-            rz = z + rec.z
-            gx = int(rx)
-            gy = int(ry)
-            gz = int(rz)
-            ob, nb = self.change_block_to(gx, gy, gz, 0, 0)
+        self.apply_block_changes([(int(x + rec.x), int(y + rec.y), int(z + rec.z), 0, 0) for rec in records])
 
     def chunk_complete_at(self, x, z):
         cx = x >> 4
@@ -207,46 +557,100 @@ class Grid(object):
             return chunk.complete
 
     def blocks_in_aabb(self, bb):
+        if self.aabb_uniform_flags(bb) == block_flags[0]:
+            for x, y, z in bb.grid_area:
+                yield self.make_block(x, y, z, 0, 0)
+            return
         for x, y, z in bb.grid_area:
             blk = self.get_block(x, y, z)
             if blk is not None:
                 yield blk
 
-    def is_any_liquid(self, bb):
-        for blk in self.blocks_in_aabb(bb):
-            if blk.material.is_liquid:
+    def blocks_in_aabb_with(self, bb, flags):
+        """ blocks_in_aabb, but only blocks having any of the flags are built """
+        uniform = self.aabb_uniform_flags(bb)
+        if uniform is not None and not uniform & flags:
+            return
+        for x, y, z in bb.grid_area:
+            if self.flags_at(x, y, z) & flags:
+                yield self.get_block(x, y, z)
+
+    def any_flag_in_aabb(self, bb, flags):
+        uniform = self.aabb_uniform_flags(bb)
+        if uniform is not None:
+            return bool(uniform & flags)
+        for x, y, z in bb.grid_area:
+            if self.flags_at(x, y, z) & flags:
                 return True
         return False
 
+    def is_any_liquid(self, bb):
+        return self.any_flag_in_aabb(bb, blocks.IS_LIQUID)
+
     def aabb_collides(self, bb):
-        for col_bb in self.collision_aabbs_in(bb):
-            if col_bb.collides(bb):
-                return True
-        return False
+        boxes = array.array('d')
+        self.collision_boxes(bb, boxes)
+        return bb.collides_any(boxes)
 
     def collision_aabbs_in(self, bb):
-        out = []
-        for blk in self.blocks_in_aabb(bb.extend_to(0, -1, 0)):
-            blk.add_grid_bounding_boxes_to(out)
-        return out
+        boxes = array.array('d')
+        self.collision_boxes(bb, boxes)
+        return [AABB(*boxes[i:i + 6]) for i in xrange(0, len(boxes), 6)]
+
+    def collision_boxes(self, bb, out):
+        """
+        fills the array out with min_x, min_y, min_z, max_x, max_y, max_z of
+        the collision boxes in bb, returns how many. Unit shapes come from
+        the block tables, only blocks with SHAPE_CONTEXT are built.
+        """
+        del out[:]
+        bb = bb.extend_to(0, -1, 0)
+        uniform = self.aabb_uniform_flags(bb)
+        if uniform == block_flags[0]:
+            return 0
+        min_x, min_y, min_z, max_x, max_y, max_z = bb.grid_box
+        min_y, max_y = max(min_y, 0), min(max_y, 255)
+        cube = block_shape[1 << 4]
+        for x in xrange(min_x, max_x + 1):
+            columns = [(self.chunks.get((x >> 4, z >> 4), None), (z & 15) << 4 | (x & 15), z)
+                       for z in xrange(min_z, max_z + 1)]
+            for y in xrange(min_y, max_y + 1):  # in the order of grid_area, x, y, z
+                for chunk, column, z in columns:
+                    if chunk is None:
+                        continue
+                    if uniform is None:
+                        section = chunk.sections[y >> 4]
+                        if section is None:
+                            continue
+                        shape = block_shape[section.key((y & 15) << 8 | column)]
+                    else:
+                        shape = cube
+                    if shape == blocks.SHAPE_CONTEXT:
+                        context_boxes = []
+                        self.get_block(x, y, z).add_grid_bounding_boxes_to(context_boxes)
+                        for box in context_boxes:
+                            out.extend((box.min_x, box.min_y, box.min_z, box.max_x, box.max_y, box.max_z))
+                        continue
+                    for min_bx, min_by, min_bz, max_bx, max_by, max_bz in collision_shapes[shape]:
+                        out.extend((x + min_bx, y + min_by, z + min_bz, x + max_bx, y + max_by, z + max_bz))
+        return len(out) / 6
 
     def avoid_aabbs_in(self, bb):
         out = []
-        for blk in self.blocks_in_aabb(bb):  # lava, fire, web
-            if blk.is_lava or blk.number == blocks.Fire.number or blk.number == blocks.Cobweb.number:
-                out.append(AABB.from_block_cube(blk.x, blk.y, blk.z))
+        for x, y, z in bb.grid_area:  # lava, fire, web
+            block_id = self.block_id_at(x, y, z)
+            if block_id == blocks.Fire.number or block_id == blocks.Cobweb.number or \
+                    block_flags[block_id << 4] & blocks.IS_LAVA:
+                out.append(AABB.from_block_cube(x, y, z))
         return out
 
     def aabb_on_ladder(self, bb):
-        blk = self.get_block(bb.gridpos_x, bb.gridpos_y, bb.gridpos_z)
-        return blk.number == blocks.Ladders.number or blk.number == blocks.Vines.number
+        block_id = self.block_id_at(bb.gridpos_x, bb.gridpos_y, bb.gridpos_z)
+        return block_id == blocks.Ladders.number or block_id == blocks.Vines.number
 
     def aabb_in_water(self, bb):
         #TODO return the bast water block instead of boolean
-        for blk in self.blocks_in_aabb(bb.expand(-0.001, -0.4010000059604645, -0.001)):
-            if blk.is_water:
-                return True
-        return False
+        return self.any_flag_in_aabb(bb.expand(-0.001, -0.4010000059604645, -0.001), blocks.IS_WATER)
 
     def standing_on_solidblock(self, bb):
         standing_on = None
@@ -299,89 +703,196 @@ class Grid(object):
             chunk = self.get_chunk(chunk_crd)
             if chunk is None:
                 continue
-            for level, block_types in enumerate(chunk.block_types):
-                if block_types is None:
+            for level, section in enumerate(chunk.sections):
+                if section is None or not section.count(block_number):
                     continue
-                if block_types.count(block_number) > 0:
-                    for pos, block_id in enumerate(block_types):
-                        if block_id == block_number:
-                            meta = chunk.get_meta(level, pos)
-                            if block_filter is not None and not block_filter(meta):
-                                continue
-                            cx = pos & 15
-                            cz = (pos >> 4) & 15
-                            cy = pos / 256
-                            x = cx + chunk_crd[0] * 16
-                            y = cy + level * 16
-                            z = cz + chunk_crd[1] * 16
-                            yield self.make_block(x, y, z, block_number, meta)
-
-    def raycast_to_block(self, position, direction, max_distance=40):
-        g_position = position.grid_shift()
-        gx = g_position.x
-        gy = g_position.y
-        gz = g_position.z
-        if fops.eq(0, direction.x):
-            stepx = 0
-            tdx = sys.float_info.max
-        else:
-            stepx = int(math.copysign(1, direction.x))
-            tdx = abs(1 / direction.x)
-
-        if fops.eq(0, direction.y):
-            stepy = 0
-            tdy = sys.float_info.max
-        else:
-            stepy = int(math.copysign(1, direction.y))
-            tdy = abs(1 / direction.y)
-
-        if fops.eq(0, direction.z):
-            stepz = 0
-            tdz = sys.float_info.max
-        else:
-            stepz = int(math.copysign(1, direction.z))
-            tdz = abs(1 / direction.z)
-
-        if stepx == 0:
-            tmaxx = tdx
-        elif stepx > 0:
-            tmaxx = (math.floor(position.x) + 1 - position.x) * tdx
-        else:
-            tmaxx = (position.x - math.floor(position.x)) * tdx
-
-        if stepy == 0:
-            tmaxy = tdy
-        elif stepy > 0:
-            tmaxy = (math.floor(position.y) + 1 - position.y) * tdy
-        else:
-            tmaxy = (position.y - math.floor(position.y)) * tdy
-
-        if stepz == 0:
-            tmaxz = tdz
-        elif stepz > 0:
-            tmaxz = (math.floor(position.z) + 1 - position.z) * tdz
-        else:
-            tmaxz = (position.z - math.floor(position.z)) * tdz
-
-        sqr_max_distance = max_distance * max_distance
+                for pos in section.positions_of(block_number):
+                    meta = section.meta_at(pos)
+                    if block_filter is not None and not block_filter(meta):
+                        continue
+                    cx = pos & 15
+                    cz = (pos >> 4) & 15
+                    cy = pos / 256
+                    x = cx + chunk_crd[0] * 16
+                    y = cy + level * 16
+                    z = cz + chunk_crd[1] * 16
+                    yield self.make_block(x, y, z, block_number, meta)
+
+    def nearest_blocks(self, coords, block_number, block_filter=None, distance=160):
+        """
+        blocks of block_number within distance of coords, nearest first.
+        Sections are searched in rings of columns around coords, only as far
+        as the caller keeps asking. block_filter gets the meta.
+        """
+        px, py, pz = coords.x, coords.y, coords.z
+        center_x, center_z = utils.grid_shift(px) >> 4, utils.grid_shift(pz) >> 4
+        max_sq = distance * distance
+        last_ring = distance / 16 + 1
+        heap = []
+        counter = itertools.count()
+        ring = 0
         while True:
-            if tmaxx < tmaxy:
-                if tmaxx < tmaxz:
-                    gx = gx + stepx
-                    tmaxx = tmaxx + tdx
-                else:
-                    gz = gz + stepz
-                    tmaxz = tmaxz + tdz
+            # blocks of the rings not searched yet are at least this far
+            ring_sq = (max(0, ring - 1) * 16) ** 2 if ring <= last_ring else float("inf")
+            while heap and heap[0][0] < ring_sq:
+                dist_sq, _, level, item = heapq.heappop(heap)
+                if dist_sq > max_sq:
+                    return
+                if level is None:
+                    x, y, z, meta = item
+                    if self.block_id_at(x, y, z) == block_number:  # the grid may have changed since
+                        yield self.make_block(x, y, z, block_number, meta)
+                    continue
+                section = item.sections[level]
+                if section is None:
+                    continue
+                for pos in section.positions_of(block_number):
+                    meta = section.meta_at(pos)
+                    if block_filter is not None and not block_filter(meta):
+                        continue
+                    x = item.grid_x + (pos & 15)
+                    y = (level << 4) + (pos >> 8)
+                    z = item.grid_z + ((pos >> 4) & 15)
+                    heapq.heappush(heap, ((x - px) ** 2 + (y - py) ** 2 + (z - pz) ** 2, next(counter), None,
+                                          (x, y, z, meta)))
+            if ring > last_ring:
+                return
+            for chunk_x, chunk_z in ring_columns(center_x, center_z, ring):
+                chunk = self.chunks.get((chunk_x, chunk_z), None)
+                if chunk is None:
+                    continue
+                for level, section in enumerate(chunk.sections):
+                    if section is None or not section.count(block_number):
+                        continue
+                    dist_sq = axis_gap(px, chunk.grid_x) ** 2 + axis_gap(py, level << 4) ** 2 + \
+                        axis_gap(pz, chunk.grid_z) ** 2
+                    heapq.heappush(heap, (dist_sq, next(counter), level, chunk))
+            ring += 1
 
-            else:
-                if tmaxy < tmaxz:
-                    gy = gy + stepy
-                    tmaxy = tmaxy + tdy
-                else:
-                    gz = gz + stepz
-                    tmaxz = tmaxz + tdz
-            blk = self.get_block(gx, gy, gz)
-            if blk.number != blocks.Air.number:
-                return blk
-            if (g_position.x - gx) ** 2 + (g_position.y - gy) ** 2 + (g_position.z - gz) ** 2 > sqr_max_distance:
-                return blocks.Air(self, 0, 0, 0, 0)
+    def raycast_to_block(self, position, direction, max_distance=40):
+        """ first block along the ray, air when there is none within max_distance """
+        hit = raycast.raycast(self, position.x, position.y, position.z, direction.x, direction.y, direction.z,
+                              max_distance)
+        if hit is None:
+            return blocks.Air(self, 0, 0, 0, 0)
+        return self.make_block(hit.x, hit.y, hit.z, hit.block_id, hit.meta)
+
+
+def ring_columns(center_x, center_z, ring):
+    """ columns ring columns away from the center one """
+    if ring == 0:
+        yield center_x, center_z
+        return
+    for x in xrange(center_x - ring, center_x + ring + 1):
+        yield x, center_z - ring
+        yield x, center_z + ring
+    for z in xrange(center_z - ring + 1, center_z + ring):
+        yield center_x - ring, z
+        yield center_x + ring, z
+
+
+def axis_gap(p, start):
+    """ distance from p to the block corners start to start + 15 along one axis """
+    if p < start:
+        return start - p
+    elif p > start + 15:
+        return p - start - 15
+    return 0
+
+
+def check_block_tables(grid, positions):
+    """
+    compares the blocks tables with the properties of block objects placed
+    at positions of the grid, list of mismatch descriptions
+    """
+    errors = []
+    for key in xrange(256 << 4):
+        block_id, meta = key >> 4, key & 15
+        cls = blocks.block_list[block_id]
+        if cls is None:
+            if block_flags[key] or block_shape[key]:
+                errors.append("unknown block id %d meta %d has flags %d shape %d" %
+                              (block_id, meta, block_flags[key], block_shape[key]))
+            continue
+        for x, y, z in positions:
+            old_id, old_meta = grid.block_id_at(x, y, z), grid.meta_at(x, y, z)
+            if grid.change_block_to(x, y, z, block_id, meta)[1] is None:
+                errors.append("cannot place blocks at %s, section not loaded" % ((x, y, z),))
+                return errors
+            errors.extend("%s meta %d at %s: %s" % (cls.name, meta, (x, y, z), e)
+                          for e in block_table_mismatches(grid, x, y, z))
+            grid.change_block_to(x, y, z, old_id, old_meta)
+    return errors
+
+
+BlockRecord = collections.namedtuple("BlockRecord", "x y z block_id meta")  # like the records of the packets
+
+
+def check_change_notifications(grid, x, y, z):
+    """
+    changes blocks around x, y, z of a loaded section, drops the chunk and
+    compares what the listeners were told, list of mismatch descriptions
+    """
+    section = grid.section_at(x, y, z)
+    if section is None:
+        return ["no section at %s" % ((x, y, z),)]
+    errors = []
+    seen = []
+    listener = lambda coords, section, positions: seen.append((coords, section, positions))
+    grid.subscribe(listener)
+    coords = (x >> 4, y >> 4, z >> 4)
+    pos = (y & 15) << 8 | (z & 15) << 4 | (x & 15)
+
+    def expect(what, positions):
+        version = section.version
+        told = [(c, p) for c, s, p in seen]
+        del seen[:]
+        if told != [(coords, p) for p in positions]:
+            errors.append("%s told %s" % (what, told))
+        return version
+
+    new_id = 1 if grid.block_id_at(x, y, z) != 1 else 3
+    before = section.version
+    grid.change_block_to(x, y, z, new_id, 0)
+    if expect("change_block_to", [[pos]]) <= before:
+        errors.append("change_block_to did not raise the version %d" % before)
+    grid.change_block_to(x, y, z, new_id, 0)
+    expect("unchanged block", [])
+    grid.multi_block_change(x >> 4, z >> 4, [BlockRecord(x & 15, y, z & 15, 0, 0)])
+    expect("multi_block_change", [[pos]])
+    grid.on_explosion(x + 0.5, y + 0.5, z + 0.5, [BlockRecord(0, 0, 0, 0, 0)])
+    expect("on_explosion of air", [])
+    chunk = grid.get_chunk((x >> 4, z >> 4))
+    grid.chunks.pop(chunk.coords)
+    grid.chunk_dropped(chunk)
+    told = [(c, s) for c, s, p in seen]
+    if (coords, None) not in told or any(s is not None for c, s in told):
+        errors.append("dropped chunk told %s" % told)
+    grid.chunks[chunk.coords] = chunk
+    grid.unsubscribe(listener)
+    return errors
+
+
+def block_table_mismatches(grid, x, y, z):
+    blk = grid.get_block(x, y, z)
+    key = grid.block_key_at(x, y, z)
+    flags = grid.flags_at(x, y, z)
+    if key != blk.number << 4 | blk.meta or flags != block_flags[key]:
+        yield "grid key %d flags %d" % (key, flags)
+    if not flags & blocks.CONTEXT:
+        for flag, name in blocks.flag_properties:
+            value = bool(getattr(blk, name, False))
+            if value != bool(flags & flag):
+                yield "%s is %s" % (name, value)
+    if blk.material.is_liquid != bool(flags & blocks.IS_LIQUID):
+        yield "is_liquid is %s" % blk.material.is_liquid
+    if blocks.block_slipperiness[key] != blk.slipperiness:
+        yield "slipperiness is %s, %s in the table" % (blk.slipperiness, blocks.block_slipperiness[key])
+    if not flags & blocks.BOXES_CONTEXT:
+        boxes = [(b.min_x, b.min_y, b.min_z, b.max_x, b.max_y, b.max_z) for b in blk.grid_bounding_boxes]
+        table = [(x + b[0], y + b[1], z + b[2], x + b[3], y + b[4], z + b[5])
+                 for b in collision_shapes[block_shape[key]]]
+        if boxes != table:
+            yield "boxes are %s, %s in the table" % (boxes, table)
+        if bool(boxes) != bool(flags & blocks.HAS_BOXES):
+            yield "has boxes is %s" % bool(boxes)
@@ -1,40 +1,269 @@
 
 
+import array
+
+import config
 import logbot
 import utils
 import fops
+import blocks
 
 
 log = logbot.getlogger("GRIDSPACE")
 
 
-class NodeState(object):
-    def __init__(self, grid, x=None, y=None, z=None, vector=None):
+# packed NodeState flags, the words of Walkability
+CAN_BE = 1
+CAN_STAND = 1 << 1
+CAN_JUMP = 1 << 2
+CAN_FALL = 1 << 3
+CAN_CLIMB = 1 << 4
+IN_FIRE = 1 << 5
+IN_WATER = 1 << 6
+CAN_HOLD = 1 << 7
+KNOWN = 1 << 8  # set in every stored word, 0 is not computed yet
+NO_CACHE = 1 << 9  # climbable depends on the neighbours, computed every time
+
+# packed node coordinates, x and z in 26 bits, y in 10 bits
+COORD_OFFSET = 1 << 25
+Y_OFFSET = 256
+X_SHIFT = 36
+Z_SHIFT = 10
+DX = 1 << X_SHIFT
+DY = 1
+DZ = 1 << Z_SHIFT
+SECTION_BITS = ~(15 << X_SHIFT | 15 << Z_SHIFT | 15)  # key & SECTION_BITS is the corner of its section
+
+blank_layer = array.array('H', [0]) * 256
+
+
+def pack(x, y, z):
+    """ one int of the node coordinates, neighbours are DX, DY and DZ apart """
+    return (x + COORD_OFFSET) << X_SHIFT | (z + COORD_OFFSET) << Z_SHIFT | (y + Y_OFFSET)
+
+
+def unpack(key):
+    return (key >> X_SHIFT) - COORD_OFFSET, (key & 1023) - Y_OFFSET, (key >> Z_SHIFT & 0x3ffffff) - COORD_OFFSET
+
+
+def pack_coords(coords):
+    return pack(coords.x, coords.y, coords.z)
+
+
+def unpack_coords(key):
+    return utils.Vector(*unpack(key))
+
+
+# (delta of the packed coords, diagonal, i, j) of utils.adjacency and utils.cross
+packed_adjacency = [(i * DX + j * DZ, i != 0 and j != 0, i, j) for i, j in utils.adjacency]
+packed_cross = [i * DX + j * DZ for i, j in utils.cross]
+
+# bits of the move masks of Walkability, every direction on the same level, falls of
+# one to three blocks and a step up, then straight up and down
+move_deltas = [d + k for d, _, _, _ in packed_adjacency for k in (0, -1, -2, -3, 1)] + [DY, -DY]
+move_bits = dict((d, 1 << n) for n, d in enumerate(move_deltas))
+mask_moves = {}
+
+# nodes whose moves read a block, from two below to four above it, a fall reads four
+# blocks down and a step up two blocks up
+move_reach = [i * DX + j * DZ + k for i in (-1, 0, 1) for j in (-1, 0, 1) for k in xrange(-2, 5)]
+section_reach = [i * DX + j * DZ + k for i in (-16, 0, 16) for j in (-16, 0, 16) for k in (-16, 0, 16)]
+
+
+def moves_in(mask):
+    """ packed deltas of the moves of mask """
+    try:
+        return mask_moves[mask]
+    except KeyError:
+        deltas = mask_moves[mask] = tuple(d for n, d in enumerate(move_deltas) if mask >> n & 1)
+        return deltas
+
+
+def node_flags(grid, x, y, z):
+    """ packed flags of the node at x, y, z from the blocks below, in and above it """
+    flags_0 = grid.flags_at(x, y - 1, z)
+    flags_1 = grid.flags_at(x, y, z)
+    flags_2 = grid.flags_at(x, y + 1, z)
+    out = KNOWN
+    climbable_1 = flags_1 & blocks.IS_CLIMBABLE
+    if flags_1 & blocks.CONTEXT:
+        climbable_1 = grid.get_block(x, y, z).is_climbable
+        out |= NO_CACHE
+    if flags_1 & flags_2 & blocks.CAN_FALL_THROUGH:
+        out |= CAN_BE
+        if flags_0 & blocks.CAN_STAND_ON:
+            out |= CAN_STAND
+            if flags_1 & flags_2 & blocks.IS_FREE:
+                out |= CAN_JUMP
+        if flags_0 & blocks.CAN_FALL_THROUGH:
+            out |= CAN_FALL
+        if climbable_1:
+            out |= CAN_CLIMB
+    if (flags_1 | flags_2) & blocks.IS_BURNING:
+        out |= IN_FIRE
+    if (flags_1 | flags_2) & blocks.IS_WATER:
+        out |= IN_WATER
+    if out & IN_WATER or flags_1 & blocks.IS_LADDER or (flags_1 & blocks.IS_VINE and climbable_1):
+        out |= CAN_HOLD
+    return out
+
+
+class Walkability(object):
+    """
+    Node flags and moves of one grid, shared by every GridSpace of it.
+    Flag words are kept per section in arrays indexed like the section
+    blocks, move masks of the nodes A* expanded in a dict per section.
+    Both are filled when first asked for and cleared by the block change
+    notifications of the grid. A node depends on the blocks below, in and
+    above it, its moves on the blocks of the nodes around it, see
+    move_reach. Sections are keyed by the packed coords of their corner.
+    """
+
+    def __init__(self, grid):
         self.grid = grid
+        self.sections = {}
+        self.moves = {}
+        self.hits = 0
+        self.misses = 0
+        self.uncached = 0  # words with NO_CACHE handed out, moves seeing one are not kept
+        grid.subscribe(self.section_changed)
+
+    def word(self, key):
+        """ flags of the node at packed coords key """
+        corner = key & SECTION_BITS
+        words = self.sections.get(corner, None)
+        if words is None:
+            if len(self.sections) >= config.WALKABILITY_CACHE_SECTIONS:
+                self.shrink()
+            words = self.sections[corner] = array.array('H', [0]) * 4096
+        pos = (key & 15) << 8 | (key >> Z_SHIFT & 15) << 4 | (key >> X_SHIFT & 15)  # like the section blocks
+        word = words[pos]
+        if word:
+            self.hits += 1
+            return word
+        self.misses += 1
+        x, y, z = unpack(key)
+        word = node_flags(self.grid, x, y, z)
+        if word & NO_CACHE:
+            self.uncached += 1
+        else:
+            words[pos] = word
+        return word
+
+    def flags(self, x, y, z):
+        return self.word(pack(x, y, z))
+
+    def move_mask(self, key):
+        """ mask of move_bits of the node at packed coords key, None when not known """
+        masks = self.moves.get(key & SECTION_BITS, None)
+        if masks is None:
+            return None
+        return masks.get(key, None)
+
+    def set_move_mask(self, key, mask):
+        corner = key & SECTION_BITS
+        masks = self.moves.get(corner, None)
+        if masks is None:
+            if len(self.moves) >= config.WALKABILITY_CACHE_SECTIONS:
+                self.shrink()
+            masks = self.moves[corner] = {}
+        masks[key] = mask
+
+    def shrink(self):
+        """ drops the half of the sections farthest from the focus of the grid """
+        focus_x, focus_z = self.grid.focus_column()
+
+        def distance(corner):
+            x, _, z = unpack(corner)
+            return ((x >> 4) - focus_x) ** 2 + ((z >> 4) - focus_z) ** 2
+        for cache in (self.sections, self.moves):
+            corners = sorted(cache, key=distance)
+            for corner in corners[len(corners) / 2:]:
+                del cache[corner]
+
+    def section_changed(self, coords, section, positions):
+        chunk_x, level, chunk_z = coords
+        corner = pack(chunk_x << 4, level << 4, chunk_z << 4)
+        words = self.sections.get(corner, None)
+        below = self.sections.get(corner - 16 * DY, None)
+        above = self.sections.get(corner + 16 * DY, None)
+        moves = self.moves
+        if positions is None:
+            self.sections.pop(corner, None)
+            if below is not None:
+                below[15 << 8:] = blank_layer
+            if above is not None:
+                above[:256] = blank_layer
+            for d in section_reach:
+                moves.pop(corner + d, None)
+            return
+        for pos in positions:
+            if words is not None:
+                words[pos] = 0
+                if pos >= 256:
+                    words[pos - 256] = 0
+                if pos < 15 << 8:
+                    words[pos + 256] = 0
+            if pos < 256 and below is not None:
+                below[pos + (15 << 8)] = 0
+            elif pos >= 15 << 8 and above is not None:
+                above[pos - (15 << 8)] = 0
+            if moves:
+                block = corner + (pos & 15) * DX + (pos >> 4 & 15) * DZ + (pos >> 8)
+                for d in move_reach:
+                    node = block + d
+                    masks = moves.get(node & SECTION_BITS, None)
+                    if masks is not None:
+                        masks.pop(node, None)
+
+
+def walkability(grid):
+    if grid.walkability is None:
+        grid.walkability = Walkability(grid)
+    return grid.walkability
+
+
+class NodeState(object):
+    """ node flags at x, y, z for the callers that want attributes, GridSpace keeps only the words """
+    __slots__ = ("x", "y", "z", "flags")
+
+    def __init__(self, x, y, z, flags):
         self.x = x
         self.y = y
         self.z = z
-        self.coords = utils.Vector(self.x, self.y, self.z)
-        self.block_0 = grid.get_block(self.x, self.y - 1, self.z)
-        self.block_1 = grid.get_block(self.x, self.y, self.z)
-        self.block_2 = grid.get_block(self.x, self.y + 1, self.z)
-        self.can_be = self.block_1.can_fall_through and self.block_2.can_fall_through
-        self.can_stand = self.block_0.can_stand_on and self.can_be
-        self.can_jump = self.can_stand and self.block_1.is_free and self.block_2.is_free
-        self.can_fall = self.can_be and self.block_0.can_fall_through
-        self.can_climb = self.can_be and self.block_1.is_climbable
-        self.in_fire = self.block_1.is_burning or self.block_2.is_burning
-        self.in_water = self.block_1.is_water or self.block_2.is_water
-        self.can_hold = self.in_water or self.block_1.is_ladder or (self.block_1.is_vine and self.block_1.is_climbable)
-        self.platform_y = self.y
-        self.center_x = self.x + 0.5
-        self.center_z = self.z + 0.5
+        self.flags = flags
+
+    can_be = property(lambda self: bool(self.flags & CAN_BE))
+    can_stand = property(lambda self: bool(self.flags & CAN_STAND))
+    can_jump = property(lambda self: bool(self.flags & CAN_JUMP))
+    can_fall = property(lambda self: bool(self.flags & CAN_FALL))
+    can_climb = property(lambda self: bool(self.flags & CAN_CLIMB))
+    in_fire = property(lambda self: bool(self.flags & IN_FIRE))
+    in_water = property(lambda self: bool(self.flags & IN_WATER))
+    can_hold = property(lambda self: bool(self.flags & CAN_HOLD))
+
+    @property
+    def key(self):
+        return pack(self.x, self.y, self.z)
+
+    @property
+    def coords(self):
+        return utils.Vector(self.x, self.y, self.z)
+
+    @property
+    def platform_y(self):
+        return self.y
+
+    @property
+    def center_x(self):
+        return self.x + 0.5
+
+    @property
+    def center_z(self):
+        return self.z + 0.5
 
     def __repr__(self):
-        if self.can_stand:
-            return "ON %s" % self.block_0
-        else:
-            return "IN %s" % self.block_1
+        return "%s %d, %d, %d flags %s" % ("ON" if self.can_stand else "IN", self.x, self.y, self.z, bin(self.flags))
 
     def vertical_center_in(self, center):
         return fops.lte(self.x, center.x) and fops.lte(center.x, (self.x + 1)) and fops.lte(self.z, center.z) and fops.lte(center.z, (self.z + 1))
@@ -50,24 +279,21 @@ class NodeState(object):
 
 
 class GridSpace(object):
+    """
+    Moves between nodes of the grid. Nodes are packed coords, see pack,
+    their flags and moves come from the Walkability of the grid.
+    """
 
     def __init__(self, grid):
         self.grid = grid
-        self.cache = {}
+        self.walkability = walkability(grid)
+        self.word = self.walkability.word
 
     def get_state_coords(self, coords):
-        return self._get_state(coords.tuple)
+        return self.get_state(coords.x, coords.y, coords.z)
 
     def get_state(self, x, y, z):
-        return self._get_state((x, y, z))
-
-    def _get_state(self, t_coords):
-        try:
-            return self.cache[t_coords]
-        except KeyError:
-            state = NodeState(self.grid, t_coords[0], t_coords[1], t_coords[2])
-            self.cache[t_coords] = state
-            return state
+        return NodeState(x, y, z, self.word(pack(x, y, z)))
 
     def positions_to_dig(self, coords):
         center = utils.Vector(coords.x, coords.y - 1, coords.z)
@@ -77,152 +303,147 @@ class GridSpace(object):
                     spow = x ** 2 + y ** 2 + z ** 2
                     if spow > 25:
                         continue
-                    state = self.get_state(center.x + x, center.y + y, center.z + z)
-                    if state.can_stand:
+                    if self.word(pack(center.x + x, center.y + y, center.z + z)) & CAN_STAND:
                         yield utils.Vector(center.x + x, center.y + y, center.z + z)
 
-    def neighbours_of(self, coords, go_fire=False):
-        x = coords.x
-        y = coords.y
-        z = coords.z
-        base_state = self.get_state_coords(coords)
-        if base_state.in_water:
-            for k in [0, 1, -1]:
-                for i, j in utils.adjacency:
-                    to_state = self.get_state(x + i, y + k, z + j)
-                    if to_state.in_water:
-                        go = self.can_swim(base_state, to_state)
-                        if go:
-                            yield to_state
-                    elif to_state.can_stand:
-                        if i != 0 and j != 0:
+    def neighbours_of(self, key, go_fire=False):
+        """ list of packed coords reachable in one move from the packed coords key """
+        walkability = self.walkability
+        mask = walkability.move_mask(key)
+        if mask is None:
+            uncached = walkability.uncached
+            mask = 0
+            for to in self.moves_from(key):
+                mask |= move_bits[to - key]
+            if walkability.uncached == uncached:
+                walkability.set_move_mask(key, mask)
+        return [key + d for d in moves_in(mask)]
+
+    def moves_from(self, key):
+        word = self.word
+        base = word(key)
+        if base & IN_WATER:
+            for k in (0, DY, -DY):
+                for d, diagonal, _, _ in packed_adjacency:
+                    to = key + k + d
+                    flags = word(to)
+                    if flags & IN_WATER:
+                        if self.can_swim(key, to):
+                            yield to
+                    elif flags & CAN_STAND:
+                        if diagonal:
                             continue
                         if k == 0:
-                            yield to_state
-                        else:
-                            go = self.can_go(base_state, to_state)
-                            if go:
-                                yield to_state
-                    elif to_state.can_hold:
-                        if (i != 0 and j != 0) or k != 0:
+                            yield to
+                        elif self.can_go(key, to):
+                            yield to
+                    elif flags & CAN_HOLD:
+                        if diagonal or k != 0:
                             continue
-                        yield to_state
-            to_state = self.get_state(x, y + 1, z)
-            if to_state.in_water:
-                yield to_state
-            to_state = self.get_state(x, y - 1, z)
-            if to_state.can_stand or to_state.in_water:
-                yield to_state
-        elif base_state.can_hold:
-            for k in [0, 1, -1]:
-                for i, j in utils.cross:
-                    to_state = self.get_state(x + i, y + k, z + j)
-                    if to_state.can_stand:
-                        go = self.can_go(base_state, to_state)
-                        if go:
-                            yield to_state
-                    elif to_state.can_hold:
+                        yield to
+            if word(key + DY) & IN_WATER:
+                yield key + DY
+            if word(key - DY) & (CAN_STAND | IN_WATER):
+                yield key - DY
+        elif base & CAN_HOLD:
+            for k in (0, DY, -DY):
+                for d in packed_cross:
+                    to = key + k + d
+                    flags = word(to)
+                    if flags & CAN_STAND:
+                        if self.can_go(key, to):
+                            yield to
+                    elif flags & CAN_HOLD:
                         if k == 0:
-                            yield to_state
-            to_state = self.get_state(x, y + 1, z)
-            if to_state.can_hold:
-                yield to_state
-            to_state = self.get_state(x, y - 1, z)
-            if to_state.can_stand or to_state.can_hold:
-                yield to_state
+                            yield to
+            if word(key + DY) & CAN_HOLD:
+                yield key + DY
+            if word(key - DY) & (CAN_STAND | CAN_HOLD):
+                yield key - DY
         else:
-            for i, j in utils.adjacency:
-                to_state = self.get_state(x + i, y, z + j)
-                if to_state.can_stand or to_state.can_hold:
-                    go = self.can_go(base_state, to_state)
-                    if go:
-                        yield to_state
-                elif to_state.can_fall:
-                    for k in [-1, -2, -3]:
-                        to_state = self.get_state(x + i, y + k, z + j)
-                        if to_state.can_stand or to_state.can_hold:
-                            go = self.can_go(base_state, to_state)
-                            if go:
-                                yield to_state
+            for d, _, i, j in packed_adjacency:
+                to = key + d
+                flags = word(to)
+                if flags & (CAN_STAND | CAN_HOLD):
+                    if self.can_go(key, to):
+                        yield to
+                elif flags & CAN_FALL:
+                    x, y, z = unpack(key)
+                    if self.grid.height_at(x + i, z + j) <= y - 4:
+                        continue  # nothing to land on within three blocks
+                    for k in xrange(1, 4):
+                        flags = word(to - k)
+                        if flags & (CAN_STAND | CAN_HOLD):
+                            if self.can_go(key, to - k):
+                                yield to - k
                             break
-                        elif to_state.can_fall:
-                            continue
-                        else:
+                        elif not flags & CAN_FALL:
                             break
-                else:
-                    to_state = self.get_state(x + i, y + 1, z + j)
-                    if to_state.can_stand or to_state.can_hold:
-                        go = self.can_go(base_state, to_state)
-                        if go:
-                            yield to_state
-
-    def can_swim(self, from_state, to_state):
-        for x in xrange(from_state.x, to_state.x + 1):
-            for y in xrange(from_state.y, to_state.y + 1):
-                for z in xrange(from_state.z, to_state.z + 1):
-                    if from_state.x == x and from_state.y == y and from_state.z == z:
+                elif word(to + DY) & (CAN_STAND | CAN_HOLD):
+                    if self.can_go(key, to + DY):
+                        yield to + DY
+
+    def can_swim(self, from_key, to_key):
+        from_x, from_y, from_z = unpack(from_key)
+        to_x, to_y, to_z = unpack(to_key)
+        for x in xrange(from_x, to_x + 1):
+            for y in xrange(from_y, to_y + 1):
+                for z in xrange(from_z, to_z + 1):
+                    if from_x == x and from_y == y and from_z == z:
                         continue
-                    if to_state.x == x and to_state.y == y and to_state.z == z:
+                    if to_x == x and to_y == y and to_z == z:
                         continue
-                    to_state = self.get_state(x, y, z)
-                    if not to_state.can_be:
+                    to_x, to_y, to_z = x, y, z  # the ranges below follow the last checked node
+                    if not self.word(pack(x, y, z)) & CAN_BE:
                         return False
         return True
 
-    def can_go(self, from_state, to_state):
-        vertical = from_state.y != to_state.y and from_state.x == to_state.x and from_state.z == to_state.z
-        cross = from_state.x == to_state.x or from_state.z == to_state.z
+    def can_go(self, from_key, to_key):
+        from_x, from_y, from_z = unpack(from_key)
+        to_x, to_y, to_z = unpack(to_key)
+        vertical = from_y != to_y and from_x == to_x and from_z == to_z
+        cross = from_x == to_x or from_z == to_z
         if vertical:
-            if from_state.y > to_state.y:
-                if from_state.can_climb:
-                    return True
-                else:
-                    return False
+            if from_y > to_y:
+                return bool(self.word(from_key) & CAN_CLIMB)
             else:
                 return True
         elif not cross:
-            if from_state.y == to_state.y:
-                return self.diagonal_free(from_state, to_state, from_state.y)
-            elif from_state.y < to_state.y:
-                down = self.get_state(to_state.x, from_state.y, to_state.z)
-                if not down.can_be:
+            if from_y == to_y:
+                return self.diagonal_free(from_key, to_key, from_y)
+            elif from_y < to_y:
+                if not self.word(pack(to_x, from_y, to_z)) & CAN_BE:
                     return False
-                return self.diagonal_free(from_state, to_state, to_state.y)
+                return self.diagonal_free(from_key, to_key, to_y)
             else:
-                go = self.diagonal_free(from_state, to_state, from_state.y)
-                if not go:
+                if not self.diagonal_free(from_key, to_key, from_y):
                     return False
-                for i in xrange(from_state.y - to_state.y):
-                    down = self.get_state(to_state.x, from_state.y - i, to_state.z)
-                    if not down.can_be:
+                for i in xrange(from_y - to_y):
+                    if not self.word(pack(to_x, from_y - i, to_z)) & CAN_BE:
                         return False
                 return True
         else:
-            if from_state.y == to_state.y:
-                return True
-            elif from_state.y < to_state.y:
-                up = self.get_state(from_state.x, from_state.y + 1, from_state.z)
-                if not up.can_be:
-                    return False
+            if from_y == to_y:
                 return True
+            elif from_y < to_y:
+                return bool(self.word(from_key + DY) & CAN_BE)
             else:
-                for i in xrange(from_state.y - to_state.y):
-                    down = self.get_state(to_state.x, from_state.y - i, to_state.z)
-                    if not down.can_be:
+                for i in xrange(from_y - to_y):
+                    if not self.word(pack(to_x, from_y - i, to_z)) & CAN_BE:
                         return False
                 return True
 
-    def diagonal_free(self, from_state, to_state, y_level):
-        left = self.get_state(to_state.x, y_level, from_state.z)
-        if not left.can_be:
+    def diagonal_free(self, from_key, to_key, y_level):
+        from_x, _, from_z = unpack(from_key)
+        to_x, _, to_z = unpack(to_key)
+        if not self.word(pack(to_x, y_level, from_z)) & CAN_BE:
             return False
-        right = self.get_state(from_state.x, y_level, to_state.z)
-        if not right.can_be:
+        if not self.word(pack(from_x, y_level, to_z)) & CAN_BE:
             return False
         return True
 
     def can_stand(self, x, y, z):
-        return self.get_state(x, y, z).can_stand
+        return bool(self.word(pack(x, y, z)) & CAN_STAND)
 
 
 def can_stand_coords(grid, coords):
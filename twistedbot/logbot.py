@@ -4,7 +4,7 @@ import os
 from datetime import datetime
 
 from twisted.internet import reactor
-from twisted.python import log, util
+from twisted.python import context, log, util
 
 
 def exit_on_error(_stuff=None, _why=None):
@@ -36,7 +36,10 @@ class MinecraftLogObserver(object):
         if text is None:
             return
         timeStr = self.formatTime(eventDict['time'])
-        fmtDict = {'header': eventDict['header'], 'text':
+        header = eventDict['header']
+        if "bot" in eventDict:
+            header = "%s %s" % (eventDict["bot"], header)
+        fmtDict = {'header': header, 'text':
                    text.replace("\n", "\n\t")}
         msgStr = log._safeFormat("[%(header)s] %(text)s\n", fmtDict)
         util.untilConcludes(self.write, timeStr + " " + msgStr)
@@ -59,6 +62,16 @@ class Logger(object):
         log.err(*args, **kwargs)
 
 
+def bot_context(name, f, *args, **kwargs):
+    """ calls f with the log headers prefixed by the bot name """
+    return log.callWithContext({"bot": name}, f, *args, **kwargs)
+
+
+def current_bot():
+    """ name of the bot whose context we are in, or None """
+    return context.get(log.ILogContext, {}).get("bot", None)
+
+
 loggers = {}
 
 
@@ -0,0 +1,134 @@
+"""
+Many bots in one reactor.
+
+Each bot gets its own World and MineCraftFactory. Block, item and recipe
+registries are module level and shared by all of them. Log headers of a
+bot are prefixed by its name.
+"""
+
+import json
+import os
+import resource
+import time
+from collections import namedtuple
+
+from twisted.internet import reactor
+
+import config
+import factory
+import logbot
+from ticklag import TickLag
+from world import World
+
+
+log = logbot.getlogger("MULTIBOT")
+
+RosterEntry = namedtuple("RosterEntry", "name host port commander")
+
+
+def read_roster(path):
+    """
+    One bot per line: name [host[:port]] [commander]
+    Empty lines and lines starting with # are ignored.
+    """
+    roster = []
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            fields = line.split()
+            if len(fields) > 3:
+                raise ValueError("%s:%d expected name [host[:port]] [commander]" % (path, lineno))
+            name = fields[0]
+            host, port = config.SERVER_HOST, config.SERVER_PORT
+            if len(fields) > 1:
+                host, _, port = fields[1].partition(":")
+                port = int(port) if port else config.SERVER_PORT
+            commander = fields[2] if len(fields) > 2 else config.COMMANDER
+            roster.append(RosterEntry(name, host, port, commander))
+    names = [entry.name for entry in roster]
+    if len(set(names)) != len(names):
+        raise ValueError("%s has duplicate bot names" % path)
+    return roster
+
+
+class BotHost(object):
+    """ runs the roster bots, connecting them stagger seconds apart """
+
+    def __init__(self, roster, stagger=0.2):
+        self.roster = roster
+        self.stagger = stagger
+        self.worlds = []
+        self.factories = []
+
+    def start(self):
+        if config.USE_ENCRYPTION:
+            factory.import_encryption()
+        for i, entry in enumerate(self.roster):
+            world = World(host=entry.host, port=entry.port, commander_name=entry.commander,
+                          bot_name=entry.name, log_name=entry.name)
+            mc_factory = factory.MineCraftFactory(world)
+            self.worlds.append(world)
+            self.factories.append(mc_factory)
+            reactor.callLater(i * self.stagger, reactor.connectTCP, entry.host, entry.port, mc_factory)
+        log.msg("hosting %d bots" % len(self.worlds))
+
+    def stop(self):
+        for world in self.worlds:
+            world.in_context(world.on_shutdown)
+
+    def lag_report(self):
+        """ list of (bot name, TickLag) """
+        return [(world.log_name, world.ticklag) for world in self.worlds]
+
+    def log_lag(self):
+        total = TickLag(window=None)
+        for name, lag in self.lag_report():
+            log.msg("%-16s %s" % (name, lag))
+            total.merge(lag)
+        logged_in = sum(1 for world in self.worlds if world.logged_in)
+        log.msg("%d bots, %d logged in, %s" % (len(self.worlds), logged_in, total))
+
+
+def rss():
+    """ resident memory of this process in bytes """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MetricsReporter(object):
+    """ writes one json line of metrics of the host to fd on every report """
+
+    def __init__(self, host, fd):
+        self.host = host
+        self.fd = fd
+        self.last_time = time.time()
+        self.last_packets = 0
+
+    def metrics(self):
+        now = time.time()
+        packets = sum(world.packets_received for world in self.host.worlds)
+        rate = (packets - self.last_packets) / max(now - self.last_time, 1e-6)
+        self.last_time, self.last_packets = now, packets
+        chunks = [world.chunk_counters() for world in self.host.worlds]
+        return {"pid": os.getpid(),
+                "bots": len(self.host.worlds),
+                "logged_in": sum(1 for world in self.host.worlds if world.logged_in),
+                "packets_per_s": rate,
+                "rss": rss(),
+                "chunks": sum(c["chunks"] for c in chunks),
+                "chunk_bytes": sum(c["chunk_bytes"] for c in chunks),
+                "evicted_chunks": sum(c["evicted_chunks"] for c in chunks),
+                "lag": dict((name, [lag.count, lag.mean, lag.percentile(99), lag.max])
+                            for name, lag in self.host.lag_report())}
+
+    def report(self):
+        try:
+            os.write(self.fd, json.dumps(self.metrics()) + "\n")
+        except OSError as e:
+            log.msg("metrics pipe closed, %s, exiting" % e)
+            reactor.stop()
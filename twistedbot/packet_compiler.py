@@ -0,0 +1,703 @@
+"""
+Compiles construct packet definitions into specialised decode functions.
+
+Every packet Struct is turned into Python source that reads fixed size runs
+of fields with a single struct.unpack_from and produces the same Containers
+as construct does. Anything the compiler does not know falls back to the
+construct object itself, so construct stays the reference implementation.
+
+The compiler also makes skip functions that only find where a packet ends.
+They read the fields that lengths, counts and conditions depend on, but do
+not slice payload strings nor run adapters. Lambdas in the definitions must
+therefore only look at plain integer or flag fields.
+"""
+
+import struct
+from StringIO import StringIO
+
+from construct import Container, ListContainer
+from construct import Construct, Struct, Sequence, FormatField, StaticField
+from construct import MetaField, MetaArray, Switch, Value, Peek, RepeatUntil
+from construct import Reconfig, Buffered, Adapter
+from construct import BitIntegerAdapter, MappingAdapter, StringAdapter, LengthValueAdapter
+from construct import ConstructError, FieldError, SwitchError
+
+
+FLAG_EMBED = Construct.FLAG_EMBED
+
+header_packer = struct.Struct(">B")
+bits_formats = {8: ">B", 16: ">H", 32: ">I", 64: ">Q"}
+
+
+class PacketIncomplete(FieldError):
+    """ not enough bytes in the buffer, needed is the total length required """
+
+    def __init__(self, needed):
+        super(PacketIncomplete, self).__init__("need %d bytes" % needed)
+        self.needed = needed
+
+
+def construct_fallback(con, buf, offset, context):
+    """ parse with construct itself, used for constructs the compiler does not know """
+    stream = StringIO(buf[offset:].tobytes())
+    try:
+        obj = con._parse(stream, context)
+    except FieldError:
+        raise PacketIncomplete(len(buf) + 1)
+    return obj, offset + stream.tell()
+
+
+def is_simple(con):
+    """ fixed size single field that can be folded into one struct run """
+    if isinstance(con, FormatField):
+        return True
+    return is_flag(con)
+
+
+def is_flag(con):
+    return isinstance(con, MappingAdapter) and \
+        type(con.subcon) is StaticField and con.subcon.length == 1
+
+
+def static_size(con):
+    """ size of con if it does not depend on the data, otherwise None """
+    if con._is_flag(Construct.FLAG_DYNAMIC):
+        return None
+    try:
+        return con.sizeof()
+    except Exception:
+        return None
+
+
+def field_names(con):
+    """ names of con and of all constructs nested in it """
+    names = set()
+    stack = [con]
+    while stack:
+        con = stack.pop()
+        if con.name is not None:
+            names.add(con.name)
+        if isinstance(con, Switch):
+            stack.extend(con.cases.itervalues())
+            if con.default is not Switch.NoDefault:
+                stack.append(con.default)
+        elif isinstance(con, Struct):
+            stack.extend(con.subcons)
+        elif getattr(con, "subcon", None) is not None:
+            stack.append(con.subcon)
+    return names
+
+
+def linear_length(lengthfunc, name):
+    """ returns multiplier if lengthfunc(ctx) == ctx[name] * multiplier, otherwise None """
+    try:
+        one = lengthfunc(Container(**{name: 1}))
+        seven = lengthfunc(Container(**{name: 7}))
+    except Exception:
+        return None
+    if isinstance(one, (int, long)) and one * 7 == seven:
+        return one
+    return None
+
+
+def is_length_value(con):
+    """ LengthValueAdapter over Sequence(length field, MetaField of linear length) """
+    seq = con.subcon
+    if not isinstance(seq, Sequence) or len(seq.subcons) != 2:
+        return False
+    length, data = seq.subcons
+    return isinstance(length, FormatField) and isinstance(data, MetaField) and \
+        linear_length(data.lengthfunc, length.name) is not None
+
+
+def payload_names(con):
+    """ top level payload keys of a Struct, fields of embedded structs included """
+    names = []
+    for sc in con.subcons:
+        if isinstance(sc, Value):
+            continue
+        if sc.conflags & FLAG_EMBED:
+            inner = sc
+            while isinstance(inner, (Switch, Reconfig)):
+                inner = inner.subcon if isinstance(inner, Reconfig) else \
+                    [case for case in inner.cases.itervalues() if not isinstance(case, Value)][0]
+            names.extend(payload_names(inner))
+        elif sc.name is not None:
+            names.append(sc.name)
+    return names
+
+
+class PacketCompiler(object):
+
+    def __init__(self):
+        self.lines = []
+        self.namespace = {"Container": Container,
+                          "ListContainer": ListContainer,
+                          "PacketIncomplete": PacketIncomplete,
+                          "SwitchError": SwitchError,
+                          "construct_fallback": construct_fallback}
+        self.counter = 0
+        self.skipping = False
+
+    def const(self, obj, prefix="k"):
+        self.counter += 1
+        name = "_%s%d" % (prefix, self.counter)
+        self.namespace[name] = obj
+        return name
+
+    def tmp(self, prefix="t"):
+        self.counter += 1
+        return "%s%d" % (prefix, self.counter)
+
+    def emit(self, depth, text):
+        self.lines.append("    " * depth + text)
+
+    def need(self, depth, size):
+        self.emit(depth, "if o + %d > n: raise PacketIncomplete(o + %d)" % (size, size))
+
+    def compile(self, pid, con, skip=False):
+        self.lines = []
+        self.skipping = skip
+        fname = "%s_%d" % ("skip" if skip else "decode", pid)
+        self.emit(0, "def %s(b, o, n):" % fname)
+        size = static_size(con) if skip else None
+        if size is not None:
+            self.need(1, size)
+            self.emit(1, "return None, o + %d" % size)
+        else:
+            var = self.emit_value(con, None, 1)
+            self.emit(1, "return %s, o" % var)
+        source = "\n".join(self.lines) + "\n"
+        code = compile(source, "<packet %d %s>" % (pid, con.name), "exec")
+        exec code in self.namespace
+        f = self.namespace[fname]
+        f.source = source
+        return f
+
+    def emit_run(self, run, dvar, depth):
+        fmt = ">" + "".join(sc.packer.format[1:] if isinstance(sc, FormatField) else "B" for sc in run)
+        packer = struct.Struct(fmt)
+        pname = self.const(packer, "s")
+        self.need(depth, packer.size)
+        names = []
+        mapped = []
+        for sc in run:
+            if sc.name is None:
+                names.append("_")
+            elif is_flag(sc):
+                var = self.tmp("f")
+                names.append(var)
+                mapped.append((sc, var))
+            else:
+                names.append("%s[%r]" % (dvar, sc.name))
+        self.emit(depth, "%s, = %s.unpack_from(b, o)" % (", ".join(names), pname))
+        self.emit(depth, "o += %d" % packer.size)
+        for sc, var in mapped:
+            self.emit(depth, "%s[%r] = %s" % (dvar, sc.name, self.flag_expr(sc, var)))
+
+    def flag_expr(self, con, var):
+        decoding = dict((ord(k), v) for k, v in con.decoding.iteritems())
+        if con.decdefault is NotImplemented:
+            return "%s._decode(chr(%s), None)" % (self.const(con, "a"), var)
+        return "%s.get(%s, %s)" % (self.const(decoding, "m"), var, self.const(con.decdefault, "k"))
+
+    def emit_fields(self, subcons, cvar, dvar, depth):
+        run = []
+        for sc in subcons:
+            if is_simple(sc) and not sc.conflags & FLAG_EMBED:
+                run.append(sc)
+                continue
+            if run:
+                self.emit_run(run, dvar, depth)
+                run = []
+            if sc.conflags & FLAG_EMBED:
+                self.emit_embedded(sc, cvar, dvar, depth)
+            else:
+                var = self.emit_value(sc, cvar, depth)
+                if sc.name is not None:
+                    self.emit(depth, "%s[%r] = %s" % (dvar, sc.name, var))
+        if run:
+            self.emit_run(run, dvar, depth)
+
+    def emit_embedded(self, con, cvar, dvar, depth):
+        if isinstance(con, Reconfig):
+            self.emit_embedded(con.subcon, cvar, dvar, depth)
+        elif isinstance(con, Struct) and not isinstance(con, Sequence):
+            self.emit_fields(con.subcons, cvar, dvar, depth)
+        elif isinstance(con, Switch):
+            key = self.tmp("k")
+            self.emit(depth, "%s = %s(%s)" % (key, self.const(con.keyfunc, "p"), cvar))
+            for i, (k, case) in enumerate(con.cases.iteritems()):
+                self.emit(depth, "%s %s == %r:" % ("if" if i == 0 else "elif", key, k))
+                if isinstance(case, Value):
+                    self.emit(depth + 1, "pass")
+                else:
+                    self.emit_embedded(case, cvar, dvar, depth + 1)
+            self.emit(depth, "else:")
+            self.emit(depth + 1, "raise SwitchError(%s)" % key)
+        else:
+            raise ValueError("cannot embed %r" % con)
+
+    def emit_value(self, con, ctx, depth):
+        """ emits code that decodes con, returns the name of the variable holding the result """
+        if isinstance(con, FormatField):
+            var = self.tmp()
+            self.need(depth, con.length)
+            self.emit(depth, "%s, = %s.unpack_from(b, o)" % (var, self.const(con.packer, "s")))
+            self.emit(depth, "o += %d" % con.length)
+            return var
+        elif is_flag(con):
+            var = self.tmp()
+            self.need(depth, 1)
+            self.emit(depth, "%s, = %s.unpack_from(b, o)" % (var, self.const(header_packer, "s")))
+            self.emit(depth, "o += 1")
+            self.emit(depth, "%s = %s" % (var, self.flag_expr(con, var)))
+            return var
+        elif type(con) is StaticField:
+            var = self.tmp()
+            self.need(depth, con.length)
+            if self.skipping:
+                self.emit(depth, "%s = None" % var)
+            else:
+                self.emit(depth, "%s = b[o:o + %d].tobytes()" % (var, con.length))
+            self.emit(depth, "o += %d" % con.length)
+            return var
+        elif isinstance(con, MetaField):
+            var = self.tmp()
+            end = self.tmp("e")
+            self.emit(depth, "%s = o + %s(%s)" % (end, self.const(con.lengthfunc, "p"), ctx))
+            self.emit(depth, "if %s > n: raise PacketIncomplete(%s)" % (end, end))
+            if self.skipping:
+                self.emit(depth, "%s = None" % var)
+            else:
+                self.emit(depth, "%s = b[o:%s].tobytes()" % (var, end))
+            self.emit(depth, "o = %s" % end)
+            return var
+        elif isinstance(con, Sequence):
+            return self.emit_sequence(con, depth)
+        elif isinstance(con, Struct):
+            cvar = self.tmp("c")
+            dvar = self.tmp("d")
+            self.emit(depth, "%s = Container()" % cvar)
+            self.emit(depth, "%s = %s.__dict__" % (dvar, cvar))
+            self.emit_fields(con.subcons, cvar, dvar, depth)
+            return cvar
+        elif isinstance(con, Switch):
+            var = self.tmp()
+            key = self.tmp("k")
+            self.emit(depth, "%s = %s(%s)" % (key, self.const(con.keyfunc, "p"), ctx))
+            for i, (k, case) in enumerate(con.cases.iteritems()):
+                self.emit(depth, "%s %s == %r:" % ("if" if i == 0 else "elif", key, k))
+                case_var = self.emit_value(case, ctx, depth + 1)
+                self.emit(depth + 1, "%s = %s" % (var, case_var))
+            self.emit(depth, "else:")
+            if con.default is Switch.NoDefault:
+                self.emit(depth + 1, "raise SwitchError(%s)" % key)
+            else:
+                case_var = self.emit_value(con.default, ctx, depth + 1)
+                self.emit(depth + 1, "%s = %s" % (var, case_var))
+            return var
+        elif isinstance(con, Value):
+            var = self.tmp()
+            self.emit(depth, "%s = %s(%s)" % (var, self.const(con.func, "p"), ctx))
+            return var
+        elif isinstance(con, MetaArray):
+            return self.emit_metaarray(con, ctx, depth)
+        elif isinstance(con, RepeatUntil):
+            var = self.tmp("l")
+            self.emit(depth, "%s = []" % var)
+            self.emit(depth, "while True:")
+            item = self.emit_value(con.subcon, ctx, depth + 1)
+            self.emit(depth + 1, "%s.append(%s)" % (var, item))
+            self.emit(depth + 1, "if %s(%s, %s): break" % (self.const(con.predicate, "p"), item, ctx))
+            return var
+        elif isinstance(con, Peek):
+            var = self.tmp()
+            pos = self.tmp("o")
+            self.emit(depth, "%s = o" % pos)
+            self.emit(depth, "try:")
+            item = self.emit_value(con.subcon, ctx, depth + 1)
+            self.emit(depth + 1, "%s = %s" % (var, item))
+            self.emit(depth, "except PacketIncomplete:")
+            self.emit(depth + 1, "%s = None" % var)
+            self.emit(depth, "o = %s" % pos)
+            return var
+        elif isinstance(con, Buffered) and self.is_bit_struct(con):
+            return self.emit_bit_struct(con, depth)
+        elif isinstance(con, StringAdapter) and is_length_value(con.subcon):
+            var = self.emit_length_value(con.subcon, depth)
+            if con.encoding and not self.skipping:
+                self.emit(depth, "%s = %s.decode(%r)" % (var, var, con.encoding))
+            return var
+        elif isinstance(con, LengthValueAdapter) and is_length_value(con):
+            return self.emit_length_value(con, depth)
+        elif isinstance(con, Adapter):
+            inner = self.emit_value(con.subcon, ctx, depth)
+            if self.skipping:
+                return inner
+            var = self.tmp()
+            self.emit(depth, "%s = %s._decode(%s, %s)" % (var, self.const(con, "a"), inner, ctx))
+            return var
+        elif isinstance(con, Reconfig):
+            return self.emit_value(con.subcon, ctx, depth)
+        else:
+            var = self.tmp()
+            self.emit(depth, "%s, o = construct_fallback(%s, b, o, %s)" % (var, self.const(con, "x"), ctx))
+            return var
+
+    def emit_sequence(self, con, depth):
+        cvar = self.tmp("c")
+        var = self.tmp("l")
+        self.emit(depth, "%s = Container()" % cvar)
+        self.emit(depth, "%s = ListContainer()" % var)
+        for sc in con.subcons:
+            item = self.emit_value(sc, cvar, depth)
+            self.emit(depth, "%s.append(%s)" % (var, item))
+            if sc.name is not None:
+                self.emit(depth, "%s[%r] = %s" % (cvar, sc.name, item))
+        return var
+
+    def emit_metaarray(self, con, ctx, depth):
+        var = self.tmp("l")
+        count = self.tmp("i")
+        self.emit(depth, "%s = %s(%s)" % (count, self.const(con.countfunc, "p"), ctx))
+        size = static_size(con.subcon) if self.skipping else None
+        if size is not None:
+            end = self.tmp("e")
+            self.emit(depth, "%s = o + %s * %d" % (end, count, size))
+            self.emit(depth, "if %s > n: raise PacketIncomplete(%s)" % (end, end))
+            self.emit(depth, "o = %s" % end)
+            return "None"
+        self.emit(depth, "%s = ListContainer()" % var)
+        if isinstance(con.subcon, FormatField):
+            size = con.subcon.length
+            end = self.tmp("e")
+            pname = self.const(con.subcon.packer, "s")
+            self.emit(depth, "%s = o + %s * %d" % (end, count, size))
+            self.emit(depth, "if %s > n: raise PacketIncomplete(%s)" % (end, end))
+            self.emit(depth, "for o in xrange(o, %s, %d):" % (end, size))
+            self.emit(depth + 1, "%s.append(%s.unpack_from(b, o)[0])" % (var, pname))
+            self.emit(depth, "o = %s" % end)
+            return var
+        self.emit(depth, "for _ in xrange(%s):" % count)
+        item = self.emit_value(con.subcon, ctx, depth + 1)
+        self.emit(depth + 1, "%s.append(%s)" % (var, item))
+        return var
+
+    def is_bit_struct(self, con):
+        inner = con.subcon
+        if not isinstance(inner, Struct) or isinstance(inner, Sequence):
+            return False
+        width = 0
+        for sc in inner.subcons:
+            if not isinstance(sc, BitIntegerAdapter) or sc.swapped or sc.signed or sc.name is None:
+                return False
+            if not isinstance(sc.width, (int, long)):
+                return False
+            width += sc.width
+        return width in bits_formats
+
+    def emit_bit_struct(self, con, depth):
+        inner = con.subcon
+        width = sum(sc.width for sc in inner.subcons)
+        packer = struct.Struct(bits_formats[width])
+        word = self.tmp("w")
+        self.need(depth, packer.size)
+        self.emit(depth, "%s, = %s.unpack_from(b, o)" % (word, self.const(packer, "s")))
+        self.emit(depth, "o += %d" % packer.size)
+        shift = width
+        fields = []
+        for sc in inner.subcons:
+            shift -= sc.width
+            fields.append("%s=(%s >> %d) & %d" % (sc.name, word, shift, (1 << sc.width) - 1))
+        var = self.tmp("c")
+        self.emit(depth, "%s = Container(%s)" % (var, ", ".join(fields)))
+        return var
+
+    def emit_length_value(self, con, depth):
+        length, data = con.subcon.subcons
+        scale = linear_length(data.lengthfunc, length.name)
+        size = self.tmp("i")
+        end = self.tmp("e")
+        var = self.tmp()
+        self.need(depth, length.length)
+        self.emit(depth, "%s, = %s.unpack_from(b, o)" % (size, self.const(length.packer, "s")))
+        self.emit(depth, "o += %d" % length.length)
+        if scale == 1:
+            self.emit(depth, "%s = o + %s" % (end, size))
+        else:
+            self.emit(depth, "%s = o + %s * %d" % (end, size, scale))
+        self.emit(depth, "if %s > n: raise PacketIncomplete(%s)" % (end, end))
+        if self.skipping:
+            self.emit(depth, "%s = None" % var)
+        else:
+            self.emit(depth, "%s = b[o:%s].tobytes()" % (var, end))
+        self.emit(depth, "o = %s" % end)
+        return var
+
+
+def compile_packets(packets, skip=False):
+    """
+    Returns dict packet id -> decode function f(view, offset, length) -> (container, new offset).
+    The view is a memoryview over the received bytes, payload strings are the only copies made.
+    With skip the functions only walk the packet and return None instead of the container.
+    """
+    compiler = PacketCompiler()
+    return dict((pid, compiler.compile(pid, con, skip=skip)) for pid, con in packets.iteritems())
+
+
+def decode_stream(decoders, buf, offset=0, skippers=None, ends=None):
+    """
+    Decode as many whole packets as possible from buf starting at offset.
+
+    Returns list of (header, payload), offset of the first byte not consumed
+    and the buffer length needed before decoding can make progress again.
+    buf can be str, bytearray or memoryview. Packets with a function in
+    skippers are stepped over and left out of the list. If ends is a list,
+    the end offset of every returned packet is appended to it.
+    """
+    out = []
+    view = memoryview(buf)
+    n = len(view)
+    needed = offset + 1
+    if not skippers:
+        skippers = {}
+    while offset < n:
+        header, = header_packer.unpack_from(view, offset)
+        skipper = skippers.get(header, None)
+        decoder = decoders.get(header, None) if skipper is None else skipper
+        if decoder is None:
+            break
+        try:
+            payload, end = decoder(view, offset + 1, n)
+        except PacketIncomplete as e:
+            needed = e.needed
+            break
+        except ConstructError:
+            break
+        if skipper is None:
+            out.append((header, payload))
+            if ends is not None:
+                ends.append(end)
+        offset = end
+        needed = offset + 1
+    return out, offset, needed
+
+
+class Unsupported(Exception):
+    pass
+
+
+class EncoderCompiler(object):
+    """
+    Compiles packet Structs into functions returning the whole packet bytestream, header included.
+
+    Two functions are made for every packet. The positional one takes the
+    plain field values in declaration order, fields of nested structs made
+    of plain fields only are flattened into it. The payload one takes the
+    same nested dict or Container as make_packet. Conditions are evaluated
+    on the payload, so they are supported in the payload functions only,
+    the positional one then goes through a dict. Constructs the compiler
+    does not know are built by construct.
+    """
+
+    def __init__(self):
+        self.namespace = {"SwitchError": SwitchError}
+        self.counter = 0
+
+    def const(self, obj, prefix="k"):
+        self.counter += 1
+        name = "_%s%d" % (prefix, self.counter)
+        self.namespace[name] = obj
+        return name
+
+    def tmp(self, prefix="t"):
+        self.counter += 1
+        return "%s%d" % (prefix, self.counter)
+
+    def emit(self, depth, text):
+        self.lines.append((depth, text))
+
+    def append(self, depth, expr):
+        self.lines.append((depth, None, expr))
+
+    def flush(self, depth):
+        if self.run_args:
+            packer = struct.Struct(">" + "".join(self.run_fmt))
+            self.append(depth, "%s.pack(%s)" % (self.const(packer, "s"), ", ".join(self.run_args)))
+        self.run_fmt = []
+        self.run_args = []
+
+    def compile(self, pid, con):
+        try:
+            build = self.compile_function("build_%d" % pid, ["p"], pid, con, "p", lambda name: "p[%r]" % name)
+        except Unsupported:
+            return self.fallback(pid, con)
+        try:
+            names = []
+            encode = self.compile_function("encode_%d" % pid, names, pid, con, None, self.arg_access(names))
+        except Unsupported:
+            names = payload_names(con)
+            encode = lambda *args: build(dict(zip(names, args)))
+        encode.args = names
+        encode.build = build
+        return encode
+
+    def arg_access(self, names):
+        def access(name):
+            if name in names:
+                raise Unsupported("duplicate argument %s" % name)
+            names.append(name)
+            return name
+        return access
+
+    def compile_function(self, fname, args, pid, con, ctx, access):
+        self.lines = []
+        self.run_fmt = []
+        self.run_args = []
+        if pid is not None:
+            self.run_fmt.append("B")
+            self.run_args.append(str(pid))
+        self.emit_fields(con.subcons, ctx, access, 1)
+        self.flush(1)
+        body = []
+        if all(line[0] == 1 for line in self.lines):
+            parts = [line[2] for line in self.lines if len(line) == 3]
+            body.extend("    " + line[1] for line in self.lines if len(line) == 2)
+            if len(parts) == 1:
+                body.append("    return %s" % parts[0])
+            else:
+                body.append("    return \"\".join((%s,))" % ", ".join(parts))
+        else:
+            body.append("    r = []")
+            for line in self.lines:
+                if len(line) == 3:
+                    body.append("    " * line[0] + "r.append(%s)" % line[2])
+                else:
+                    body.append("    " * line[0] + line[1])
+            body.append("    return \"\".join(r)")
+        source = "def %s(%s):\n%s\n" % (fname, ", ".join(args), "\n".join(body))
+        code = compile(source, "<encoder %s %s>" % (fname, con.name), "exec")
+        exec code in self.namespace
+        f = self.namespace[fname]
+        f.source = source
+        return f
+
+    def emit_fields(self, subcons, ctx, access, depth):
+        for sc in subcons:
+            if isinstance(sc, Value):
+                continue
+            if sc.conflags & FLAG_EMBED:
+                self.emit_embedded(sc, ctx, access, depth)
+            elif sc.name is None:
+                raise Unsupported("unnamed field")
+            elif isinstance(sc, Struct) and not isinstance(sc, Sequence) and ctx is None and \
+                    all(is_simple(f) and f.name is not None for f in sc.subcons):
+                self.emit_fields(sc.subcons, ctx, access, depth)
+            else:
+                self.emit_value(sc, access(sc.name), ctx, depth)
+
+    def emit_embedded(self, con, ctx, access, depth):
+        if isinstance(con, Reconfig):
+            self.emit_embedded(con.subcon, ctx, access, depth)
+        elif isinstance(con, Struct) and not isinstance(con, Sequence):
+            self.emit_fields(con.subcons, ctx, access, depth)
+        elif isinstance(con, Switch):
+            self.emit_switch(con, ctx, depth, lambda case, depth: self.emit_embedded(case, ctx, access, depth))
+        else:
+            raise Unsupported("cannot embed %r" % con)
+
+    def emit_switch(self, con, ctx, depth, emit_case):
+        if ctx is None or con.include_key:
+            raise Unsupported("switch needs the payload as context")
+        self.flush(depth)
+        key = self.tmp("k")
+        self.emit(depth, "%s = %s(%s)" % (key, self.const(con.keyfunc, "p"), ctx))
+        for i, (k, case) in enumerate(con.cases.iteritems()):
+            self.emit(depth, "%s %s == %r:" % ("if" if i == 0 else "elif", key, k))
+            self.emit_case(case, depth + 1, emit_case)
+        self.emit(depth, "else:")
+        if con.default is Switch.NoDefault:
+            self.emit(depth + 1, "raise SwitchError(%s)" % key)
+        else:
+            self.emit_case(con.default, depth + 1, emit_case)
+
+    def emit_case(self, case, depth, emit_case):
+        start = len(self.lines)
+        if not isinstance(case, Value):
+            emit_case(case, depth)
+            self.flush(depth)
+        if len(self.lines) == start:
+            self.emit(depth, "pass")
+
+    def emit_value(self, con, value, ctx, depth):
+        """ emits code that writes value encoded by con """
+        if isinstance(con, FormatField):
+            self.run_fmt.append(con.packer.format[1:])
+            self.run_args.append(value)
+        elif is_flag(con):
+            mapping = dict((k, ord(v)) for k, v in con.encoding.iteritems() if isinstance(v, str))
+            self.run_fmt.append("B")
+            self.run_args.append("%s(%s)" % (self.const(self.flag_encoder(con, mapping), "f"), value))
+        elif isinstance(con, MetaField) or type(con) is StaticField:
+            self.flush(depth)
+            self.append(depth, value)
+        elif isinstance(con, StringAdapter) and isinstance(con.subcon, LengthValueAdapter) and \
+                is_length_value(con.subcon):
+            length = con.subcon.subcon.subcons[0]
+            var = self.tmp()
+            if con.encoding:
+                self.emit(depth, "%s = %s.encode(%r)" % (var, value, con.encoding))
+            else:
+                self.emit(depth, "%s = %s" % (var, value))
+            self.run_fmt.append(length.packer.format[1:])
+            self.run_args.append("%s._encode(%s, None)[0]" % (self.const(con.subcon, "a"), var))
+            self.flush(depth)
+            self.append(depth, var)
+        elif isinstance(con, Struct) and not isinstance(con, Sequence):
+            var = self.tmp("c")
+            self.emit(depth, "%s = %s" % (var, value))
+            self.emit_fields(con.subcons, var, lambda name: "%s[%r]" % (var, name), depth)
+        elif isinstance(con, Switch):
+            self.emit_switch(con, ctx, depth, lambda case, depth: self.emit_value(case, value, ctx, depth))
+        elif isinstance(con, Adapter) and not isinstance(con, (StringAdapter, LengthValueAdapter)):
+            var = self.tmp()
+            self.emit(depth, "%s = %s._encode(%s, %s)" % (var, self.const(con, "a"), value, ctx))
+            self.emit_value(con.subcon, var, ctx, depth)
+        elif not con._is_flag(Construct.FLAG_DYNAMIC) or isinstance(con, Struct):
+            # self contained, let construct build it
+            self.flush(depth)
+            self.append(depth, "%s.build(%s)" % (self.const(con, "x"), value))
+        else:
+            raise Unsupported("cannot encode %r" % con)
+
+    @staticmethod
+    def flag_encoder(con, mapping):
+        def encode_flag(value):
+            try:
+                return mapping[value]
+            except (KeyError, TypeError):
+                return ord(con._encode(value, None))
+        return encode_flag
+
+    def fallback(self, pid, con):
+        names = payload_names(con)
+        header = chr(pid)
+
+        def build(payload):
+            return header + con.build(Container(**payload))
+
+        def encode(*args):
+            return build(dict(zip(names, args)))
+        encode.args = names
+        encode.build = build
+        return encode
+
+
+def compile_encoders(packets):
+    """
+    Returns dict packet id -> encode function f(*values) -> packet bytestream.
+    f.args holds the value names and f.build(payload) encodes a make_packet payload.
+    """
+    compiler = EncoderCompiler()
+    return dict((pid, compiler.compile(pid, con)) for pid, con in packets.iteritems())
@@ -0,0 +1,263 @@
+"""
+Sample payloads for every packet id, used to check that the packet decoding
+engines agree with each other and as a source of locally generated traffic.
+"""
+
+import gzip
+import zlib
+from StringIO import StringIO
+
+from construct import Struct, FormatField
+from pynbt import NBTFile, TAG_Compound, TAG_String, TAG_Short, TAG_List
+
+from packets import packets, parse_packets, make_packet, skippers, encoders
+from packet_compiler import decode_stream
+from packets import Container, Metadata
+
+
+def nbt_bytes():
+    display = TAG_Compound()
+    display[u'Name'] = TAG_String(u'sample')
+    enchantment = TAG_Compound()
+    enchantment[u'id'] = TAG_Short(16)
+    enchantment[u'lvl'] = TAG_Short(2)
+    nbt = NBTFile(name=u'')
+    nbt[u'display'] = display
+    nbt[u'ench'] = TAG_List(TAG_Compound, [enchantment])
+    f = StringIO()
+    gz = gzip.GzipFile(fileobj=f, mode='wb')
+    nbt.save(gz)
+    gz.close()
+    return f.getvalue()
+
+
+NBT_DATA = nbt_bytes()
+
+
+def slot(item_id=-1, count=1, damage=0, nbt=None):
+    if item_id < 0:
+        return Container(id=item_id)
+    if nbt is None:
+        return Container(id=item_id, count=count, damage=damage, size=-1, data=None)
+    return Container(id=item_id, count=count, damage=damage, size=len(nbt), data=nbt)
+
+
+def section_data(sections, block_id=1, meta=0, light_data=True, biomes=True):
+    """ raw (not compressed) column data for given number of sections, all of one block type """
+    data = chr(block_id) * 4096 * sections + chr(meta | meta << 4) * 2048 * sections
+    if light_data:
+        data += "\xff" * 2048 * sections * 2
+    if biomes:
+        data += "\x01" * 256
+    return data
+
+
+def metadata():
+    return {0: Metadata("byte", 0), 1: Metadata("short", 300), 8: Metadata("int", 0), 16: Metadata("float", 1.5)}
+
+
+def samples():
+    """ returns dict packet id -> list of payload containers """
+    chunk = zlib.compress(section_data(2))
+    bulk = zlib.compress(section_data(1) + section_data(3, block_id=3))
+    s = {
+        0: [Container(pid=12345)],
+        1: [Container(eid=1, level_type=u"default", game_mode=0, dimension=0, difficulty=1, unused=0, players=20)],
+        2: [Container(protocol=61, username=u"twistedbot", server_host=u"localhost", server_port=25565)],
+        3: [Container(message=u"<lukleh> hello \xe9")],
+        4: [Container(timestamp=123456789, daytime=-6000)],
+        5: [Container(eid=7, slot=0, slotdata=slot(276, 1, 5)), Container(eid=7, slot=1, slotdata=slot())],
+        6: [Container(x=-100, y=64, z=250)],
+        7: [Container(eid=1, target=2, button=1)],
+        8: [Container(hp=20, fp=18, saturation=5.0)],
+        9: [Container(dimension=-1, difficulty=1, game_mode=0, world_height=256, level_type=u"default")],
+        10: [Container(grounded=1)],
+        11: [Container(position=Container(x=1.5, y=64.0, stance=65.62, z=-3.5), grounded=Container(grounded=1))],
+        12: [Container(orientation=Container(yaw=90.0, pitch=-10.0), grounded=Container(grounded=0))],
+        13: [Container(position=Container(x=1.5, y=65.62, stance=64.0, z=-3.5),
+                       orientation=Container(yaw=90.0, pitch=-10.0),
+                       grounded=Container(grounded=1))],
+        14: [Container(state=0, x=-10, y=63, z=20, face=1)],
+        15: [Container(x=-10, y=63, z=20, face=1, slotdata=slot(4, 64, 0), cursor_x=8, cursor_y=16, cursor_z=8)],
+        16: [Container(active_slot=3)],
+        17: [Container(eid=5, unknown=0, x=10, y=64, z=10)],
+        18: [Container(eid=5, animation=1)],
+        19: [Container(eid=5, action=1)],
+        20: [Container(eid=9, username=u"lukleh", x=32, y=2048, z=-64, yaw=10, pitch=20, item=0, metadata=metadata())],
+        22: [Container(collected_eid=10, collector_eid=9)],
+        23: [Container(eid=11, type=2, x=32, y=2048, z=-64, yawn=0, pitch=0, object_data=0, velocity=None),
+             Container(eid=12, type=60, x=32, y=2048, z=-64, yawn=0, pitch=0, object_data=9, velocity=Container(x=1, y=2, z=3))],
+        24: [Container(eid=13, type=50, x=32, y=2048, z=-64, yaw=0, pitch=0, head_yaw=0,
+                       velocity_x=0, velocity_y=0, velocity_z=0, metadata=metadata())],
+        25: [Container(eid=14, title=u"Kebab", x=1, y=65, z=2, direction=1)],
+        26: [Container(eid=15, x=32, y=2048, z=-64, count=3)],
+        28: [Container(eid=13, x=-100, y=0, z=350)],
+        29: [Container(count=3, eids=[13, 14, 15])],
+        30: [Container(eid=13)],
+        31: [Container(eid=13, dx=1, dy=-2, dz=3)],
+        32: [Container(eid=13, yaw=100, pitch=200)],
+        33: [Container(eid=13, dx=1, dy=-2, dz=3, yaw=100, pitch=200)],
+        34: [Container(eid=13, x=32, y=2048, z=-64, yaw=100, pitch=200)],
+        35: [Container(eid=13, yaw=100)],
+        38: [Container(eid=13, status=2)],
+        39: [Container(eid=13, vehicle_id=11)],
+        40: [Container(eid=13, metadata={0: Metadata("byte", 1), 10: Metadata("slotdata", slot(260, 1, 0)),
+                                         17: Metadata("string16", u"name"), 18: Metadata("int_tup", Container(x=1, y=2, z=3))})],
+        41: [Container(eid=13, effect=1, amount=0, duration=600)],
+        42: [Container(eid=13, effect=1)],
+        43: [Container(current=0.5, level=3, total=40)],
+        51: [Container(x=-2, z=3, continuous=True, primary_bitmap=3, add_bitmap=0, size=len(chunk), data=chunk)],
+        52: [Container(x=-2, z=3, count=2, datasize=8,
+                       blocks=[Container(x=1, z=2, y=64, block_id=4, meta=0), Container(x=15, z=0, y=255, block_id=35, meta=14)])],
+        53: [Container(x=-20, y=64, z=30, type=58, meta=0)],
+        54: [Container(x=-20, y=64, z=30, byte1=1, byte2=2, block_id=54)],
+        55: [Container(eid=9, x=-20, y=64, z=30, distance=4)],
+        56: [Container(count=2, size=len(bulk), light_data=True, data=bulk,
+                       meta=[Container(x=0, z=0, primary_bitmap=1, add_bitmap=0),
+                             Container(x=1, z=0, primary_bitmap=7, add_bitmap=0)])],
+        60: [Container(x=1.5, y=64.0, z=-3.5, radius=3.0, count=2,
+                       records=[Container(x=1, y=0, z=-1), Container(x=-2, y=1, z=0)],
+                       player_motion_x=0.0, player_motion_y=0.5, player_motion_z=0.0)],
+        61: [Container(sid=1001, x=-20, y=64, z=30, data=0, volume_decrease=False)],
+        62: [Container(sound_name=u"step.grass", x=-160, y=512, z=240, volume=1.0, pitch=63)],
+        63: [Container(particle_name=u"crit", x=1.0, y=2.0, z=3.0, offset_x=0.5, offset_y=0.5, offset_z=0.5, speed=1.0, count=10)],
+        70: [Container(state=1, creative=0)],
+        71: [Container(eid=20, unknown=True, x=32, y=2048, z=-64)],
+        100: [Container(window_id=1, window_type=1, title=u"Crafting", extra_slots=9, use_provided_title=False)],
+        101: [Container(window_id=1)],
+        102: [Container(window_id=0, slot=36, mouse_button=0, action_number=1, hold_shift=False, slotdata=slot(17, 4, 1))],
+        103: [Container(window_id=0, slot=36, slotdata=slot(17, 4, 1)),
+              Container(window_id=0, slot=37, slotdata=slot(278, 1, 10, NBT_DATA))],
+        104: [Container(window_id=0, length=4, slotdata=[slot(), slot(1, 64, 0), slot(278, 1, 10, NBT_DATA), slot()])],
+        105: [Container(window_id=1, bar=0, progress=100)],
+        106: [Container(window_id=0, action_number=1, confirmed=True)],
+        107: [Container(slot=36, slotdata=slot(1, 1, 0))],
+        108: [Container(window_id=1, enchantment=2)],
+        130: [Container(x=-20, y=64, z=30, line1=u"waypoint", line2=u"1", line3=u"home", line4=u"")],
+        131: [Container(primary=358, secondary=0, length=3, data="map")],
+        132: [Container(x=-20, y=64, z=30, action=1, size=len(NBT_DATA), nbt=NBT_DATA),
+              Container(x=-20, y=64, z=30, action=1, size=0, nbt=None)],
+        200: [Container(sid=1004, count=1)],
+        201: [Container(name=u"lukleh", online=True, ping=35)],
+        202: [Container(flags=5, is_god=1, is_flying=0, can_fly=4, is_creative=0, walking_speed=25, flying_speed=12)],
+        203: [Container(text=u"/he")],
+        204: [Container(locale=u"en_GB", view_distance=0, chat_flags=0, difficulty=0, show_cape=True)],
+        205: [Container(status=0)],
+        206: [Container(name=u"kills", display_text=u"Kills", create_remove=0)],
+        207: [Container(item_name=u"lukleh", update_remove=0, score_name=u"kills", value=3),
+              Container(item_name=u"lukleh", update_remove=1)],
+        208: [Container(position=1, name=u"kills")],
+        209: [Container(team_name=u"red", mode=0, team_display_name=u"Red", team_prefix=u"[r]", team_suffix=u"",
+                        friendly_fire=1, player_count=2, names=[u"lukleh", u"twistedbot"]),
+              Container(team_name=u"red", mode=1)],
+        250: [Container(channel=u"MC|Brand", length=7, data="vanilla")],
+        252: [Container(shared_length=4, shared_secret="abcd", token_length=2, token_secret="xy")],
+        253: [Container(server_id=u"-", public_key_length=3, public_key="key", token_length=4, verify_token="1234")],
+        254: [Container(magic_number=1)],
+        255: [Container(message=u"kicked")],
+    }
+    return s
+
+
+def encode_samples(sample_map=None):
+    """ returns list of (packet id, packet bytes) built by the construct engine """
+    if sample_map is None:
+        sample_map = samples()
+    out = []
+    for pid in sorted(sample_map):
+        for payload in sample_map[pid]:
+            out.append((pid, make_packet(packets[pid].name, payload, template=packets[pid])))
+    return out
+
+
+def normalize(obj):
+    """ make parsed packets comparable, NBT objects have no equality """
+    if isinstance(obj, NBTFile):
+        return ("NBT", obj.pretty())
+    elif isinstance(obj, Container):
+        return dict((k, normalize(v)) for k, v in obj.iteritems())
+    elif isinstance(obj, dict):
+        return dict((k, normalize(v)) for k, v in obj.iteritems())
+    elif isinstance(obj, Metadata):
+        return Metadata(obj.type, normalize(obj.value))
+    elif isinstance(obj, (list, tuple)):
+        return [normalize(v) for v in obj]
+    return obj
+
+
+def flat_values(pid, payload):
+    """ positional values for the encoder taken from a make_packet payload """
+    encoder = encoders[pid]
+    flattened = set(sc.name for sc in packets[pid].subcons if isinstance(sc, Struct) and
+                    all(isinstance(f, FormatField) for f in sc.subcons))
+    flat = {}
+    for name, value in payload.items():
+        if name in flattened and hasattr(encoder, "source"):
+            flat.update(value.items())
+        else:
+            flat[name] = value
+    return [flat.get(name, None) for name in encoder.args]
+
+
+def check_encoders():
+    """ compiled encoders have to produce the same bytes as construct build """
+    errors = []
+    for pid, payloads in sorted(samples().iteritems()):
+        encoder = encoders[pid]
+        for payload in payloads:
+            reference = make_packet(packets[pid].name, payload, template=packets[pid])
+            try:
+                built = encoder.build(payload)
+                encoded = encoder(*flat_values(pid, payload))
+            except Exception as e:
+                errors.append("packet %d encoder failed %r" % (pid, e))
+                continue
+            if built != reference:
+                errors.append("packet %d payload encoder differs" % pid)
+            if encoded != reference:
+                errors.append("packet %d positional encoder differs" % pid)
+    return errors
+
+
+def check_conformance():
+    """
+    Round trip every packet id through both decoding engines.
+    Returns list of error descriptions, empty if the engines agree.
+    """
+    errors = check_encoders()
+    encoded = encode_samples()
+    missing = set(packets.keys()) - set(pid for pid, _ in encoded)
+    for pid in sorted(missing):
+        errors.append("packet %d has no sample" % pid)
+    for pid, data in encoded:
+        reference, ref_left = parse_packets(data, engine="construct")
+        compiled, comp_left = parse_packets(data, engine="compiled")
+        if len(reference) != 1 or ref_left:
+            errors.append("packet %d construct did not parse the sample" % pid)
+            continue
+        if normalize(reference) != normalize(compiled) or ref_left != comp_left:
+            errors.append("packet %d differs\n  construct %s\n  compiled  %s" % (pid, reference, compiled))
+            continue
+        # every truncated prefix has to be left over untouched by both engines
+        for cut in xrange(1, len(data)):
+            part = data[:cut]
+            ref, ref_left = parse_packets(part, engine="construct")
+            comp, comp_left = parse_packets(part, engine="compiled")
+            if ref or comp or ref_left != part or comp_left != part:
+                errors.append("packet %d truncated at %d handled differently" % (pid, cut))
+                break
+        # skip function has to end where the decoder ends and wait on every prefix
+        for cut in xrange(1, len(data) + 1):
+            out, offset, _ = decode_stream({}, data[:cut], 0, skippers)
+            if offset != (len(data) if cut == len(data) else 0) or out:
+                errors.append("packet %d skipped wrongly at %d" % (pid, cut))
+                break
+    stream = "".join(data for _, data in encoded)
+    reference, ref_left = parse_packets(stream + stream[:5], engine="construct")
+    compiled, comp_left = parse_packets(stream + stream[:5], engine="compiled")
+    if normalize(reference) != normalize(compiled) or ref_left != comp_left:
+        errors.append("whole sample stream differs")
+    _, offset, _ = decode_stream({}, stream, 0, skippers)
+    if offset != len(stream):
+        errors.append("whole sample stream skipped wrongly")
+    return errors
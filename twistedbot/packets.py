@@ -22,7 +22,9 @@ from construct import StringAdapter, LengthValueAdapter, Sequence
 
 from pynbt import NBTFile
 
+import config
 import logbot
+from packet_compiler import compile_packets, compile_encoders, decode_stream
 
 # Strings.
 # This one is a UCS2 string, which effectively decodes single writeChar()
@@ -111,6 +113,9 @@ class NBTAdapter(Adapter):
     def _decode(self, obj, context):
         return NBTFile(StringIO(obj), compression=NBTFile.Compression.GZIP)
 
+    def _encode(self, obj, context):
+        return obj
+
 
 def NBTdata(name, size_name):
     return NBTAdapter(MetaField(name, lambda ctx: ctx[size_name]))
@@ -747,15 +752,28 @@ packet_stream = Struct("packet_stream",
                        )
 
 
-def parse_packets(bytestream):
+decoders = compile_packets(packets)
+skippers = compile_packets(packets, skip=True)
+
+
+def parse_packets(bytestream, engine=None):
     """
     Opportunistically parse out as many packets as possible from a raw
     bytestream.
 
     Returns a tuple containing a list of unpacked packet containers, and any
     leftover unparseable bytes.
+
+    engine is "compiled" or "construct", defaults to config.PACKET_ENGINE.
+    The construct engine is the reference implementation.
     """
 
+    if engine is None:
+        engine = config.PACKET_ENGINE
+    if engine == "compiled":
+        l, offset, _ = decode_stream(decoders, bytestream)
+        return l, bytestream[offset:]
+
     container = packet_stream.parse(bytestream)
 
     l = [(i.header, i.payload) for i in container.full_packet]
@@ -763,6 +781,98 @@ def parse_packets(bytestream):
 
     return l, leftovers
 
+
+class PacketBuffer(object):
+    """
+    Growable receive buffer with a read cursor.
+
+    Received bytes are appended to a bytearray, packets are decoded in place
+    from the cursor and the cursor stays at the last complete packet boundary.
+    Decoding is not attempted again until the buffer holds at least as many
+    bytes as the incomplete packet needs, so big packets split over many
+    reads cost linear time.
+    Packet ids set with skip_packets are only framed, never decoded.
+    """
+
+    compact_size = 65536
+
+    def __init__(self, engine=None):
+        self.engine = engine
+        self.buf = bytearray()
+        self.pos = 0
+        self.needed = 1
+        self.skippers = {}
+
+    def skip_packets(self, pids):
+        self.skippers = dict((pid, skippers[pid]) for pid in pids if pid in skippers)
+
+    def __len__(self):
+        return len(self.buf) - self.pos
+
+    @property
+    def leftover(self):
+        return str(self.buf[self.pos:])
+
+    def feed(self, bytestream):
+        self.buf.extend(bytestream)
+
+    def read_packets(self):
+        """ returns list of (header, payload) of all complete packets received so far """
+        packets, _, _ = self._read(False)
+        return packets
+
+    def read_packets_raw(self):
+        """ same as read_packets but also returns the raw bytes of these packets """
+        packets, data, _ = self._read(True)
+        return packets, data
+
+    def read_frames(self):
+        """ same as read_packets but also returns list of the raw bytes of each packet """
+        packets, _, frames = self._read(False, frames=True)
+        return packets, frames
+
+    def _read(self, raw, frames=False):
+        if len(self.buf) < self.needed:
+            return [], "", []
+        start = self.pos
+        ends = [] if frames else None
+        # frames have to cover the whole stream, nothing is skipped
+        skippers = None if frames else self.skippers
+        engine = self.engine if self.engine is not None else config.PACKET_ENGINE
+        if engine == "compiled":
+            parsed, self.pos, self.needed = decode_stream(decoders, self.buf, self.pos, skippers, ends)
+        else:
+            parsed, leftover = parse_packets(str(self.buf[self.pos:]), engine=engine)
+            if skippers:
+                parsed = [p for p in parsed if p[0] not in skippers]
+            self.pos = len(self.buf) - len(leftover)
+            self.needed = len(self.buf) + 1
+            if frames:
+                # construct does not tell packet boundaries, the compiled decoders do
+                decode_stream(decoders, self.buf[start:self.pos], 0, None, ends)
+                ends = [start + end for end in ends]
+        view = memoryview(self.buf)
+        data = view[start:self.pos].tobytes() if raw else ""
+        raw_frames = []
+        if frames:
+            for end in ends:
+                raw_frames.append(view[start:end].tobytes())
+                start = end
+        del view
+        self.compact()
+        return parsed, data, raw_frames
+
+    def compact(self):
+        if self.pos == len(self.buf):
+            self.needed -= self.pos
+            self.pos = 0
+            del self.buf[:]
+        elif self.pos > self.compact_size and self.pos * 2 > len(self.buf):
+            del self.buf[:self.pos]
+            self.needed -= self.pos
+            self.pos = 0
+
+
 incremental_packet_stream = \
     Struct("incremental_packet_stream",
            Struct("full_packet",
@@ -803,6 +913,16 @@ def parse_packets_incrementally(bytestream):
         yield header, payload
 
 packets_by_name = dict((v.name, k) for (k, v) in packets.iteritems())
+encoders = compile_encoders(packets)
+
+
+def packet_encoder(packet):
+    """
+    Cached encoder for packet name, call it with the field values in
+    declaration order, fields of nested structs flattened. Returns the
+    whole packet bytestream.
+    """
+    return encoders[packets_by_name[packet]]
 
 
 def make_packet(packet, payload, template=None):
@@ -819,6 +939,8 @@ def make_packet(packet, payload, template=None):
         return ""
 
     header = packets_by_name[packet]
+    if template is None and config.PACKET_ENGINE == "compiled":
+        return encoders[header].build(payload)
     container = Container(**payload)
 
     if template is None:
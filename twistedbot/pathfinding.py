@@ -4,7 +4,7 @@ import time
 
 import config
 import logbot
-from gridspace import GridSpace
+from gridspace import GridSpace, pack_coords, unpack, unpack_coords
 from axisbox import AABB
 
 
@@ -39,28 +39,32 @@ class PathOverLimit(BaseEx):
 
 
 class PathNode(object):
-    def __init__(self, coords=None, cost=1):
-        self.coords = coords
-        self.cost = cost
+    """ A* node of the packed coords key, see gridspace.pack """
+    __slots__ = ("key", "g", "h", "f", "step", "_parent")
+
+    def __init__(self, key):
+        self.key = key
         self.g = 0
         self.h = 0
         self.f = 0
         self.step = 0
         self._parent = None
-        self.hash = hash(self.coords)
+
+    @property
+    def coords(self):
+        return unpack_coords(self.key)
 
     def __repr__(self):
-        #return "%s:st%s:cost:%s:g%s:h%s:f%s" % (str(self.coords), self.step, self.cost, self.g, self.h, self.f)
         return str(self.coords)
 
     def __lt__(self, other):
         return self.f < other.f
 
     def __eq__(self, other):
-        return self.coords == other.coords
+        return self.key == other.key
 
     def __hash__(self):
-        return self.hash
+        return hash(self.key)
 
     @property
     def parent(self):
@@ -80,22 +84,23 @@ class PathNode(object):
 class AStarCoords(object):
     def __init__(self, dimension, start_coords, goal_coords):
         self.goal_coords = goal_coords
-        self.goal_node = PathNode(goal_coords)
-        self.start_node = PathNode(start_coords)
-        self.astar = AStarAlgo(graph=GridSpace(dimension.grid), start_node=self.start_node, goal_node=self.goal_node, is_goal=self.is_goal, heuristics=self.heuristics)
+        self.goal_key = pack_coords(goal_coords.grid_shift())
+        self.start_node = PathNode(pack_coords(start_coords))
+        self.astar = AStarAlgo(graph=GridSpace(dimension.grid), start_node=self.start_node, goal_coords=self.goal_coords, is_goal=self.is_goal, heuristics=self.heuristics)
         self.t_start = time.time()
         self.path = None
 
-    def heuristics(self, start, goal):
-        adx = abs(start.coords.x - goal.coords.x)
-        adz = abs(start.coords.z - goal.coords.z)
+    def heuristics(self, node):
+        x, _, z = unpack(node.key)
+        adx = abs(x - self.goal_coords.x)
+        adz = abs(z - self.goal_coords.z)
         h_diagonal = min(adx, adz)
         h_straight = adx + adz
         h = config.COST_DIAGONAL * h_diagonal + config.COST_DIRECT * (h_straight - 2 * h_diagonal)
         return h
 
     def is_goal(self, current):
-        return current == self.goal_node
+        return current.key == self.goal_key
 
     def time_sice_start(self):
         return time.time() - self.t_start
@@ -106,7 +111,7 @@ class AStarCoords(object):
             while count < 1000:
                 self.astar.next()
         except PathNotFound:
-            log.err("did not find path between %s and %s" % (self.start_node.coords, self.goal_node.coords))
+            log.err("did not find path between %s and %s" % (self.start_node.coords, self.goal_coords))
             log.msg('time consumed %s sec, made %d iterations' % (self.time_sice_start(), self.astar.iter_count))
             raise StopIteration()
         except PathFound:
@@ -115,7 +120,7 @@ class AStarCoords(object):
             self.path = self.astar.path
             raise StopIteration()
         except PathOverLimit:
-            log.err("finding path over limit between %s and %s" % (self.start_node.coords, self.goal_node.coords))
+            log.err("finding path over limit between %s and %s" % (self.start_node.coords, self.goal_coords))
             log.msg('time consumed %s sec, made %d iterations' % (self.time_sice_start(), self.astar.iter_count))
             raise StopIteration()
         except:
@@ -124,15 +129,11 @@ class AStarCoords(object):
 
 class AStarMultiCoords(AStarCoords):
     def __init__(self, multiple_goals=None, **kwargs):
-        self.multiple_goals = [PathNode(g) for g in multiple_goals]
+        self.goal_keys = set(pack_coords(g) for g in multiple_goals)
         super(AStarMultiCoords, self).__init__(**kwargs)
 
     def is_goal(self, current):
-        for g in self.multiple_goals:
-            if current == g:
-                return True
-        else:
-            return False
+        return current.key in self.goal_keys
 
 
 class AStarBBCol(AStarCoords):
@@ -141,31 +142,29 @@ class AStarBBCol(AStarCoords):
         super(AStarBBCol, self).__init__(goal_coords=bb.bottom_center, **kwargs)
 
     def is_goal(self, current):
-        x = current.coords.x
-        y = current.coords.y
-        z = current.coords.z
+        x, y, z = unpack(current.key)
         return self.bb.collides(AABB(x, y, z, x + 1, y + config.PLAYER_HEIGHT, z + 1))
 
 
 class AStarAlgo(object):
 
-    def __init__(self, graph=None, start_node=None, goal_node=None, heuristics=None, is_goal=None, max_cost=None):
+    def __init__(self, graph=None, start_node=None, goal_coords=None, heuristics=None, is_goal=None, max_cost=None):
         self.graph = graph
         self.start_node = start_node
-        self.goal_node = goal_node
+        self.goal_coords = goal_coords
         self.heuristics = heuristics
         self.is_goal = is_goal
         if max_cost is None:
-            vdist = start_node.coords - goal_node.coords
+            vdist = start_node.coords - goal_coords
             self.max_cost = int(max(32, min(vdist.manhatan_size * 2, config.PATHFIND_LIMIT)))
         else:
             self.max_cost = int(max_cost)
         log.msg("limit for astar is %s" % self.max_cost)
         self.path = None
-        self.closed_set = set()
+        self.closed_set = set()  # packed coords
         self.open_heap = [self.start_node]
-        self.open_set = set([self.start_node])
-        self.start_node.set_score(0, self.heuristics(self.start_node, self.goal_node))
+        self.open_set = set([self.start_node.key])
+        self.start_node.set_score(0, self.heuristics(self.start_node))
         self.iter_count = 0
 
     def reconstruct_path(self, current):
@@ -179,11 +178,6 @@ class AStarAlgo(object):
     def get_edge_cost(self, node_from, node_to):
         return config.COST_DIRECT
 
-    def neighbours(self, node):
-        for state in self.graph.neighbours_of(node.coords):
-            if state.coords not in self.closed_set:
-                yield PathNode(state.coords)
-
     def next(self):
         self.iter_count += 1
         if not self.open_set:
@@ -193,19 +187,15 @@ class AStarAlgo(object):
             self.path = self.reconstruct_path(x)
             self.graph = None
             raise PathFound()
-        self.open_set.remove(x)
-        self.closed_set.add(x.coords)
-        for y in self.neighbours(x):
-            tentative_g_core = x.g + self.get_edge_cost(x, y)
-            if y not in self.open_set:
-                y.set_score(tentative_g_core, self.heuristics(y, self.goal_node))
-                y.parent = x
-                heapq.heappush(self.open_heap, y)
-                self.open_set.add(y)
-                if y.step > self.max_cost:
-                    raise PathOverLimit()
-            elif tentative_g_core < y.g:
-                y.set_score(tentative_g_core, self.heuristics(y, self.goal_node))
-                y.parent = x
-                if y.step > self.max_cost:
-                    raise PathOverLimit()
+        self.open_set.remove(x.key)
+        self.closed_set.add(x.key)
+        for key in self.graph.neighbours_of(x.key):
+            if key in self.closed_set or key in self.open_set:
+                continue
+            y = PathNode(key)
+            y.set_score(x.g + self.get_edge_cost(x, y), self.heuristics(y))
+            y.parent = x
+            heapq.heappush(self.open_heap, y)
+            self.open_set.add(key)
+            if y.step > self.max_cost:
+                raise PathOverLimit()
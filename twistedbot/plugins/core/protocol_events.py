@@ -135,8 +135,8 @@ class ProtocolEvents(PluginEventHandlerBase):
         #TODO relevant when we can enchant or use anvil
         pass
 
-    def on_load_chunk(self, x, z, continuous, primary_bit, add_bit, data_array):
-        self.world.grid.load_chunk(x=x, z=z, continuous=continuous, primary_bit=primary_bit, add_bit=add_bit, data_array=data_array)
+    def on_load_columns(self, columns):
+        self.world.grid.load_columns(columns)
 
     def on_multi_block_change(self, x, z, blocks):
         self.world.grid.multi_block_change(chunk_x=x, chunk_z=z, blocks=blocks)
@@ -144,9 +144,6 @@ class ProtocolEvents(PluginEventHandlerBase):
     def on_block_change(self, x, y, z, block_id, block_meta):
         self.world.grid.block_change(x=x, y=y, z=z, btype=block_id, bmeta=block_meta)
 
-    def on_load_bulk_chunk(self, metas, data_array, light_data):
-        self.world.grid.load_bulk_chunk(metas=metas, data_array=data_array, light_data=light_data)
-
     def on_explosion(self, x, y, z, radius, records, player_motion_x, player_motion_y, player_motion_z):
         log.msg("Explosion at %f %f %f radius %f blocks affected %d" % (x, y, z, radius, len(records)))
         self.world.grid.on_explosion(x=x, y=y, z=z, records=records)
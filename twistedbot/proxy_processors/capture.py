@@ -0,0 +1,42 @@
+"""
+Writes decrypted packet frames of both directions into a capture file,
+read it back with twistedbot.capture.CaptureReader.
+"""
+
+import time
+
+import twistedbot.logbot as logbot
+from twistedbot.capture import CaptureWriter, directions
+
+
+log = logbot.getlogger("CAPTURE")
+
+ignore_packets = []
+filter_packets = []
+needs_frames = True
+capture_file = None
+
+writer = None
+
+
+def process_packets(streamtype, pcks, encrypted=False, leftover=None, frames=None):
+    global writer
+    if not frames:
+        return
+    if writer is None:
+        path = capture_file or time.strftime("capture-%Y%m%d-%H%M%S.tbcap")
+        log.msg("capturing to %s" % path)
+        writer = CaptureWriter(path)
+    direction = directions[streamtype]
+    for p, frame in zip(pcks, frames):
+        if p[0] in ignore_packets:
+            continue
+        if filter_packets and p[0] not in filter_packets:
+            continue
+        writer.write(direction, frame)
+
+
+def finish():
+    if writer is not None:
+        writer.close()
+        log.msg("captured %d frames, %d bytes to %s" % (writer.frames, writer.bytes, writer.path))
@@ -77,10 +77,11 @@ def format_packet(data, prefix="  ", depth=1):
         return str(data)
 
 
-def process_packets(streamtype, pcks, encrypted=False, leftover=None):
+def process_packets(streamtype, pcks, encrypted=False, leftover=None, frames=None):
     """
         main function to use
         @streamtype - values 'CLIENT' or 'SERVER', depending where this data came from
+        @frames - raw bytes of each packet, only given to processors with needs_frames = True
     """
     if not pcks:
         return
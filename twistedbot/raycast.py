@@ -0,0 +1,166 @@
+"""
+Voxel raycasts over the grid sections.
+
+Rays step cell by cell with the integer DDA of Amanatides and Woo. A ray
+in an empty section, one that is all air, not sent or in a chunk that is
+not loaded, jumps to where it leaves the section without looking at its
+blocks. Nothing is built on the way, a hit is one RayHit.
+
+Faces are numbered as in the player digging and block placement packets,
+0 bottom, 1 top, 2 -z, 3 +z, 4 -x, 5 +x.
+"""
+
+import math
+from collections import namedtuple
+
+
+RayHit = namedtuple("RayHit", "block_id meta x y z face distance")
+
+INFINITY = float("inf")
+
+
+def axis_start(p, g, d):
+    """ step, t between boundaries and t to the first boundary along one axis """
+    if d > 0:
+        return 1, 1.0 / d, (g + 1 - p) / d
+    elif d < 0:
+        return -1, -1.0 / d, (p - g) / -d
+    return 0, INFINITY, INFINITY
+
+
+def left_in_section(g, step):
+    """ boundaries to cross until the next section along one axis """
+    if step > 0:
+        return 16 - (g & 15)
+    elif step < 0:
+        return (g & 15) + 1
+    return 0
+
+
+def raycast(grid, x, y, z, dx, dy, dz, max_distance=40):
+    """
+    first non air block along the ray from x, y, z in direction dx, dy, dz
+    within max_distance, the cell of x, y, z does not count. RayHit or None.
+    """
+    length = math.sqrt(dx * dx + dy * dy + dz * dz)
+    if length == 0:
+        return None
+    dx, dy, dz = dx / length, dy / length, dz / length
+    gx, gy, gz = int(math.floor(x)), int(math.floor(y)), int(math.floor(z))
+    stepx, tdx, tmaxx = axis_start(x, gx, dx)
+    stepy, tdy, tmaxy = axis_start(y, gy, dy)
+    stepz, tdz, tmaxz = axis_start(z, gz, dz)
+    facex = 4 if stepx > 0 else 5
+    facey = 0 if stepy > 0 else 1
+    facez = 2 if stepz > 0 else 3
+    chunks = grid.chunks
+    chunk_x = chunk_z = level = None
+    chunk = section = None
+    empty = True
+    while True:
+        if tmaxx < tmaxy:
+            if tmaxx < tmaxz:
+                t = tmaxx
+                gx += stepx
+                tmaxx += tdx
+                face = facex
+            else:
+                t = tmaxz
+                gz += stepz
+                tmaxz += tdz
+                face = facez
+        elif tmaxy < tmaxz:
+            t = tmaxy
+            gy += stepy
+            tmaxy += tdy
+            face = facey
+        else:
+            t = tmaxz
+            gz += stepz
+            tmaxz += tdz
+            face = facez
+        if t > max_distance:
+            return None
+        if gx >> 4 != chunk_x or gz >> 4 != chunk_z:
+            chunk_x, chunk_z, level = gx >> 4, gz >> 4, None
+            chunk = chunks.get((chunk_x, chunk_z), None)
+        if gy >> 4 != level:
+            level = gy >> 4
+            if gy < 0 or gy > 255:
+                if (gy < 0) == (stepy <= 0):
+                    return None  # out of the world and moving away
+                section = None
+            else:
+                section = None if chunk is None else chunk.sections[level]
+            empty = section is None or section.all_air
+        if empty:
+            # on to the last cell before the section boundary, the next step leaves the section
+            t_exit = INFINITY
+            left_x, left_y, left_z = left_in_section(gx, stepx), left_in_section(gy, stepy), left_in_section(gz, stepz)
+            if stepx:
+                t_exit = min(t_exit, tmaxx + (left_x - 1) * tdx)
+            if stepy:
+                t_exit = min(t_exit, tmaxy + (left_y - 1) * tdy)
+            if stepz:
+                t_exit = min(t_exit, tmaxz + (left_z - 1) * tdz)
+            if t_exit > max_distance:
+                return None
+            if tmaxx < t_exit:
+                k = min(left_x - 1, int(math.ceil((t_exit - tmaxx) / tdx)))
+                gx += k * stepx
+                tmaxx += k * tdx
+            if tmaxy < t_exit:
+                k = min(left_y - 1, int(math.ceil((t_exit - tmaxy) / tdy)))
+                gy += k * stepy
+                tmaxy += k * tdy
+            if tmaxz < t_exit:
+                k = min(left_z - 1, int(math.ceil((t_exit - tmaxz) / tdz)))
+                gz += k * stepz
+                tmaxz += k * tdz
+            continue
+        pos = (gy & 15) << 8 | (gz & 15) << 4 | (gx & 15)
+        block_id = section.block_id(pos)
+        if block_id:
+            return RayHit(block_id, section.meta_at(pos), gx, gy, gz, face, t)
+
+
+def raycast_many(grid, x, y, z, directions, max_distance=40):
+    """ raycast from x, y, z along each of the directions, list of RayHit or None """
+    return [raycast(grid, x, y, z, dx, dy, dz, max_distance) for dx, dy, dz in directions]
+
+
+def cone_directions(dx, dy, dz, half_angle, rings=3, per_ring=8):
+    """
+    unit directions of a cone around dx, dy, dz, the axis and rings of
+    per_ring rays out to half_angle radians
+    """
+    length = math.sqrt(dx * dx + dy * dy + dz * dz)
+    dx, dy, dz = dx / length, dy / length, dz / length
+    # two unit vectors perpendicular to the axis and to each other
+    if abs(dy) < 0.9:
+        ux, uy, uz = -dz, 0.0, dx
+    else:
+        ux, uy, uz = 0.0, dz, -dy
+    length = math.sqrt(ux * ux + uy * uy + uz * uz)
+    ux, uy, uz = ux / length, uy / length, uz / length
+    vx, vy, vz = dy * uz - dz * uy, dz * ux - dx * uz, dx * uy - dy * ux
+    out = [(dx, dy, dz)]
+    for ring in xrange(1, rings + 1):
+        tilt = half_angle * ring / rings
+        cos_tilt, sin_tilt = math.cos(tilt), math.sin(tilt)
+        for i in xrange(per_ring):
+            turn = 2 * math.pi * (i + 0.5 * (ring & 1)) / per_ring
+            a, b = sin_tilt * math.cos(turn), sin_tilt * math.sin(turn)
+            out.append((cos_tilt * dx + a * ux + b * vx, cos_tilt * dy + a * uy + b * vy, cos_tilt * dz + a * uz + b * vz))
+    return out
+
+
+def visible_blocks(grid, x, y, z, directions, max_distance=40):
+    """ distinct blocks hit by the rays from x, y, z, nearest first """
+    seen = {}
+    for hit in raycast_many(grid, x, y, z, directions, max_distance):
+        if hit is not None:
+            crd = (hit.x, hit.y, hit.z)
+            if crd not in seen or hit.distance < seen[crd].distance:
+                seen[crd] = hit
+    return sorted(seen.itervalues(), key=lambda hit: hit.distance)
@@ -0,0 +1,262 @@
+"""
+Compact storage of 16x16x16 chunk sections.
+
+Block ids are kept as one id for uniform sections, as 4 bit indexes into
+a palette of up to 16 ids, or as the full 4096 byte array. Meta is one
+value when uniform, otherwise the 2048 nibble bytes as they come from the
+server. Sections only ever grow into a bigger representation on writes,
+a section compacts again when the server sends it anew.
+
+Positions are y << 8 | z << 4 | x, nibbles of even positions are the
+low half of a byte. Bulk nibble work goes through translate tables, so
+unpacking a section does not loop in python.
+
+Every section counts its block ids and indexes the positions of ids with
+at most INDEX_LIMIT blocks, ores and crafting tables rather than stone.
+Both are built with the section and kept up to date by set, ids without
+an index are found by scanning the ids. The counts also tell whether a
+section is all air or all opaque blocks, grid queries skip those.
+"""
+
+import array
+import binascii
+import string
+
+from blocks import block_opaque, block_flags
+
+
+SECTION_SIZE = 4096
+NIBBLES_SIZE = SECTION_SIZE / 2
+PALETTE_SIZE = 16
+INDEX_LIMIT = 64
+
+low_nibbles = string.maketrans("".join(chr(i) for i in xrange(256)), "".join(chr(i & 15) for i in xrange(256)))
+high_nibbles = string.maketrans("".join(chr(i) for i in xrange(256)), "".join(chr(i >> 4) for i in xrange(256)))
+
+
+def unpack_nibbles(packed):
+    """ 2048 packed bytes to 4096 bytes of one nibble each """
+    out = bytearray(SECTION_SIZE)
+    packed = str(packed)
+    out[0::2] = packed.translate(low_nibbles)
+    out[1::2] = packed.translate(high_nibbles)
+    return out
+
+
+def pack_nibbles(values):
+    """ 4096 bytes below 16 to 2048 packed bytes """
+    # hexlify makes two digits of every byte, the first one is 0, the second one the value
+    swapped = bytearray(SECTION_SIZE)
+    swapped[0::2] = values[1::2]
+    swapped[1::2] = values[0::2]
+    return bytearray(binascii.unhexlify(binascii.hexlify(swapped)[1::2]))
+
+
+class Section(object):
+    """
+    ids is None for a uniform section with the id in palette[0], nibble
+    indexes with a palette, or the ids array without. meta is the nibble
+    array or None with the uniform meta in meta_value. counts maps block id
+    to its number of blocks, index block id to an array of its positions.
+    opaque caches all_opaque, None when not known. version is stamped by
+    the grid on every change, see Grid.subscribe.
+    """
+    __slots__ = ("ids", "palette", "meta", "meta_value", "counts", "index", "opaque", "version")
+
+    def __init__(self, ids, palette, meta, meta_value=0):
+        self.ids = ids
+        self.palette = palette
+        self.meta = meta
+        self.meta_value = meta_value
+        self.counts = {}
+        self.index = {}
+        self.opaque = None
+        self.version = 0
+
+    @classmethod
+    def uniform(cls, block_id, meta=0):
+        section = cls(None, [block_id], None, meta)
+        section.counts[block_id] = SECTION_SIZE
+        return section
+
+    @classmethod
+    def from_data(cls, ids, meta):
+        """ ids and meta strings as sent by the server """
+        distinct = set(ids)
+        if len(distinct) == 1:
+            section = cls(None, [ord(ids[0])], None)
+        elif len(distinct) <= PALETTE_SIZE:
+            palette = sorted(ord(c) for c in distinct)
+            table = string.maketrans("".join(chr(i) for i in palette), "".join(chr(i) for i in xrange(len(palette))))
+            section = cls(pack_nibbles(ids.translate(table)), palette, None)
+        else:
+            section = cls(bytearray(ids), None, None)
+        value = ord(meta[0])
+        if value & 15 == value >> 4 and meta.count(meta[0]) == NIBBLES_SIZE:
+            section.meta_value = value & 15
+        else:
+            section.meta = bytearray(meta)
+        for c in distinct:
+            count = ids.count(c) if len(distinct) > 1 else SECTION_SIZE
+            section.counts[ord(c)] = count
+            if count <= INDEX_LIMIT:
+                section.index[ord(c)] = array.array('H', find_all(ids, c))
+        return section
+
+    @property
+    def kind(self):
+        if self.palette is None:
+            return "array"
+        return "uniform" if self.ids is None else "palette"
+
+    @property
+    def nbytes(self):
+        """ bytes held by the arrays of the section """
+        return len(self.ids or "") + len(self.meta or "") + \
+            sum(positions.itemsize * len(positions) for positions in self.index.itervalues())
+
+    def count(self, block_id):
+        return self.counts.get(block_id, 0)
+
+    @property
+    def all_air(self):
+        return self.counts.get(0, 0) == SECTION_SIZE
+
+    @property
+    def all_opaque(self):
+        """ every block has the flags and shape of stone, see blocks.block_opaque """
+        if self.opaque is None:
+            self.opaque = all(block_opaque[block_id] for block_id in self.counts)
+        return self.opaque
+
+    @property
+    def uniform_flags(self):
+        """ block_flags shared by all blocks of an all air or all opaque section, otherwise None """
+        if self.all_air:
+            return block_flags[0]
+        if self.all_opaque:
+            return block_flags[1 << 4]
+        return None
+
+    def block_id(self, pos):
+        palette = self.palette
+        if palette is None:
+            return self.ids[pos]
+        ids = self.ids
+        if ids is None:
+            return palette[0]
+        return palette[ids[pos >> 1] >> ((pos & 1) << 2) & 15]
+
+    def meta_at(self, pos):
+        meta = self.meta
+        if meta is None:
+            return self.meta_value
+        return meta[pos >> 1] >> ((pos & 1) << 2) & 15
+
+    def key(self, pos):
+        """ block id << 4 | meta """
+        palette = self.palette
+        ids = self.ids
+        if palette is None:
+            block_id = ids[pos]
+        elif ids is None:
+            block_id = palette[0]
+        else:
+            block_id = palette[ids[pos >> 1] >> ((pos & 1) << 2) & 15]
+        meta = self.meta
+        if meta is None:
+            return block_id << 4 | self.meta_value
+        return block_id << 4 | meta[pos >> 1] >> ((pos & 1) << 2) & 15
+
+    def ids_array(self):
+        """ all 4096 ids as a new bytearray """
+        palette = self.palette
+        if palette is None:
+            return bytearray(self.ids)
+        if self.ids is None:
+            return bytearray(chr(palette[0]) * SECTION_SIZE)
+        table = "".join(chr(palette[i]) if i < len(palette) else "\x00" for i in xrange(256))
+        return bytearray(str(unpack_nibbles(self.ids)).translate(table))
+
+    def metas_array(self):
+        """ all 4096 metas as a new bytearray """
+        if self.meta is None:
+            return bytearray(chr(self.meta_value) * SECTION_SIZE)
+        return unpack_nibbles(self.meta)
+
+    def positions_of(self, block_id):
+        """ ascending positions holding block_id """
+        if block_id not in self.counts:
+            return []
+        positions = self.index.get(block_id, None)
+        if positions is not None:
+            return sorted(positions)
+        if self.ids is None:
+            return range(SECTION_SIZE)
+        return find_all(self.ids if self.palette is None else self.ids_array(), chr(block_id))
+
+    def set(self, pos, block_id, meta):
+        old_id = self.block_id(pos)
+        if old_id != block_id:
+            self.reindex(pos, old_id, block_id)
+        palette = self.palette
+        if palette is not None:
+            if self.ids is None:
+                if block_id != palette[0]:
+                    self.ids = bytearray(NIBBLES_SIZE)
+            if self.ids is not None:
+                if block_id not in palette:
+                    if len(palette) < PALETTE_SIZE:
+                        palette.append(block_id)
+                    else:
+                        self.ids = self.ids_array()
+                        self.palette = None
+                if self.palette is not None:
+                    self.set_nibble(self.ids, pos, palette.index(block_id))
+        if self.palette is None:
+            self.ids[pos] = block_id
+        if self.meta is None:
+            if meta == self.meta_value:
+                return
+            self.meta = bytearray(chr(self.meta_value | self.meta_value << 4) * NIBBLES_SIZE)
+        self.set_nibble(self.meta, pos, meta)
+
+    def reindex(self, pos, old_id, block_id):
+        self.opaque = None
+        counts, index = self.counts, self.index
+        counts[old_id] -= 1
+        if not counts[old_id]:
+            del counts[old_id]
+            index.pop(old_id, None)
+        elif old_id in index:
+            index[old_id].remove(pos)
+        count = counts.get(block_id, 0) + 1
+        counts[block_id] = count
+        if count == 1:
+            index[block_id] = array.array('H', [pos])
+        elif block_id in index:
+            if count > INDEX_LIMIT:
+                del index[block_id]
+            else:
+                index[block_id].append(pos)
+
+    @staticmethod
+    def set_nibble(nibbles, pos, value):
+        b = nibbles[pos >> 1]
+        if pos & 1:
+            nibbles[pos >> 1] = (b & 15) | (value << 4)
+        else:
+            nibbles[pos >> 1] = (b & 240) | value
+
+    def __repr__(self):
+        return "<Section %s %d bytes>" % (self.kind, self.nbytes)
+
+
+def find_all(ids, c):
+    """ positions of the character c in ids """
+    out = []
+    pos = ids.find(c)
+    while pos >= 0:
+        out.append(pos)
+        pos = ids.find(c, pos + 1)
+    return out
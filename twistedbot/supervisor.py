@@ -0,0 +1,153 @@
+"""
+Bots spread over worker processes.
+
+Every worker is multibot.py hosting one shard of the roster. A worker
+that dies is started again with the back-off of ReconnectingClientFactory,
+the delay resets once the worker reports metrics. Workers report over a
+pipe on fd 3, one json line per report.
+"""
+
+import json
+import os
+import time
+
+from twisted.internet import reactor
+from twisted.internet.protocol import ProcessProtocol, ReconnectingClientFactory
+
+import config
+import logbot
+
+
+log = logbot.getlogger("SUPERVISOR")
+
+METRICS_FD = 3
+
+
+class WorkerProtocol(ProcessProtocol):
+
+    def __init__(self, slot):
+        self.slot = slot
+        self.pending = ""
+
+    def childDataReceived(self, fd, data):
+        if fd != METRICS_FD:
+            return
+        lines = (self.pending + data).split("\n")
+        self.pending = lines.pop()
+        for line in lines:
+            try:
+                metrics = json.loads(line)
+            except ValueError:
+                log.msg("worker %d sent garbage metrics %r" % (self.slot.index, line))
+                continue
+            self.slot.got_metrics(metrics)
+
+    def processEnded(self, reason):
+        self.slot.ended(reason)
+
+
+class WorkerSlot(ReconnectingClientFactory):
+    """
+    One worker process. Plays both the factory and the connector of
+    ReconnectingClientFactory, connect starts the process.
+    """
+
+    maxDelay = config.CONNECTION_MAX_DELAY * 12
+    initialDelay = config.CONNECTION_INITIAL_DELAY * 10
+
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.delay = self.initialDelay
+        self.process = None
+        self.started = None
+        self.restarts = 0
+        self.metrics = None
+
+    def command(self):
+        s = self.supervisor
+        return [s.python, s.multibot_py, s.roster_path,
+                "--shard", "%d/%d" % (self.index, s.workers),
+                "--metrics_fd", str(METRICS_FD),
+                "--report", str(s.report)] + s.worker_args
+
+    def connect(self):
+        args = self.command()
+        self.process = reactor.spawnProcess(WorkerProtocol(self), args[0], args, env=os.environ,
+                                            childFDs={1: 1, 2: 2, METRICS_FD: "r"})
+        self.started = time.time()
+        self.metrics = None
+        log.msg("worker %d started, pid %d" % (self.index, self.process.pid))
+
+    def stopConnecting(self):
+        pass
+
+    def stop(self):
+        self.stopTrying()
+        if self.process is not None and self.process.pid is not None:
+            self.process.signalProcess("INT")
+
+    def got_metrics(self, metrics):
+        if self.metrics is None:
+            self.resetDelay()
+        self.metrics = metrics
+
+    def ended(self, reason):
+        log.msg("worker %d ended after %.1fs, %s" %
+                (self.index, time.time() - self.started, reason.getErrorMessage()))
+        self.process = None
+        self.metrics = None
+        if self.continueTrying:
+            self.restarts += 1
+            self.retry(self)
+            log.msg("worker %d restarts in %.1fs" % (self.index, self.delay))
+
+
+class Supervisor(object):
+
+    def __init__(self, roster_path, workers, python, multibot_py, report=30.0, worker_args=()):
+        self.roster_path = roster_path
+        self.workers = workers
+        self.python = python
+        self.multibot_py = multibot_py
+        self.report = report
+        self.worker_args = list(worker_args)
+        self.slots = [WorkerSlot(self, i) for i in xrange(workers)]
+
+    def start(self):
+        for slot in self.slots:
+            slot.connect()
+
+    def stop(self):
+        for slot in self.slots:
+            slot.stop()
+
+    def log_metrics(self):
+        totals = dict(bots=0, logged_in=0, packets_per_s=0.0, rss=0, lag=[])
+        for slot in self.slots:
+            m = slot.metrics
+            if m is None:
+                log.msg("worker %d no metrics yet, restarts %d" % (slot.index, slot.restarts))
+                continue
+            lags = m["lag"].values()
+            log.msg("worker %d pid %d bots %d/%d %.0f packets/s rss %.1fMB chunks %d %.1fKB each evicted %d "
+                    "restarts %d, %s" %
+                    (slot.index, m["pid"], m["logged_in"], m["bots"], m["packets_per_s"],
+                     m["rss"] / 1048576.0, m["chunks"], m["chunk_bytes"] / 1024.0 / max(1, m["chunks"]),
+                     m["evicted_chunks"], slot.restarts, lag_summary(lags)))
+            for key in ("bots", "logged_in", "packets_per_s", "rss"):
+                totals[key] += m[key]
+            totals["lag"].extend(lags)
+        log.msg("%d workers, bots %d/%d %.0f packets/s rss %.1fMB, %s" %
+                (len(self.slots), totals["logged_in"], totals["bots"], totals["packets_per_s"],
+                 totals["rss"] / 1048576.0, lag_summary(totals["lag"])))
+
+
+def lag_summary(lags):
+    """ lags are [count, mean, p99, max] of bots """
+    count = sum(lag[0] for lag in lags)
+    if not count:
+        return "no ticks"
+    mean = sum(lag[0] * lag[1] for lag in lags) / count
+    return "ticks %d lag mean %.1fms worst p99 %.1fms max %.1fms" % \
+        (count, mean * 1000, max(lag[2] for lag in lags) * 1000, max(lag[3] for lag in lags) * 1000)
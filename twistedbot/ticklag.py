@@ -0,0 +1,56 @@
+"""
+Tick lag, how late ticks happen compared to config.TIME_STEP.
+"""
+
+from collections import deque
+
+import config
+
+
+class TickLag(object):
+    """
+    Collects intervals between ticks, lag is the part over TIME_STEP.
+    Count, mean and max cover everything, percentiles the last window ticks.
+    """
+
+    def __init__(self, step=None, window=6000):
+        self.step = config.TIME_STEP if step is None else step
+        self.recent = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = None
+
+    def tick(self, now):
+        """ records the interval since the previous call """
+        if self.last is not None:
+            self.record(now - self.last)
+        self.last = now
+
+    def record(self, interval):
+        lag = max(0.0, interval - self.step)
+        self.recent.append(lag)
+        self.count += 1
+        self.total += lag
+        if lag > self.max:
+            self.max = lag
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        if not self.recent:
+            return 0.0
+        lags = sorted(self.recent)
+        return lags[min(len(lags) - 1, int(len(lags) * p / 100.0))]
+
+    def merge(self, other):
+        self.recent.extend(other.recent)
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def __str__(self):
+        return "ticks %d lag mean %.1fms p99 %.1fms max %.1fms" % \
+            (self.count, self.mean * 1000, self.percentile(99) * 1000, self.max * 1000)
@@ -0,0 +1,270 @@
+"""
+Locally generated server to client traffic and a replay harness for it.
+
+Scenarios are lists of (packet id, payload) made deterministically, so the
+replay benchmark runs offline. Replay feeds the encoded stream through
+MineCraftProtocol.parse_stream, which decodes, dispatches through the
+router and fires the EventRegister handlers of a fresh World.
+"""
+
+import random
+import time
+import zlib
+from collections import defaultdict
+from StringIO import StringIO
+
+import config
+import packet_samples
+from packets import make_packet, packets, decoders
+from packets import Container, Metadata
+
+
+BOT_EID = 1
+SPAWN = (8, 64, 8)
+
+
+def terrain_column(x, z, light_data=True):
+    """ raw column data with 4 sections: stone with ores, dirt, grass at y 63, air above """
+    rnd = random.Random(x * 7919 + z)
+    types = bytearray()
+    for y in xrange(64):
+        for _ in xrange(256):
+            if y == 0:
+                types.append(7)
+            elif y < 59:
+                types.append(rnd.choice((1, 1, 1, 1, 1, 1, 13, 16, 15)))
+            elif y < 63:
+                types.append(3)
+            else:
+                types.append(2)
+    sections = 4
+    data = str(types) + "\x00" * 2048 * sections
+    if light_data:
+        data += "\x00" * 2048 * sections + "\xff" * 2048 * sections
+    return data + "\x01" * 256
+
+
+def terrain_grid(radius=2, cx=0, cz=0):
+    """ Grid without a dimension loaded with terrain columns around column cx, cz """
+    from grid import Grid, read_column
+    grid = Grid(None)
+    grid.load_columns([read_column(StringIO(terrain_column(x, z)), x, z, True, 15, 0)
+                       for x, z in area(cx, cz, radius)])
+    return grid
+
+
+def chunk_packet(x, z):
+    data = zlib.compress(terrain_column(x, z))
+    return 51, Container(x=x, z=z, continuous=True, primary_bitmap=15, add_bitmap=0, size=len(data), data=data)
+
+
+def bulk_packet(columns):
+    data = zlib.compress("".join(terrain_column(x, z) for x, z in columns))
+    metas = [Container(x=x, z=z, primary_bitmap=15, add_bitmap=0) for x, z in columns]
+    return 56, Container(count=len(metas), size=len(data), light_data=True, data=data, meta=metas)
+
+
+def area(cx, cz, radius):
+    return [(x, z) for x in xrange(cx - radius, cx + radius + 1) for z in xrange(cz - radius, cz + radius + 1)]
+
+
+def mob_metadata(rnd):
+    return {0: Metadata("byte", 0), 1: Metadata("short", 300), 16: Metadata("byte", rnd.randint(0, 3))}
+
+
+def login(eid=BOT_EID):
+    x, y, z = SPAWN
+    return [(1, Container(eid=eid, level_type=u"default", game_mode=0, dimension=0, difficulty=1,
+                          unused=0, players=20)),
+            (6, Container(x=x, y=y, z=z)),
+            (202, Container(flags=0, is_god=0, is_flying=0, can_fly=0, is_creative=0,
+                            walking_speed=25, flying_speed=12)),
+            (16, Container(active_slot=0)),
+            (4, Container(timestamp=0, daytime=1000))]
+
+
+def location():
+    x, y, z = SPAWN
+    return [(13, Container(position=Container(x=x + 0.5, y=y + config.PLAYER_EYELEVEL, stance=float(y), z=z + 0.5),
+                           orientation=Container(yaw=0.0, pitch=0.0),
+                           grounded=Container(grounded=1)))]
+
+
+def spawn_mobs(rnd, first_eid, count):
+    out = []
+    for eid in xrange(first_eid, first_eid + count):
+        out.append((24, Container(eid=eid, type=rnd.choice((50, 51, 52, 54, 90, 91, 92, 93)),
+                                  x=rnd.randint(-256, 768), y=64 * 32, z=rnd.randint(-256, 768),
+                                  yaw=rnd.randint(-128, 127), pitch=0, head_yaw=0,
+                                  velocity_x=0, velocity_y=0, velocity_z=0, metadata=mob_metadata(rnd))))
+    return out
+
+
+def scenario_spawn():
+    """ login, inventory, the first chunks, players and mobs around """
+    rnd = random.Random(1)
+    out = login()
+    slots = [packet_samples.slot() for _ in xrange(45)]
+    slots[36] = packet_samples.slot(278, 1, 10, packet_samples.NBT_DATA)
+    slots[37] = packet_samples.slot(4, 64, 0)
+    out.append((104, Container(window_id=0, length=len(slots), slotdata=slots)))
+    out.append((8, Container(hp=20, fp=20, saturation=5.0)))
+    columns = area(0, 0, 3)
+    for i in xrange(0, len(columns), 10):
+        out.append(bulk_packet(columns[i:i + 10]))
+    out.extend(location())
+    for name in (u"lukleh", u"twistedbot", u"steve", u"alex"):
+        out.append((201, Container(name=name, online=True, ping=rnd.randint(10, 200))))
+    out.extend(spawn_mobs(rnd, 100, 40))
+    for eid in xrange(100, 140):
+        out.append((40, Container(eid=eid, metadata=mob_metadata(rnd))))
+        out.append((5, Container(eid=eid, slot=0, slotdata=packet_samples.slot(rnd.choice((-1, 261, 267))))))
+    return out
+
+
+def scenario_chunk_load():
+    """ teleport into an unknown area, lots of chunk data and unloading of the old area """
+    out = login() + [bulk_packet(area(0, 0, 1))] + location()
+    columns = area(20, 20, 5)
+    for i in xrange(0, len(columns), 10):
+        out.append(bulk_packet(columns[i:i + 10]))
+    for x, z in area(20, 20, 7):
+        if abs(x - 20) > 5 or abs(z - 20) > 5:
+            out.append(chunk_packet(x, z))
+    for x, z in area(0, 0, 1):
+        out.append((51, Container(x=x, z=z, continuous=True, primary_bitmap=0, add_bitmap=0,
+                                  size=len(zlib.compress("")), data=zlib.compress(""))))
+    rnd = random.Random(2)
+    for _ in xrange(50):
+        x, z = rnd.choice(columns)
+        blocks = [Container(x=rnd.randint(0, 15), z=rnd.randint(0, 15), y=rnd.randint(0, 63),
+                            block_id=rnd.choice((0, 1, 4)), meta=0) for _ in xrange(8)]
+        out.append((52, Container(x=x, z=z, count=len(blocks), datasize=4 * len(blocks), blocks=blocks)))
+    return out
+
+
+def scenario_combat(length=4000):
+    """ many mobs moving, hurting, dying and respawning around the bot """
+    rnd = random.Random(3)
+    out = login() + [bulk_packet(area(0, 0, 1))] + location()
+    alive = range(100, 160)
+    out.extend(spawn_mobs(rnd, 100, 60))
+    next_eid = 160
+    while len(out) < length:
+        eid = rnd.choice(alive)
+        kind = rnd.random()
+        if kind < 0.4:
+            out.append((33, Container(eid=eid, dx=rnd.randint(-8, 8), dy=rnd.randint(-4, 4), dz=rnd.randint(-8, 8),
+                                      yaw=rnd.randint(0, 255), pitch=rnd.randint(0, 255))))
+        elif kind < 0.55:
+            out.append((28, Container(eid=eid, x=rnd.randint(-800, 800), y=rnd.randint(-800, 800),
+                                      z=rnd.randint(-800, 800))))
+        elif kind < 0.65:
+            out.append((35, Container(eid=eid, yaw=rnd.randint(0, 255))))
+        elif kind < 0.72:
+            out.append((38, Container(eid=eid, status=2)))
+            out.append((62, Container(sound_name=u"mob.zombie.hurt", x=eid, y=512, z=0, volume=1.0, pitch=63)))
+        elif kind < 0.78:
+            out.append((18, Container(eid=eid, animation=1)))
+        elif kind < 0.84:
+            out.append((40, Container(eid=eid, metadata=mob_metadata(rnd))))
+        elif kind < 0.88:
+            out.append((8, Container(hp=rnd.randint(1, 20), fp=20, saturation=5.0)))
+        elif kind < 0.92:
+            out.append((63, Container(particle_name=u"crit", x=1.0, y=65.0, z=3.0, offset_x=0.5, offset_y=0.5,
+                                      offset_z=0.5, speed=1.0, count=10)))
+        elif kind < 0.96:
+            out.append((29, Container(count=1, eids=[eid])))
+            alive.remove(eid)
+            out.extend(spawn_mobs(rnd, next_eid, 1))
+            alive.append(next_eid)
+            next_eid += 1
+        else:
+            out.append((34, Container(eid=eid, x=rnd.randint(-256, 768), y=64 * 32, z=rnd.randint(-256, 768),
+                                      yaw=rnd.randint(0, 255), pitch=0)))
+    return out
+
+
+def scenario_idle(length=2000):
+    """ nothing happens, keep alives, time updates and a few animals looking around """
+    rnd = random.Random(4)
+    out = login() + [bulk_packet(area(0, 0, 1))] + location()
+    out.extend(spawn_mobs(rnd, 100, 10))
+    tick = 0
+    while len(out) < length:
+        tick += 1
+        if tick % 20 == 0:
+            out.append((4, Container(timestamp=tick, daytime=1000 + tick)))
+        if tick % 400 == 0:
+            out.append((0, Container(pid=tick)))
+            out.append((201, Container(name=u"lukleh", online=True, ping=rnd.randint(10, 200))))
+        eid = rnd.randint(100, 109)
+        out.append((35, Container(eid=eid, yaw=rnd.randint(0, 255))))
+        out.append((32, Container(eid=eid, yaw=rnd.randint(0, 255), pitch=rnd.randint(0, 255))))
+    return out
+
+
+scenarios = {"spawn": scenario_spawn,
+             "chunk-load": scenario_chunk_load,
+             "combat": scenario_combat,
+             "idle": scenario_idle}
+
+
+def encode(scenario):
+    """ list of (packet id, packet bytes) """
+    return [(pid, make_packet(packets[pid].name, payload)) for pid, payload in scenario]
+
+
+class NullTransport(object):
+
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+
+class Replay(object):
+    """ replays one encoded scenario into a fresh World, read_size mimics TCP reads """
+
+    def __init__(self, frames, read_size=4096):
+        self.frames = frames
+        self.stream = "".join(data for _, data in frames)
+        self.read_size = read_size
+
+    def decode_times(self, repeat=10):
+        """ returns dict packet id -> (count, mean decode time) """
+        frames = defaultdict(list)
+        for pid, data in self.frames:
+            frames[pid].append(memoryview(data))
+        out = {}
+        for pid, views in frames.iteritems():
+            decoder = decoders[pid]
+            start = time.time()
+            for _ in xrange(repeat):
+                for view in views:
+                    decoder(view, 1, len(view))
+            out[pid] = (len(views), (time.time() - start) / (repeat * len(views)))
+        return out
+
+    def decode(self):
+        """ returns seconds to decode the whole stream in read_size pieces """
+        from packets import PacketBuffer
+        buf = PacketBuffer()
+        start = time.time()
+        for i in xrange(0, len(self.stream), self.read_size):
+            buf.feed(self.stream[i:i + self.read_size])
+            buf.read_packets()
+        return time.time() - start
+
+    def pipeline(self):
+        """ returns seconds to decode and dispatch the whole stream to a fresh World """
+        from world import World
+        from factory import MineCraftProtocol
+        world = World()
+        protocol = MineCraftProtocol(world)
+        protocol.transport = NullTransport()
+        start = time.time()
+        for i in xrange(0, len(self.stream), self.read_size):
+            protocol.parse_stream(self.stream[i:i + self.read_size])
+        return time.time() - start
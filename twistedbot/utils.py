@@ -21,7 +21,11 @@ def do_later(delay, fn, *args, **kwargs):
     d = defer.Deferred()
     d.addCallback(lambda ignored: fn(*args, **kwargs))
     d.addErrback(logbot.exit_on_error)
-    reactor.callLater(delay, d.callback, None)
+    bot = logbot.current_bot()
+    if bot is None:
+        reactor.callLater(delay, d.callback, None)
+    else:
+        reactor.callLater(delay, logbot.bot_context, bot, d.callback, None)
     return d
 
 
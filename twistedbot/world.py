@@ -1,5 +1,6 @@
 
 
+import time
 from collections import defaultdict
 from datetime import datetime
 
@@ -7,6 +8,7 @@ import logbot
 import utils
 import config
 import inventory
+import chunkcache
 from entities import Entities
 from grid import Grid
 from statistics import Statistics
@@ -14,6 +16,7 @@ from chat import Chat
 from botentity import BotEntity
 from signwaypoints import SignWayPoints
 from eventregister import EventRegister
+from ticklag import TickLag
 
 
 log = logbot.getlogger("WORLD")
@@ -27,11 +30,28 @@ class Dimension(object):
         self.sign_waypoints = SignWayPoints(self)
 
 
+class BotConfig(object):
+    """
+    Copy of the config module for one bot, so that bots hosted in one
+    process can differ in name, commander and server.
+    """
+
+    def __init__(self, **overrides):
+        for name in dir(config):
+            if name.isupper():
+                setattr(self, name, getattr(config, name))
+        for name, value in overrides.iteritems():
+            if value is not None:
+                setattr(self, name, value)
+
+
 class World(object):
-    def __init__(self, host=None, port=None, commander_name=None, bot_name=None):
+    def __init__(self, host=None, port=None, commander_name=None, bot_name=None, log_name=None):
         self.server_host = host
         self.server_port = port
-        self.config = config
+        self.log_name = log_name
+        self.config = BotConfig(USERNAME=bot_name, SERVER_HOST=host, SERVER_PORT=port,
+                                COMMANDER=commander_name.lower() if commander_name else None)
         self.eventregister = EventRegister(self)
         self.eventregister.setup()
         self.commander = Commander(commander_name)
@@ -49,13 +69,23 @@ class World(object):
         self.sign_waypoints = None
         self.dimension = None
         self.dimensions = [Dimension(self), Dimension(self), Dimension(self)]
+        for dim, d in enumerate(self.dimensions, -1):
+            d.grid.cache = chunkcache.open_cache(self.config, dim)
         self.spawn_position = None
         self.game_mode = None
         self.difficulty = None
         self.players = defaultdict(int)
         self.last_tick_time = datetime.now()
         self.period_time_estimation = config.TIME_STEP
-        utils.do_later(config.TIME_STEP, self.tick)
+        self.ticklag = TickLag()
+        self.packets_received = 0
+        self.in_context(utils.do_later, config.TIME_STEP, self.tick)
+
+    def in_context(self, f, *args, **kwargs):
+        """ calls f so that its logging, and everything it schedules, is headed by log_name """
+        if self.log_name is None:
+            return f(*args, **kwargs)
+        return logbot.bot_context(self.log_name, f, *args, **kwargs)
 
     def predict_next_ticktime(self, tick_start):
         tick_end = datetime.now()
@@ -71,11 +101,14 @@ class World(object):
 
     def tick(self):
         tick_start = datetime.now()
+        self.ticklag.tick(time.time())
         if self.logged_in:
             self.bot.tick()
             self.chat.tick()
             self.every_n_ticks()
             self.game_ticks += 1
+        if self.protocol is not None:
+            self.protocol.flush()
         utils.do_later(self.predict_next_ticktime(tick_start), self.tick)
 
     def every_n_ticks(self, n=100):
@@ -91,18 +124,36 @@ class World(object):
         else:
             log.err("Trying to send %s while disconnected" % name)
 
+    def send_values(self, name, *values):
+        if self.protocol is not None:
+            self.protocol.send_values(name, values)
+        else:
+            log.err("Trying to send %s while disconnected" % name)
+
     def dimension_change(self, dimension):
         dim = dimension + 1  # to index from 0
         d = self.dimensions[dim]
+        if self.dimension is not None and self.dimension is not d:
+            # the server sends it all again on return, keep only the sign waypoints
+            self.dimension.grid.unpin_all("path")
+            self.dimension.grid.evict(0)
         self.dimension = d
         self.entities, self.grid, self.sign_waypoints = d.entities, d.grid, d.sign_waypoints
         if not self.entities.has_entity_eid(self.bot.eid):
             self.entities.new_bot(self.bot.eid)
         log.msg("NEW DIMENSION %d" % dim)
 
+    def chunk_counters(self):
+        """ grid counters summed over the dimensions """
+        counters = defaultdict(int)
+        for d in self.dimensions:
+            for key, value in d.grid.counters().iteritems():
+                counters[key] += value
+        return counters
+
     @property
     def server_lag(self):
-        return self.players[config.USERNAME]
+        return self.players[self.config.USERNAME]
 
 
 class Commander(object):